@@ -3,14 +3,23 @@ ASGI config for backend project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+The read endpoints are served by the async views in restaurant/async_views.py,
+so one worker can keep many slow clients waiting on the database, and
+streaming responses are produced on a thread (restaurant/asgi.py), e.g.
+    uvicorn backend.asgi:application --workers 2
+    gunicorn backend.asgi:application -k uvicorn.workers.UvicornWorker
+
 For more information on this file, see
-https://docs.djangoproject.com/en/3.0/howto/deployment/asgi/
+https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
 """
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
+from restaurant.asgi import StreamingASGIHandler
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+os.environ.setdefault('FOODPOCKET_ASYNC_VIEWS', '1')
 
-application = get_asgi_application()
+django.setup(set_prefix=False)
+application = StreamingASGIHandler()
@@ -41,17 +41,42 @@ INSTALLED_APPS = [
     'django.contrib.staticfiles',
 ]
 
+# The session, csrf, auth and messages middleware skip the token authenticated
+# API under API_PREFIX (see restaurant/middleware.py SkipOnApiMixin), the admin
+# and the ops endpoints run the whole list
 MIDDLEWARE = [
+    'restaurant.middleware.ProfilingMiddleware',
+    'restaurant.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
-    'django.contrib.sessions.middleware.SessionMiddleware',
+    'restaurant.middleware.CompressionMiddleware',
+    'restaurant.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
-    'django.middleware.csrf.CsrfViewMiddleware',
-    'django.contrib.auth.middleware.AuthenticationMiddleware',
-    'django.contrib.messages.middleware.MessageMiddleware',
+    'restaurant.middleware.CsrfViewMiddleware',
+    'restaurant.middleware.AuthenticationMiddleware',
+    'restaurant.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'restaurant.middleware.ShardRoutingMiddleware',
+    'restaurant.middleware.ReplicaRoutingMiddleware',
 ]
 
+API_PREFIX = '/api/rest/'
+
+# API responses from this size on are compressed (see restaurant/compression.py),
+# smaller ones gain little and cost a compression call each
+COMPRESSION_MIN_SIZE = 1024
+
+# Compression level per endpoint (url name), brotli 0-11, gzip 1-9.
+# brotli is only offered when the brotli package is installed
+COMPRESSION_LEVELS = {
+    'default': {'br': 5, 'gzip': 6},
+    # biggest bodies, cached and sent many times
+    'getRestaurantList': {'br': 7, 'gzip': 6},
+    'getVisitRecords': {'br': 7, 'gzip': 6},
+    # streamed, a cheap level keeps up with the rows
+    'exportPocket': {'br': 3, 'gzip': 1},
+}
+
 ROOT_URLCONF = 'backend.urls'
 
 TEMPLATES = [
@@ -72,6 +97,16 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'backend.wsgi.application'
 
+ASGI_APPLICATION = 'backend.asgi.application'
+
+# Serve the read endpoints with the async views in restaurant/async_views.py,
+# backend/asgi.py turns this on, WSGI deployments keep the sync views
+ASYNC_VIEWS = os.environ.get('FOODPOCKET_ASYNC_VIEWS', '') == '1'
+
+# Size of the thread pool running blocking ORM calls for async views,
+# bounds the number of database connections one ASGI worker can open
+ASYNC_ORM_WORKERS = int(os.environ.get('FOODPOCKET_ASYNC_ORM_WORKERS', '8'))
+
 
 # Database
 # https://docs.djangoproject.com/en/3.0/ref/settings/#databases
@@ -80,9 +115,135 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
-    }
+        # a file like in production: concurrent writers (job threads) wait for the lock,
+        # the shared in-memory test database fails them with "table is locked" at once
+        'TEST': {'NAME': os.path.join(BASE_DIR, 'test-db.sqlite3')},
+    },
+    # stand-in read replica for development, point it at a real replica in production
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+    },
+    # stand-in shard for development, a second local sqlite file
+    'shard1': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'db-shard1.sqlite3'),
+    },
 }
 
+DATABASE_ROUTERS = [
+    'restaurant.routers.ShardRouter',
+    'restaurant.routers.PrimaryReplicaRouter',
+]
+
+# Aliases holding pocket data by owner (see restaurant/sharding.py),
+# e.g. FOODPOCKET_SHARDS=default,shard1, empty keeps everything on default.
+# Every shard needs the full schema: manage.py migrate --database=shard1
+DATABASE_SHARDS = [alias for alias in os.environ.get('FOODPOCKET_SHARDS', '').split(',') if alias]
+
+# Aliases GET views decorated with @db_policy('replica') read from,
+# e.g. FOODPOCKET_REPLICAS=replica, empty keeps every query on the primary
+DATABASE_REPLICAS = [alias for alias in os.environ.get('FOODPOCKET_REPLICAS', '').split(',') if alias]
+
+# After a mutation, reads of the same user_token stay on the primary for this long.
+# The pins live in the cache, use a shared cache backend with multiple workers
+REPLICA_STICKY_SECONDS = 5
+
+# Caches, local memory LRU per process by default. Use a shared backend
+# (memcached, redis) with multiple workers so replica pins are seen by all.
+# With DATABASE_SHARDS the default cache must be shared: it holds the shard
+# of each account, which manage.py rebalance changes from another process
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # serialized read responses, see restaurant/response_cache.py
+    'responses': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'responses',
+        'OPTIONS': {'MAX_ENTRIES': 5000},
+    },
+}
+
+RESPONSE_CACHE_ALIAS = 'responses'
+
+# Upper bound on how long a cached response lives; 0 disables caching.
+# Writes invalidate right away in a cache shared by every process writing
+# (web workers, runjobs, management commands); with the per-process default
+# above only the process making the write sees it, the others keep serving
+# the old responses until this runs out (manage.py check --deploy warns)
+RESPONSE_CACHE_SECONDS = 60
+
+# Identical reads missing the cache at the same time wait this long for the
+# one building the response before building it themselves
+SINGLE_FLIGHT_TIMEOUT = 5
+
+# Background jobs (see restaurant/jobs.py), run by: manage.py runjobs
+# Threads per worker process running jobs at the same time
+JOB_CONCURRENCY = 2
+
+# A running job not reporting progress for this long lost its worker and is
+# run again, at most JOB_MAX_ATTEMPTS times in total
+JOB_LEASE_SECONDS = 300
+JOB_MAX_ATTEMPTS = 3
+
+# Progress of a running job is written at most this often
+JOB_PROGRESS_INTERVAL = 1
+
+# Uploads waiting for their import job, must be shared by web and worker processes
+JOB_FILES_DIR = os.path.join(BASE_DIR, 'jobfiles')
+
+# Removed pockets, restaurants and visit records are kept this many days before
+# manage.py purgedeleted deletes (or archives) them, see restaurant/retention.py
+PURGE_RETENTION_DAYS = 30
+
+# Pause between purge batches, leaves the database to requests in between
+PURGE_PAUSE_SECONDS = 0.1
+
+# Request metrics served on /metrics (restaurant/metrics.py), FOODPOCKET_METRICS=0 turns them off
+METRICS_ENABLED = os.environ.get('FOODPOCKET_METRICS', '1') != '0'
+
+# Directory shared by the worker processes (gunicorn) for their metrics snapshots,
+# empty keeps the metrics of each process to itself
+METRICS_DIR = os.environ.get('FOODPOCKET_METRICS_DIR', '')
+
+# A worker writes its snapshot at most this often (and when it exits)
+METRICS_FLUSH_SECONDS = 5
+
+# Bearer token for scraping /metrics (Authorization: Bearer ...), staff sessions can always read it
+METRICS_TOKEN = os.environ.get('FOODPOCKET_METRICS_TOKEN', '')
+
+# Sampling profiler (restaurant/profiling.py), off unless one of these is set.
+# FOODPOCKET_PROFILE_RATE=0.01 profiles 1% of the requests from their start,
+# FOODPOCKET_PROFILE_SLOW_MS=500 profiles every request running longer than 500 ms
+# (every request is then registered and its queries timed, still cheap)
+PROFILE_SAMPLE_RATE = float(os.environ.get('FOODPOCKET_PROFILE_RATE', 0))
+PROFILE_SLOW_MS = int(os.environ['FOODPOCKET_PROFILE_SLOW_MS']) \
+    if os.environ.get('FOODPOCKET_PROFILE_SLOW_MS') else None
+
+# Between two stack samples of a profiled request
+PROFILE_INTERVAL_MS = 5
+
+# Collapsed stack files of the profiled requests, render them with a flame graph tool
+PROFILE_DIR = os.environ.get('FOODPOCKET_PROFILE_DIR', os.path.join(BASE_DIR, 'profiles'))
+
+# Pragmas applied to every new SQLite connection (see restaurant/signals.py)
+SQLITE_PRAGMAS = {}
+
+# Production database profile, enabled with FOODPOCKET_DB_PROFILE=production
+# WAL lets readers run while a writer (e.g. a last_use_time save) holds the lock,
+# and persistent connections skip reconnecting and re-applying pragmas per request,
+# on every alias: the primary, its replicas and the shards
+if os.environ.get('FOODPOCKET_DB_PROFILE') == 'production':
+    for database in DATABASES.values():
+        database['CONN_MAX_AGE'] = 600
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'mmap_size': 256 * 1024 * 1024,
+        'busy_timeout': 5000,  # milliseconds
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
@@ -15,8 +15,13 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
+from restaurant import views
 
 urlpatterns = [
     path('api/rest/', include('restaurant.urls')),
     path('admin/', admin.site.urls),
+
+    # operations, behind the admin session (full middleware stack)
+    path('ops/cacheStats/', views.cacheStats, name='cacheStats'),
+    path('metrics', views.getMetrics, name='metrics'),
 ]
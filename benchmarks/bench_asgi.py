@@ -0,0 +1,118 @@
+"""
+    Compare WSGI and ASGI throughput of the read endpoints with many slow clients
+
+    Every response is delivered to a client which needs --delay seconds to receive it.
+    A WSGI worker is blocked while sending, so it can only serve --threads clients at
+    once, an ASGI worker awaits the slow send and keeps serving other connections.
+
+    usage: python benchmarks/bench_asgi.py [--connections 200] [--requests 400]
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+from common import setup_django, seed
+
+
+def run_wsgi(query: str, args) -> float:
+    from django.core.handlers.wsgi import WSGIHandler
+    from django.test import RequestFactory
+
+    app = WSGIHandler()
+
+    def one(_):
+        environ = RequestFactory().get('/api/rest/getRestaurantList/?' + query).environ
+        body = app(environ, lambda status, headers: None)
+        for _ in body:
+            time.sleep(args.delay)  # slow client keeps the worker thread busy
+        body.close()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        list(pool.map(one, range(args.requests)))
+    return time.perf_counter() - start
+
+
+def run_asgi(query: str, args) -> float:
+    from django.core.handlers.asgi import ASGIHandler
+
+    app = ASGIHandler()
+
+    async def one(semaphore):
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+            'method': 'GET', 'scheme': 'http', 'path': '/api/rest/getRestaurantList/',
+            'query_string': query.encode(), 'headers': [(b'host', b'localhost')],
+            'server': ('localhost', 80), 'client': ('127.0.0.1', 12345),
+        }
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            if message['type'] == 'http.response.body':
+                await asyncio.sleep(args.delay)  # slow client, the worker keeps going
+
+        async with semaphore:
+            await app(scope, receive, send)
+
+    async def main():
+        semaphore = asyncio.Semaphore(args.connections)
+        await asyncio.gather(*(one(semaphore) for _ in range(args.requests)))
+
+    start = time.perf_counter()
+    asyncio.run(main())
+    return time.perf_counter() - start
+
+
+def worker(args):
+    setup_django(args.db, {'FOODPOCKET_ASYNC_VIEWS': '1' if args.mode == 'asgi' else ''})
+    query = urlencode({'user_token': args.token, 'pocket_uid': args.pocket})
+    elapsed = (run_asgi if args.mode == 'asgi' else run_wsgi)(query, args)
+    print('%-5s %12d %10d %10.2f %10.1f' % (
+        args.mode, args.connections, args.requests, elapsed, args.requests / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1].strip())
+    parser.add_argument('--connections', type=int, default=200,
+                        help='concurrent client connections')
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--threads', type=int, default=8,
+                        help='threads of the WSGI worker')
+    parser.add_argument('--delay', type=float, default=0.2,
+                        help='seconds a slow client needs to receive a response')
+    parser.add_argument('--restaurants', type=int, default=20)
+    parser.add_argument('--visits', type=int, default=50)
+    # internal, used by the child processes
+    parser.add_argument('--mode', choices=('wsgi', 'asgi'))
+    parser.add_argument('--db')
+    parser.add_argument('--token')
+    parser.add_argument('--pocket')
+    args = parser.parse_args()
+
+    if args.mode:
+        return worker(args)
+
+    # each mode runs in its own process since the url conf depends on it
+    with tempfile.TemporaryDirectory() as tmp:
+        db = os.path.join(tmp, 'bench.sqlite3')
+        setup_django(db)
+        token, pocket = seed(args.restaurants, args.visits)
+
+        print('%-5s %12s %10s %10s %10s' % ('mode', 'connections', 'requests', 'seconds', 'req/s'))
+        for mode in ('wsgi', 'asgi'):
+            sys.stdout.flush()
+            subprocess.run([sys.executable, __file__] + sys.argv[1:] + [
+                '--mode', mode, '--db', db, '--token', token, '--pocket', pocket,
+            ], check=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+    Bytes and CPU time of compressing API responses per encoding and level
+
+    getRestaurantList and the export of a pocket with long notes are
+    compressed with every level of every available encoding (brotli needs
+    pip install brotli), the levels of settings.COMPRESSION_LEVELS are marked
+
+    usage: python benchmarks/bench_compression.py [--restaurants 200] [--visits 2000]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from common import setup_django, seed
+
+LEVELS = {'gzip': (1, 6, 9), 'br': (1, 3, 5, 7, 11)}
+
+
+def measure(content: bytes, encoding: str, level: int, rounds: int) -> (int, float):
+    from restaurant import compression
+
+    start = time.process_time()
+    for _ in range(rounds):
+        size = len(compression.compress(content, encoding, level))
+    return size, (time.process_time() - start) / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1].strip())
+    parser.add_argument('--restaurants', type=int, default=200)
+    parser.add_argument('--visits', type=int, default=2000)
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        setup_django(os.path.join(tmp, 'bench.sqlite3'))
+        from django.conf import settings
+        from django.test import Client
+        from restaurant import compression
+        from restaurant.models import Restaurant
+
+        token, pocket = seed(args.restaurants, args.visits)
+        Restaurant.objects.update(note='reserve a table by the window, try the seasonal menu ' * 4)
+
+        client = Client()
+        params = {'user_token': token, 'pocket_uid': pocket}
+        bodies = {
+            'getRestaurantList': client.get('/api/rest/getRestaurantList/', params).content,
+            'exportPocket': b''.join(client.get('/api/rest/exportPocket/', params).streaming_content),
+        }
+
+        print('%-18s %-5s %5s %10s %10s %7s %9s' % (
+            'endpoint', 'enc', 'level', 'bytes', 'encoded', 'ratio', 'cpu ms'))
+        for endpoint, content in bodies.items():
+            for encoding in compression.ENCODINGS:
+                configured = compression.level_for(endpoint, encoding)
+                for level in sorted(set(LEVELS[encoding]) | {configured}):
+                    size, cpu = measure(content, encoding, level, args.rounds)
+                    print('%-18s %-5s %5d %10d %10d %7.3f %9.2f%s' % (
+                        endpoint, encoding, level, len(content), size, size / len(content),
+                        cpu * 1000, ' *' if level == configured else ''))
+
+        print('* level in settings.COMPRESSION_LEVELS, responses under %d bytes are not compressed'
+              % settings.COMPRESSION_MIN_SIZE)
+
+
+if __name__ == '__main__':
+    main()
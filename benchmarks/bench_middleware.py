@@ -0,0 +1,72 @@
+"""
+    Per-request overhead of the middleware chain on the API
+
+    "full" runs django's session, csrf, auth and messages middleware on
+    api/rest/ like before, "slim" is the current MIDDLEWARE whose subclasses
+    of them skip the API.
+    getPocketList is served from the response cache, so the time is mostly
+    the handler, the middleware and the token lookup.
+
+    usage: python benchmarks/bench_middleware.py [--requests 5000]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from common import setup_django, seed
+
+# the middleware of MIDDLEWARE which skip the API, and django's own
+STOCK = {
+    'restaurant.middleware.SessionMiddleware': 'django.contrib.sessions.middleware.SessionMiddleware',
+    'restaurant.middleware.CsrfViewMiddleware': 'django.middleware.csrf.CsrfViewMiddleware',
+    'restaurant.middleware.AuthenticationMiddleware': 'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'restaurant.middleware.MessageMiddleware': 'django.contrib.messages.middleware.MessageMiddleware',
+}
+
+
+def run(middleware: list, query: str, requests: int) -> float:
+    from django.conf import settings
+    from django.core.handlers.wsgi import WSGIHandler
+    from django.test import RequestFactory
+
+    settings.MIDDLEWARE = middleware
+    app = WSGIHandler()  # loads settings.MIDDLEWARE
+    environ = RequestFactory().get('/api/rest/getPocketList/?' + query).environ
+
+    def one():
+        body = app(dict(environ), lambda status, headers: None)
+        for _ in body:
+            pass
+        body.close()
+
+    one()  # warm up the response cache
+    start = time.perf_counter()
+    for _ in range(requests):
+        one()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1].strip())
+    parser.add_argument('--requests', type=int, default=5000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        setup_django(os.path.join(tmp, 'bench.sqlite3'))
+        from django.conf import settings
+        token, _ = seed(10, 10)
+        query = 'user_token=' + token
+
+        slim = list(settings.MIDDLEWARE)
+        full = [STOCK.get(path, path) for path in slim]
+
+        print('%-5s %11s %10s %10s %12s' % ('stack', 'middleware', 'requests', 'seconds', 'us/request'))
+        for name, middleware in (('full', full), ('slim', slim)):
+            elapsed = run(middleware, query, args.requests)
+            print('%-5s %11d %10d %10.2f %12.1f' % (
+                name, len(middleware), args.requests, elapsed, elapsed / args.requests * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+    Compare concurrent read/write throughput of the default and the production SQLite profile
+
+    Reader threads build restaurant lists, writer threads log visits and save last_use_time
+    like newVisit and getRestaurantList do. Every operation is wrapped like a request,
+    so connections are closed or kept according to CONN_MAX_AGE.
+
+    usage: python benchmarks/bench_sqlite.py [--readers 8] [--writers 2] [--seconds 5]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from common import setup_django
+
+
+def worker(args):
+    setup_django(args.db, {'FOODPOCKET_DB_PROFILE': args.profile})
+
+    from datetime import date
+    from django.db import close_old_connections, OperationalError
+    from django.utils import timezone
+    from restaurant.models import Pocket, PocketSnapshot
+
+    pocket = Pocket.objects.get(uid=args.pocket)
+    restaurants = list(pocket.getRestaurants())
+    counts = {'read': 0, 'write': 0, 'locked': 0}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + args.seconds
+
+    def request(kind, func):
+        close_old_connections()  # request_started
+        try:
+            func()
+            result = kind
+        except OperationalError:
+            result = 'locked'
+        finally:
+            close_old_connections()  # request_finished
+        with lock:
+            counts[result] += 1
+
+    def read():
+        PocketSnapshot(pocket).getRestaurantList()
+
+    def write(i):
+        restaurants[i % len(restaurants)].addVisitRecord(date.today(), 3)
+        pocket.last_use_time = timezone.now()
+        pocket.save()
+
+    def reader():
+        while time.perf_counter() < deadline:
+            request('read', read)
+
+    def writer():
+        i = 0
+        while time.perf_counter() < deadline:
+            request('write', lambda: write(i))
+            i += 1
+
+    threads = [threading.Thread(target=reader) for _ in range(args.readers)] + \
+        [threading.Thread(target=writer) for _ in range(args.writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    print('%-11s %10.1f %10.1f %8d' % (
+        args.profile or 'default', counts['read'] / args.seconds,
+        counts['write'] / args.seconds, counts['locked']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1].strip())
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--restaurants', type=int, default=50)
+    parser.add_argument('--visits', type=int, default=500)
+    # internal, used by the child processes
+    parser.add_argument('--profile')
+    parser.add_argument('--db')
+    parser.add_argument('--pocket')
+    args = parser.parse_args()
+
+    if args.db:
+        return worker(args)
+
+    print('%-11s %10s %10s %8s' % ('profile', 'reads/s', 'writes/s', 'locked'))
+    for profile in ('', 'production'):
+        # a fresh database per profile, WAL mode persists in the database file
+        with tempfile.TemporaryDirectory() as tmp:
+            db = os.path.join(tmp, 'bench.sqlite3')
+            seeder = subprocess.run([
+                sys.executable, '-c',
+                'import sys; sys.path.insert(0, %r); from common import setup_django, seed; '
+                'setup_django(%r); print(seed(%d, %d)[1])' % (
+                    os.path.dirname(os.path.abspath(__file__)), db,
+                    args.restaurants, args.visits),
+            ], check=True, stdout=subprocess.PIPE, universal_newlines=True)
+
+            sys.stdout.flush()
+            subprocess.run([sys.executable, __file__] + sys.argv[1:] + [
+                '--profile', profile, '--db', db, '--pocket', seeder.stdout.strip(),
+            ], check=True)
+
+
+if __name__ == '__main__':
+    main()
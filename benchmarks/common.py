@@ -0,0 +1,57 @@
+"""
+    shared setup of the benchmark scripts: a django process on a scratch sqlite database
+"""
+import os
+import sys
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+
+def setup_django(dbPath: str, env: dict = None):
+    """
+        env: environment variables read by backend/settings.py, set before django starts
+    """
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+    os.environ.update(env or {})
+
+    import django
+    from django.conf import settings
+    django.setup()
+    settings.DATABASES['default']['NAME'] = dbPath
+    settings.ALLOWED_HOSTS = ['*']
+    settings.DEBUG = False
+
+
+def seed(restaurants: int, visits: int) -> (str, str):
+    """
+        create one account with one pocket of restaurants and visit records
+
+        return
+        1. user token
+        2. pocket uid
+    """
+    from datetime import date, timedelta
+    from django.core.management import call_command
+    from restaurant.models import Account, Restaurant, VisitRecord
+
+    call_command('migrate', run_syncdb=True, verbosity=0)
+
+    user = Account(username='bench', email='bench@test.com')
+    user.save()
+    user.initAccount()
+    token = user.createToken()
+    pocket = user.pocket_set.first()
+
+    Restaurant.objects.bulk_create([
+        Restaurant(owner=user, pocket=pocket, name='restaurant %d' % i)
+        for i in range(restaurants)
+    ])
+    ids = list(pocket.getRestaurants().values_list('id', flat=True))
+    VisitRecord.objects.bulk_create([
+        VisitRecord(restaurant_id=ids[i % len(ids)], owner=user,
+                    visit_date=date.today() - timedelta(days=i % 365))
+        for i in range(visits)
+    ])
+    Restaurant.updateLastVisits(ids)
+    return token, str(pocket.uid)
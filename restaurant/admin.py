@@ -1,5 +1,6 @@
 from django.contrib import admin
-from .models import Account, Restaurant, VisitRecord, TokenSystem, Pocket
+from .models import Account, AccountShard, Restaurant, VisitRecord, TokenSystem, Pocket, Job, \
+    ArchivedRow
 
 
 # Register your models here.
@@ -8,6 +9,11 @@ class AccountAdmin(admin.ModelAdmin):
     ordering = ['username']
 
 
+class AccountShardAdmin(admin.ModelAdmin):
+    list_display = ['account_uid', 'shard']
+    list_filter = ['shard']
+
+
 class TokenSystemAdmin(admin.ModelAdmin):
     list_display = ['owner', 'expire_time', 'create_time', 'token']
     ordering = ['-create_time', '-expire_time']
@@ -25,8 +31,22 @@ class VisitRecordAdmin(admin.ModelAdmin):
     list_display = ['restaurant', 'owner', 'visit_date', 'status']
 
 
+class ArchivedRowAdmin(admin.ModelAdmin):
+    list_display = ['model', 'uid', 'delete_time', 'archive_time']
+    list_filter = ['model']
+
+
+class JobAdmin(admin.ModelAdmin):
+    list_display = ['kind', 'owner', 'status', 'progress', 'total', 'attempts', 'create_time']
+    list_filter = ['kind', 'status']
+    ordering = ['-create_time']
+
+
 admin.site.register(Account, AccountAdmin)
+admin.site.register(AccountShard, AccountShardAdmin)
 admin.site.register(TokenSystem, TokenSystemAdmin)
 admin.site.register(Pocket, PocketAdmin)
 admin.site.register(Restaurant, RestaurantAdmin)
 admin.site.register(VisitRecord, VisitRecordAdmin)
+admin.site.register(Job, JobAdmin)
+admin.site.register(ArchivedRow, ArchivedRowAdmin)
@@ -0,0 +1,114 @@
+"""
+    visit statistics of a pocket for getVisitStats, each part is one grouped
+    aggregate in the database instead of clients downloading getVisitRecords
+
+    restaurants and months read the monthly VisitSummary, weekdays and the
+    heatmap need the day of each visit and group the visit records
+"""
+from datetime import timedelta
+from django.db.models import Count, Sum
+from django.db.models.functions import Coalesce, ExtractIsoWeekDay
+from .models import Restaurant, VisitRecord, VisitSummary
+
+# default heatmap range, ending today
+HEATMAP_DAYS = 365
+
+
+def _average(score_sum, visit_count):
+    return round(score_sum / visit_count, 2) if visit_count else None
+
+
+def _visits(pocket):
+    return VisitRecord.objects \
+        .filter(restaurant__pocket=pocket, status=VisitRecord.Status.ACTIVE) \
+        .exclude(restaurant__status=Restaurant.Status.DELETED)
+
+
+def restaurant_stats(pocket) -> list:
+    """
+        visit count and average score of every restaurant, most visited first
+    """
+    restaurants = pocket.getRestaurants() \
+        .annotate(visit_count=Coalesce(Sum('visitsummary__visit_count'), 0),
+                  score_sum=Coalesce(Sum('visitsummary__score_sum'), 0)) \
+        .order_by('-visit_count', 'name') \
+        .values_list('uid', 'name', 'visit_count', 'score_sum')
+    return [
+        {
+            'restaurant_uid': uid,
+            'restaurant_name': name,
+            'visit_count': visit_count,
+            'average_score': _average(score_sum, visit_count),
+        } for uid, name, visit_count, score_sum in restaurants
+    ]
+
+
+def month_stats(pocket) -> list:
+    months = VisitSummary.objects \
+        .filter(restaurant__pocket=pocket, visit_count__gt=0) \
+        .exclude(restaurant__status=Restaurant.Status.DELETED) \
+        .values('month') \
+        .annotate(visits=Sum('visit_count'), scores=Sum('score_sum')) \
+        .order_by('month') \
+        .values_list('month', 'visits', 'scores')
+    return [
+        {
+            'month': month.strftime('%Y-%m'),
+            'visit_count': visit_count,
+            'average_score': _average(score_sum, visit_count),
+        } for month, visit_count, score_sum in months
+    ]
+
+
+def weekday_stats(pocket) -> list:
+    """
+        visits per ISO weekday, Monday (1) to Sunday (7)
+    """
+    weekdays = {
+        weekday: (visit_count, score_sum) for weekday, visit_count, score_sum in
+        _visits(pocket)
+        .annotate(weekday=ExtractIsoWeekDay('visit_date'))
+        .values('weekday')
+        .annotate(visits=Count('id'), scores=Sum('score'))
+        .order_by()
+        .values_list('weekday', 'visits', 'scores')
+    }
+    stats = []
+    for weekday in range(1, 8):
+        visit_count, score_sum = weekdays.get(weekday, (0, 0))
+        stats.append({
+            'weekday': weekday,
+            'visit_count': visit_count,
+            'average_score': _average(score_sum, visit_count),
+        })
+    return stats
+
+
+def heatmap(pocket, date_from, date_to) -> dict:
+    """
+        visits per day from date_from to date_to (both included), days without visits are left out
+    """
+    days = _visits(pocket) \
+        .filter(visit_date__range=(date_from, date_to)) \
+        .values('visit_date') \
+        .annotate(visits=Count('id')) \
+        .order_by('visit_date') \
+        .values_list('visit_date', 'visits')
+    return {
+        'date_from': date_from,
+        'date_to': date_to,
+        'days': {day.isoformat(): visit_count for day, visit_count in days},
+    }
+
+
+def default_range(today):
+    return today - timedelta(days=HEATMAP_DAYS - 1), today
+
+
+def visit_stats(pocket, date_from, date_to) -> dict:
+    return {
+        'restaurants': restaurant_stats(pocket),
+        'months': month_stats(pocket),
+        'weekdays': weekday_stats(pocket),
+        'heatmap': heatmap(pocket, date_from, date_to),
+    }
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class RestaurantConfig(AppConfig):
     name = 'restaurant'
+
+    def ready(self):
+        # connect signal receivers, register system checks
+        from . import checks, signals  # noqa: F401
@@ -0,0 +1,99 @@
+"""
+    ASGI handler of backend/asgi.py
+
+    django 3.1 iterates streaming responses (exportPocket) inside the event
+    loop, where their ORM queries raise SynchronousOnlyOperation. This
+    handler consumes them on a thread of their own and passes the parts to
+    the loop through a small queue, a slow client stops the thread instead
+    of buffering the whole export
+
+    send_response is not a documented API of ASGIHandler, it is the only
+    part of it overridden or called here (the start message and chunking
+    are done here), AsyncViewsTestCase.test_export_over_asgi checks it on
+    django upgrades
+"""
+import asyncio
+import contextvars
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIHandler
+from django.db import close_old_connections
+
+# parts produced ahead of the client
+STREAM_QUEUE_SIZE = 16
+
+# largest body message, parts are split like ASGIHandler splits responses
+STREAM_CHUNK_SIZE = 2 ** 16
+
+_END = object()
+
+
+class StreamingASGIHandler(ASGIHandler):
+
+    async def send_response(self, response, send):
+        if not response.streaming:
+            return await super().send_response(response, send)
+
+        loop = asyncio.get_event_loop()
+        queue = asyncio.Queue(STREAM_QUEUE_SIZE)
+        cancelled = False
+
+        def put(item):
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+        def produce():
+            try:
+                # access __iter__ and not streaming_content, like ASGIHandler does
+                for part in response:
+                    if cancelled:
+                        break
+                    put(part)
+                put(_END)
+            except BaseException as e:
+                put(e)
+            finally:
+                # the thread outlives the request, give its connections back
+                close_old_connections()
+
+        await self._send_start(response, send)
+        producer = loop.run_in_executor(None, contextvars.copy_context().run, produce)
+        try:
+            while True:
+                part = await queue.get()
+                if part is _END:
+                    break
+                if isinstance(part, BaseException):
+                    raise part
+                for chunk in self._chunks(part):
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body'})
+        finally:
+            cancelled = True
+            # unblock a producer waiting on a full queue
+            while not producer.done():
+                while not queue.empty():
+                    queue.get_nowait()
+                await asyncio.sleep(0.01)
+        await sync_to_async(response.close, thread_sensitive=True)()
+
+    @staticmethod
+    def _chunks(part):
+        for position in range(0, len(part), STREAM_CHUNK_SIZE):
+            yield part[position:position + STREAM_CHUNK_SIZE]
+
+    @staticmethod
+    async def _send_start(response, send):
+        # headers are encoded like ASGIHandler.send_response does
+        headers = []
+        for header, value in response.items():
+            if isinstance(header, str):
+                header = header.encode('ascii')
+            if isinstance(value, str):
+                value = value.encode('latin1')
+            headers.append((bytes(header), bytes(value)))
+        for c in response.cookies.values():
+            headers.append((b'Set-Cookie', c.output(header='').encode('ascii').strip()))
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': headers,
+        })
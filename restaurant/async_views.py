@@ -0,0 +1,223 @@
+"""
+    async variants of the read endpoints in views.py, served instead of the
+    sync ones when settings.ASYNC_VIEWS is on (see backend/asgi.py)
+
+    parameters, errors and response data come from reads.py like those of
+    the sync views, ORM calls are blocking, so they run on a bounded thread
+    pool and independent queries (token lookup and pocket fetch) run
+    concurrently
+"""
+import asyncio
+import contextvars
+from contextlib import ExitStack
+from datetime import date
+from uuid import UUID
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import close_old_connections
+from . import reads, response_cache
+from .dbhooks import orm_hooks
+from .routers import db_policy
+
+
+_executor = None
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.ASYNC_ORM_WORKERS,
+            thread_name_prefix='orm',
+        )
+    return _executor
+
+
+def _call(func, *args):
+    try:
+        with ExitStack() as stack:
+            for hook in orm_hooks.get():
+                stack.enter_context(hook())
+            return func(*args)
+    finally:
+        # pool threads outlive requests, give their connections back like request_finished does
+        close_old_connections()
+
+
+async def run_orm(func, *args):
+    """
+        run a blocking function (ORM calls) on the bounded ORM thread pool
+    """
+    loop = asyncio.get_event_loop()
+    # copy the context so the database router sees the routing state of the request
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(get_executor(), context.run, _call, func, *args)
+
+
+async def _authorize_pocket(user_token: str, pocket_uid: UUID):
+    """
+        reads.authorize_pocket, looking up the token and the pocket at the same time
+
+        return
+        1. pocket
+        2. error response or None
+    """
+    ownerId, pocket = await asyncio.gather(
+        run_orm(reads.token_owner_id, user_token),
+        run_orm(reads.live_pocket, pocket_uid),
+    )
+    error = reads.pocket_error(ownerId, pocket)
+    return (None, error) if error is not None else (pocket, None)
+
+
+@db_policy('replica')
+async def getRecommendList(request):
+    """
+        [GET] Get recommend list, the same all day long unless the pocket changes
+        must: user_token, pocket_uid
+        optional: fields (comma separated fields of each restaurant)
+    """
+    # collect parameters
+    try:
+        user_token, pocket_uid, fields = reads.recommend_list_params(request)
+    except reads.InvalidRequest as e:
+        return e.response()
+
+    # query
+    pocket, error = await _authorize_pocket(user_token, pocket_uid)
+    if error is not None:
+        return error
+
+    # the RANDOM decisions change with the day (see PocketSnapshot.seedFor)
+    today = date.today()
+    cached, _ = await asyncio.gather(
+        run_orm(response_cache.respond, request, pocket.owner_id, pocket.uid,
+                'getRecommendList:' + today.isoformat(), lambda: reads.recommend_list(pocket, fields, today)),
+        run_orm(reads.touch_pockets, [pocket]),
+    )
+    return cached
+
+
+@db_policy('replica')
+async def getRecommendLists(request):
+    """
+        [GET] Get recommend lists of all pockets of a user (in created order), or of some of them
+        must: user_token
+        optional: pocket_uids (comma separated), fields (comma separated fields of each restaurant)
+    """
+    # collect parameters
+    try:
+        user_token, pocket_uids, fields = reads.recommend_lists_params(request)
+    except reads.InvalidRequest as e:
+        return e.response()
+
+    # query
+    ownerId = await run_orm(reads.token_owner_id, user_token)
+    if ownerId is None:
+        return reads.unauthorized()
+
+    pockets, error = await run_orm(reads.owner_pockets, ownerId, pocket_uids)
+    if error is not None:
+        return error
+
+    today = date.today()
+    cached, _ = await asyncio.gather(
+        run_orm(response_cache.respond, request, ownerId, None,
+                'getRecommendLists:' + today.isoformat(), lambda: reads.recommend_lists(pockets, fields, today)),
+        run_orm(reads.touch_pockets, pockets),
+    )
+    return cached
+
+
+@db_policy('replica')
+async def getRestaurantList(request):
+    """
+        [GET] Get all restaurants (in last visited + last updated order) and visit records visited by a user
+        must: user_token, pocket_uid
+        optional: format ("json" or "compact" column arrays, see compact.py)
+        optional: fields (comma separated fields of each restaurant,
+            visit records are not read unless visit_dates or last_update is asked)
+    """
+    # collect parameters
+    try:
+        user_token, pocket_uid, fields, fmt = reads.restaurant_list_params(request)
+    except reads.InvalidRequest as e:
+        return e.response()
+
+    # query
+    pocket, error = await _authorize_pocket(user_token, pocket_uid)
+    if error is not None:
+        return error
+
+    cached, _ = await asyncio.gather(
+        run_orm(response_cache.respond, request, pocket.owner_id, pocket.uid, 'getRestaurantList',
+                lambda: reads.restaurant_list(pocket, fields, fmt)),
+        run_orm(reads.touch_pockets, [pocket]),
+    )
+    return cached
+
+
+@db_policy('replica')
+async def getVisitRecords(request):
+    """
+        [GET] Get all visit records visited by a user
+        must: user_token, pocket_uid
+        optional: format ("json" or "compact" column arrays, see compact.py)
+    """
+    # collect parameters
+    try:
+        user_token, pocket_uid, fmt = reads.visit_records_params(request)
+    except reads.InvalidRequest as e:
+        return e.response()
+
+    # query
+    pocket, error = await _authorize_pocket(user_token, pocket_uid)
+    if error is not None:
+        return error
+
+    return await run_orm(response_cache.respond, request, pocket.owner_id, pocket.uid, 'getVisitRecords',
+                         lambda: reads.visit_records(pocket, fmt))
+
+
+@db_policy('replica')
+async def getVisitStats(request):
+    """
+        [GET] Visit statistics of a pocket: visit count and average score per restaurant,
+        per month and per weekday (ISO, Monday is 1), and visits per day for a heatmap
+        must: user_token, pocket_uid
+        optional: date_from, date_to (YYYY-MM-DD, range of the heatmap, the last 365 days by default)
+    """
+    # collect parameters
+    try:
+        user_token, pocket_uid, date_from, date_to = reads.visit_stats_params(request)
+    except reads.InvalidRequest as e:
+        return e.response()
+
+    # query
+    pocket, error = await _authorize_pocket(user_token, pocket_uid)
+    if error is not None:
+        return error
+
+    return await run_orm(response_cache.respond, request, pocket.owner_id, pocket.uid, 'getVisitStats',
+                         lambda: reads.visit_stats(pocket, date_from, date_to))
+
+
+@db_policy('replica')
+async def getPocketList(request):
+    """
+        [GET] Get all Pockets owned by a user
+        must: user_token
+    """
+    # collect parameters
+    try:
+        user_token, = reads.pocket_list_params(request)
+    except reads.InvalidRequest as e:
+        return e.response()
+
+    # query
+    ownerId = await run_orm(reads.token_owner_id, user_token)
+    if ownerId is None:
+        return reads.unauthorized()
+
+    return await run_orm(response_cache.respond, request, ownerId, None, 'getPocketList',
+                         lambda: reads.pocket_list(ownerId))
@@ -0,0 +1,48 @@
+"""
+    system checks of the deployment settings (registered in apps.py), run by
+    manage.py commands and the test runner, deploy=True ones by check --deploy
+"""
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.checks import Error, Warning, register
+
+
+def _per_process(alias: str) -> bool:
+    # each process has its own LocMemCache, a delete in one is not seen by the others
+    return isinstance(caches[alias], LocMemCache)
+
+
+@register()
+def check_shard_cache(app_configs, **kwargs):
+    """
+        account and token to shard lookups are cached in the default cache,
+        manage.py rebalance moves an account in its own process, so its
+        cache deletes must reach the web workers
+    """
+    if settings.DATABASE_SHARDS and _per_process('default'):
+        return [Error(
+            'DATABASE_SHARDS needs a shared default cache',
+            hint='Web workers would keep routing a rebalanced account to the shard it left '
+                 'for sharding.LOOKUP_CACHE_SECONDS, use memcached, redis or the database cache.',
+            id='restaurant.E001',
+        )]
+    return []
+
+
+@register(deploy=True)
+def check_response_cache(app_configs, **kwargs):
+    """
+        writes bump the version of the account in the responses cache, those
+        made by other processes (gunicorn workers, runjobs, management
+        commands) are only seen through a shared cache.
+        Run by manage.py check --deploy, one process is fine in development
+    """
+    if settings.RESPONSE_CACHE_SECONDS and _per_process(settings.RESPONSE_CACHE_ALIAS):
+        return [Warning(
+            'RESPONSE_CACHE_ALIAS is a per-process cache',
+            hint='Writes of other processes reach it only when RESPONSE_CACHE_SECONDS runs out, '
+                 'use memcached, redis or the database cache, or set RESPONSE_CACHE_SECONDS = 0.',
+            id='restaurant.W001',
+        )]
+    return []
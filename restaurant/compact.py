@@ -0,0 +1,86 @@
+"""
+    format=compact for the visit heavy list endpoints
+
+    instead of one dict per row, data holds one array per column,
+    dates are day offsets from EPOCH, times are milliseconds since EPOCH
+    and visit records refer to their restaurant by index into a
+    restaurants dictionary
+
+    getRestaurantList
+        {"format": "compact", "epoch": "1970-01-01", "restaurant_uid": [...],
+         "restaurant_name": [...], "visit_count": [...], ...,
+         "visit_dates": [...]}  # visit_dates of all restaurants back to back,
+                                # visit_count[i] of them belong to restaurant i
+    getVisitRecords
+        {"format": "compact", "epoch": "1970-01-01",
+         "restaurants": {"restaurant_uid": [...], "restaurant_name": [...]},
+         "visitrecord_uid": [...], "restaurant": [...], "visit_date": [...], "create_time": [...]}
+"""
+from datetime import date, datetime
+
+FORMATS = ('json', 'compact')
+
+EPOCH = date(1970, 1, 1)
+
+RESTAURANT_COLUMNS = ('restaurant_uid', 'restaurant_name', 'visit_count', 'visit_dates',
+                      'last_update', 'status', 'hide_until', 'note')
+
+
+def day_offset(day: date) -> int:
+    return (day - EPOCH).days
+
+
+def time_offset(moment: datetime) -> int:
+    return int(moment.timestamp() * 1000)
+
+
+def restaurant_list(restaurants: list, fields: tuple = None) -> dict:
+    """
+        columns of PocketSnapshot.getRestaurantList(), limited to fields
+        visit_count comes along with visit_dates to split them per restaurant
+    """
+    fields = fields or RESTAURANT_COLUMNS
+    data = {'format': 'compact', 'epoch': EPOCH}
+    for column in fields:
+        data[column] = [rest[column] for rest in restaurants]
+
+    if 'hide_until' in data:
+        data['hide_until'] = [day_offset(day) for day in data['hide_until']]
+    if 'last_update' in data:
+        data['last_update'] = [time_offset(moment) for moment in data['last_update']]
+    if 'visit_dates' in data:
+        data['visit_count'] = [len(rest['visit_dates']) for rest in restaurants]
+        data['visit_dates'] = [day_offset(day) for rest in restaurants for day in rest['visit_dates']]
+    return data
+
+
+def visit_records(records) -> dict:
+    """
+        columns of visit records (with select_related restaurant),
+        each restaurant is sent once in the restaurants dictionary
+    """
+    index = {}
+    restaurants = {'restaurant_uid': [], 'restaurant_name': []}
+    data = {
+        'format': 'compact',
+        'epoch': EPOCH,
+        'restaurants': restaurants,
+        'visitrecord_uid': [],
+        'restaurant': [],
+        'visit_date': [],
+        'create_time': [],
+    }
+
+    for record in records:
+        position = index.get(record.restaurant_id)
+        if position is None:
+            position = index[record.restaurant_id] = len(index)
+            restaurants['restaurant_uid'].append(record.restaurant.uid)
+            restaurants['restaurant_name'].append(record.restaurant.name)
+
+        data['visitrecord_uid'].append(record.uid)
+        data['restaurant'].append(position)
+        data['visit_date'].append(day_offset(record.visit_date))
+        data['create_time'].append(time_offset(record.create_time))
+
+    return data
@@ -0,0 +1,75 @@
+"""
+    gzip / brotli encoding of API responses, used by middleware.CompressionMiddleware
+
+    brotli is optional (pip install brotli), without it only gzip is offered
+"""
+import gzip
+import zlib
+from django.conf import settings
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# preferred first when the client accepts several with the same quality
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def negotiate(accept_encoding: str):
+    """
+        pick an encoding from an Accept-Encoding header, None when no supported one is accepted
+    """
+    accepted = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.strip().partition(';')
+        quality = 1.0
+        if params.strip().startswith('q='):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                continue
+        accepted[name.strip().lower()] = quality
+
+    best, bestQuality = None, 0.0
+    for encoding in ENCODINGS:
+        quality = accepted.get(encoding, accepted.get('*', 0.0))
+        if quality > bestQuality:
+            best, bestQuality = encoding, quality
+    return best
+
+
+def level_for(endpoint: str, encoding: str) -> int:
+    """
+        compression level of an endpoint (url name) from settings.COMPRESSION_LEVELS
+    """
+    levels = settings.COMPRESSION_LEVELS
+    return levels.get(endpoint, levels['default'])[encoding]
+
+
+def compress(content: bytes, encoding: str, level: int) -> bytes:
+    if encoding == 'br':
+        return brotli.compress(content, quality=level)
+    # mtime=0 keeps the output (and so weak etags) stable
+    return gzip.compress(content, compresslevel=level, mtime=0)
+
+
+def compress_stream(chunks, encoding: str, level: int):
+    """
+        compress an iterable of byte chunks, flushing after every chunk
+        so a slow stream still reaches the client piece by piece
+    """
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=level)
+        for chunk in chunks:
+            yield compressor.process(chunk) + compressor.flush()
+        yield compressor.finish()
+        return
+
+    # wbits 16 + MAX_WBITS writes a gzip container
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
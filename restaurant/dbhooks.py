@@ -0,0 +1,45 @@
+"""
+    per-request hooks on the database work of a request, whichever thread
+    runs it: the request thread (WSGI), the thread django runs sync views on
+    under ASGI, or the ORM threads of async views (async_views.run_orm).
+    Each of them runs in a copy of the context of the request
+
+    query_wrappers: connection.execute_wrapper style functions called for
+        every query, through one wrapper installed on each connection, so
+        the middleware never adds or removes wrappers of a connection shared
+        by the requests of an event loop thread
+    orm_hooks: context managers run_orm enters around each call on its thread
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import partial
+
+query_wrappers = ContextVar('query_wrappers', default=())
+orm_hooks = ContextVar('orm_hooks', default=())
+
+
+def _execute(execute, sql, params, many, context):
+    for wrapper in reversed(query_wrappers.get()):
+        execute = partial(wrapper, execute)
+    return execute(sql, params, many, context)
+
+
+def install(connection):
+    """
+        called for every new connection (see signals.py)
+    """
+    if _execute not in connection.execute_wrappers:
+        # first, connection.execute_wrapper blocks remove the last wrapper when they end
+        connection.execute_wrappers.insert(0, _execute)
+
+
+@contextmanager
+def adding(var: ContextVar, value):
+    """
+        append value to the tuple in var while the block runs
+    """
+    token = var.set(var.get() + (value,))
+    try:
+        yield
+    finally:
+        var.reset(token)
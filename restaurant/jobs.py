@@ -0,0 +1,265 @@
+"""
+    database backed job queue for heavy mutations, no broker needed
+
+    views enqueue a Job and answer 202 with its uid, the runjobs management
+    command claims queued jobs and runs them on a bounded number of threads,
+    clients poll getJob for status and progress (see Job.report)
+
+    a claim renews a lease (settings.JOB_LEASE_SECONDS) which every progress
+    report extends, a running job whose lease expired lost its worker and is
+    claimed again, up to settings.JOB_MAX_ATTEMPTS times
+
+    a claim is fenced by its worker and attempt (Job.held): a worker whose job
+    was claimed again gets Job.LeaseLost from its next report and stops, its
+    outcome is never stored over the one of the worker running the job now
+
+    copies and imports commit chunk by chunk, each chunk with a JobCheckpoint
+    on the shard it is written to (Job.checkpoint), so the progress is visible
+    while they run, sqlite is not locked for a whole job and a retried job
+    resumes right after the last committed chunk, whichever the shard
+"""
+import csv
+import json
+import logging
+import os
+import socket
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from django.conf import settings
+from django.db import OperationalError, connections
+from django.db.models import F, Q
+from django.utils import timezone
+from .models import Job, JobCheckpoint, Pocket, Restaurant
+from .sharding import shard_of, using_shard
+from .transfer import import_visit_records, validate, TransferError
+
+logger = logging.getLogger(__name__)
+
+# kind -> callable(job, **params) returning a json serializable result
+HANDLERS = {}
+
+
+class JobError(Exception):
+    """
+        raised by a handler to fail its job with a message for the client
+    """
+
+
+def handler(kind: str):
+    def decorator(func):
+        HANDLERS[kind] = func
+        return func
+    return decorator
+
+
+def enqueue(kind: str, owner, **params) -> Job:
+    assert kind in HANDLERS, 'Unknown job kind: ' + kind
+    return Job.objects.create(kind=kind, owner=owner, params=json.dumps(params))
+
+
+def worker_name() -> str:
+    return '%s:%d:%s' % (socket.gethostname(), os.getpid(), threading.current_thread().name)
+
+
+def _claimable(now):
+    return Q(status=Job.Status.QUEUED) | \
+        Q(status=Job.Status.RUNNING, lease_until__lt=now, attempts__lt=settings.JOB_MAX_ATTEMPTS)
+
+
+def claim(worker: str):
+    """
+        take the oldest claimable job, None when there is none
+        the conditional update lets only one of several workers win a job
+    """
+    now = timezone.now()
+
+    # lost too many times, most likely it takes the worker down with it
+    Job.objects.filter(status=Job.Status.RUNNING, lease_until__lt=now,
+                       attempts__gte=settings.JOB_MAX_ATTEMPTS) \
+        .update(status=Job.Status.FAILED, error='Worker lost', finish_time=now)
+
+    for jobId in Job.objects.filter(_claimable(now)).order_by('id').values_list('id', flat=True)[:10]:
+        claimed = Job.objects.filter(_claimable(now), id=jobId).update(
+            status=Job.Status.RUNNING,
+            worker=worker,
+            attempts=F('attempts') + 1,
+            lease_until=now + timedelta(seconds=settings.JOB_LEASE_SECONDS),
+            start_time=now,
+        )
+        if claimed:
+            return Job.objects.get(id=jobId)
+    return None
+
+
+def run(job: Job):
+    """
+        run a claimed job on the shard of its owner and store the outcome
+    """
+    params = json.loads(job.params)
+    shard = shard_of(job.owner)
+    try:
+        with using_shard(shard):
+            result = HANDLERS[job.kind](job, **params)
+    except Job.LeaseLost:
+        # another worker runs the job now, the chunk in progress was rolled back
+        logger.warning('Job %s was taken over, stopped on %s', job, job.worker)
+        return
+    except JobError as e:
+        job.status = Job.Status.FAILED
+        job.error = str(e)[:1000]
+    except Exception as e:
+        logger.exception('Job %s failed', job)
+        job.status = Job.Status.FAILED
+        job.error = 'Internal error; ' + type(e).__name__
+    else:
+        job.status = Job.Status.DONE
+        job.result = json.dumps(result, default=str)
+    job.finish_time = timezone.now()
+    finished = job.held().update(status=job.status, result=job.result, error=job.error,
+                                 progress=job.progress, total=job.total, finish_time=job.finish_time)
+    if not finished:
+        logger.warning('Job %s was taken over, dropped the outcome of %s', job, job.worker)
+        return
+    with using_shard(shard):
+        JobCheckpoint.objects.filter(job_uid=job.uid).delete()
+
+
+def run_pending(worker: str = None) -> int:
+    """
+        run claimable jobs one by one in this thread until there are none left
+        return number of jobs run
+    """
+    count = 0
+    while True:
+        job = claim(worker or worker_name())
+        if job is None:
+            return count
+        run(job)
+        count += 1
+
+
+def work(concurrency: int, poll: float, once: bool = False, stop: threading.Event = None) -> int:
+    """
+        claim and run jobs on at most `concurrency` threads, polling the queue
+        every `poll` seconds while it is empty, until `stop` is set
+        (or the queue is drained when `once`)
+        return number of jobs run
+    """
+    stop = stop or threading.Event()
+    slots = threading.Semaphore(concurrency)
+    count = 0
+
+    def runOne(job):
+        try:
+            run(job)
+        finally:
+            # connections are per thread, do not leave them to the pool
+            connections.close_all()
+            slots.release()
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='job') as pool:
+        while not stop.is_set():
+            slots.acquire()
+            try:
+                job = claim(worker_name())
+            except OperationalError as e:
+                # e.g. sqlite locked by a writer for longer than its busy timeout
+                logger.warning('Claiming a job failed, retrying: %s', e)
+                slots.release()
+                stop.wait(poll)
+                continue
+            if job is None:
+                slots.release()
+                if once:
+                    break
+                stop.wait(poll)
+                continue
+            pool.submit(runOne, job)
+            count += 1
+
+    # leaving the pool waited for the running jobs
+    return count
+
+
+@handler('removePocket')
+def remove_pocket(job: Job, pocket_uid: str):
+    try:
+        pocket = Pocket.objects.get(uid=pocket_uid, owner=job.owner)
+    except Pocket.DoesNotExist:
+        raise JobError('Pocket not found')
+
+    # marked deleted by the view already, unless its commit failed after the job was enqueued
+    if pocket.status != Pocket.Status.DELETED:
+        pocket.remove(cascade=False)
+
+    pocket.removeRestaurants(progress=job.report)
+    return {'pocket_uid': pocket_uid}
+
+
+@handler('copyRestaurants')
+def copy_restaurants(job: Job, pocket_uid: str, copy_from: str = None,
+                     copy_restaurants: list = None, deep: bool = False):
+    try:
+        pocket = Pocket.objects.exclude(status=Pocket.Status.DELETED) \
+            .get(uid=pocket_uid, owner=job.owner)
+    except Pocket.DoesNotExist:
+        raise JobError('Pocket not found')
+
+    sources = Restaurant.objects.filter(owner=job.owner, pocket__owner=job.owner) \
+        .exclude(pocket__status=Pocket.Status.DELETED)
+    if copy_from is not None:
+        sources = sources.filter(pocket__uid=copy_from)
+    if copy_restaurants is not None:
+        sources = sources.filter(uid__in=copy_restaurants)
+
+    # the chunks of an earlier attempt are committed already
+    copied = pocket.copyRestaurants(sources, deep=deep, progress=job.checkpoint,
+                                    atomic=False, skip=job.resumeFrom())
+    return {'pocket_uid': pocket_uid, 'size': copied}
+
+
+@handler('importVisitRecords')
+def import_visits(job: Job, pocket_uid: str, path: str, format: str = 'csv'):
+    taken = False
+    try:
+        try:
+            pocket = Pocket.objects.exclude(status=Pocket.Status.DELETED) \
+                .get(uid=pocket_uid, owner=job.owner)
+        except Pocket.DoesNotExist:
+            raise JobError('Pocket not found')
+
+        with open(path, newline='', encoding='utf-8-sig') as f:
+            # batches are committed one by one, a bad row has to fail the job before the first,
+            # the lease is renewed while a long file is read
+            skip = job.resumeFrom()
+            total = validate(f, format, progress=lambda rows: job.report(skip))
+            f.seek(0)
+            # the rows of an earlier attempt are imported already
+            job.report(skip, total)
+            return import_visit_records(pocket, f, format, progress=job.checkpoint,
+                                        atomic=False, skip=skip)
+    except Job.LeaseLost:
+        # the worker which took the job over reads the file too
+        taken = True
+        raise
+    except (TransferError, UnicodeDecodeError, csv.Error) as e:
+        raise JobError(str(e))
+    except FileNotFoundError:
+        raise JobError('Uploaded file is gone')
+    finally:
+        if not taken and os.path.exists(path):
+            os.remove(path)
+
+
+def save_upload(upload) -> str:
+    """
+        keep an uploaded file under settings.JOB_FILES_DIR until its job ran
+    """
+    os.makedirs(settings.JOB_FILES_DIR, exist_ok=True)
+    path = os.path.join(settings.JOB_FILES_DIR, 'upload-' + uuid.uuid4().hex)
+    with open(path, 'wb') as f:
+        for chunk in upload.chunks():
+            f.write(chunk)
+    return path
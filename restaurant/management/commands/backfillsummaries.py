@@ -0,0 +1,29 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+from restaurant.models import Restaurant, VisitSummary
+from restaurant.sharding import using_shard
+
+
+class Command(BaseCommand):
+    help = 'Build the monthly visit summaries of every restaurant from its visit records'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='restaurants rebuilt per transaction')
+
+    def handle(self, *args, **options):
+        for db in settings.DATABASE_SHARDS or [DEFAULT_DB_ALIAS]:
+            with using_shard(db):
+                restaurants = Restaurant.objects.using(db).order_by('id').values_list('id', flat=True)
+                count = 0
+                lastId = 0
+                while True:
+                    chunk = list(restaurants.filter(id__gt=lastId)[:options['batch_size']])
+                    if not chunk:
+                        break
+                    lastId = chunk[-1]
+                    VisitSummary.rebuild(chunk, using=db, batch_size=options['batch_size'])
+                    count += len(chunk)
+
+                self.stdout.write('Rebuilt visit summaries of %d restaurants on %s' % (count, db))
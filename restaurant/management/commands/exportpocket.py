@@ -0,0 +1,40 @@
+from uuid import UUID
+from django.core.management.base import BaseCommand, CommandError
+from restaurant.models import Pocket
+from restaurant.sharding import locate_shard, using_shard
+from restaurant.transfer import export_pocket, SUPPORTED_FORMATS, \
+    DEFAULT_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = 'Export restaurants and visit records of a pocket as csv or ndjson'
+
+    def add_arguments(self, parser):
+        parser.add_argument('pocket_uid', type=UUID)
+        parser.add_argument('--output', default='-',
+                            help='file to write, "-" writes stdout')
+        parser.add_argument('--format', choices=SUPPORTED_FORMATS,
+                            default='csv')
+        parser.add_argument('--chunk-size', type=int,
+                            default=DEFAULT_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        # the pocket and everything it holds live on the shard of its owner
+        with using_shard(locate_shard(Pocket, uid=options['pocket_uid'])):
+            self._handle(options)
+
+    def _handle(self, options):
+        try:
+            pocket = Pocket.objects.exclude(status=Pocket.Status.DELETED) \
+                .get(uid=options['pocket_uid'])
+        except Pocket.DoesNotExist:
+            raise CommandError('Pocket not found')
+
+        lines = export_pocket(pocket, options['format'], options['chunk_size'])
+
+        if options['output'] == '-':
+            for line in lines:
+                self.stdout.write(line, ending='')
+        else:
+            with open(options['output'], 'w', newline='', encoding='utf-8') as f:
+                f.writelines(lines)
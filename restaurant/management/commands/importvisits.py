@@ -0,0 +1,50 @@
+import csv
+import sys
+from uuid import UUID
+from django.core.management.base import BaseCommand, CommandError
+from restaurant.models import Pocket
+from restaurant.sharding import locate_shard, using_shard
+from restaurant.transfer import import_visit_records, TransferError, \
+    SUPPORTED_FORMATS, DEFAULT_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = 'Import visit records from a csv or ndjson file into a pocket'
+
+    def add_arguments(self, parser):
+        parser.add_argument('pocket_uid', type=UUID)
+        parser.add_argument('path', help='file to import, "-" reads stdin')
+        parser.add_argument('--format', choices=SUPPORTED_FORMATS,
+                            default='csv')
+        parser.add_argument('--batch-size', type=int,
+                            default=DEFAULT_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        # the pocket and everything it holds live on the shard of its owner
+        with using_shard(locate_shard(Pocket, uid=options['pocket_uid'])):
+            self._handle(options)
+
+    def _handle(self, options):
+        try:
+            pocket = Pocket.objects.exclude(status=Pocket.Status.DELETED) \
+                .get(uid=options['pocket_uid'])
+        except Pocket.DoesNotExist:
+            raise CommandError('Pocket not found')
+
+        if options['path'] == '-':
+            stats = self._import(pocket, sys.stdin, options)
+        else:
+            with open(options['path'], newline='', encoding='utf-8-sig') as f:
+                stats = self._import(pocket, f, options)
+
+        self.stdout.write(
+            'Imported %(visits_created)d visit records, '
+            'created %(restaurants_created)d restaurants' % stats
+        )
+
+    def _import(self, pocket, lines, options) -> dict:
+        try:
+            return import_visit_records(
+                pocket, lines, options['format'], options['batch_size'])
+        except (TransferError, csv.Error) as e:
+            raise CommandError(str(e))
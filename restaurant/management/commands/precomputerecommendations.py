@@ -0,0 +1,32 @@
+from datetime import date
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+from restaurant.models import DailyRecommendation, Pocket
+from restaurant.sharding import using_shard
+
+
+class Command(BaseCommand):
+    help = 'Precompute the recommend list of every active pocket for today, run once a day after ' \
+           'midnight once unhiderestaurants is done'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200,
+                            help='pockets computed together')
+
+    def handle(self, *args, **options):
+        today = date.today()
+        for db in settings.DATABASE_SHARDS or [DEFAULT_DB_ALIAS]:
+            with using_shard(db):
+                pockets = Pocket.objects.using(db).exclude(status=Pocket.Status.DELETED).order_by('id')
+                count = 0
+                lastId = 0
+                while True:
+                    chunk = list(pockets.filter(id__gt=lastId)[:options['batch_size']])
+                    if not chunk:
+                        break
+                    lastId = chunk[-1].id
+                    DailyRecommendation.build(chunk, today, using=db)
+                    count += len(chunk)
+
+                self.stdout.write('Precomputed recommend lists of %d pockets on %s' % (count, db))
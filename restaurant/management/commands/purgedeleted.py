@@ -0,0 +1,35 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from restaurant.retention import purge, DEFAULT_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = 'Delete (or archive) pockets, restaurants and visit records removed more than --days ago'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.PURGE_RETENTION_DAYS,
+                            help='keep removed rows this many days')
+        parser.add_argument('--batch-size', type=int,
+                            default=DEFAULT_BATCH_SIZE)
+        parser.add_argument('--pause', type=float, default=settings.PURGE_PAUSE_SECONDS,
+                            help='seconds to sleep between batches')
+        parser.add_argument('--archive', action='store_true',
+                            help='move the rows to the archive table instead of only deleting them')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='only report what would be purged')
+
+    def handle(self, *args, **options):
+        if options['days'] < 0 or options['batch_size'] < 1:
+            raise CommandError('--days should not be negative and --batch-size should be at least 1')
+
+        report = purge(options['days'], options['batch_size'], options['pause'],
+                       options['archive'], options['dry_run'])
+
+        verb = 'Would purge' if options['dry_run'] else ('Archived' if options['archive'] else 'Purged')
+        for db, stats in report.items():
+            self.stdout.write(
+                '%s %d visit records, %d restaurants and %d pockets on %s, '
+                '%d removed rows without delete_time %s' % (
+                    verb, stats['restaurant.visitrecord'], stats['restaurant.restaurant'],
+                    stats['restaurant.pocket'], db, stats['unstamped'],
+                    'to stamp' if options['dry_run'] else 'stamped'))
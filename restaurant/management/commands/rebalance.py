@@ -0,0 +1,34 @@
+from uuid import UUID
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from restaurant.models import Account
+from restaurant.sharding import move_account, shard_of, DEFAULT_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = 'Move the pockets, restaurants, visit records and tokens of an account to another shard ' \
+           '(needs a cache shared with the web workers, see restaurant/sharding.py)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('account_uid', type=UUID)
+        parser.add_argument('shard', help='target alias from DATABASE_SHARDS')
+        parser.add_argument('--batch-size', type=int,
+                            default=DEFAULT_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        if options['shard'] not in settings.DATABASE_SHARDS:
+            raise CommandError('Unknown shard, DATABASE_SHARDS is %s' % settings.DATABASE_SHARDS)
+
+        try:
+            account = Account.objects.get(uid=options['account_uid'])
+        except Account.DoesNotExist:
+            raise CommandError('Account not found')
+
+        source = shard_of(account)
+        stats = move_account(account, options['shard'], options['batch_size'])
+
+        self.stdout.write(
+            'Moved %(pockets)d pockets, %(restaurants)d restaurants, '
+            '%(visit_records)d visit records and %(tokens)d tokens' % stats
+            + ' from %s to %s' % (source, options['shard'])
+        )
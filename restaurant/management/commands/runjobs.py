@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from restaurant.jobs import work
+
+
+class Command(BaseCommand):
+    help = 'Run queued background jobs (pocket removal, copies, imports)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int,
+                            default=settings.JOB_CONCURRENCY,
+                            help='jobs running at the same time')
+        parser.add_argument('--poll', type=float, default=1.0,
+                            help='seconds between checks of an empty queue')
+        parser.add_argument('--once', action='store_true',
+                            help='exit once the queue is empty instead of waiting for jobs')
+
+    def handle(self, *args, **options):
+        if options['concurrency'] < 1:
+            raise CommandError('--concurrency should be at least 1')
+
+        try:
+            count = work(options['concurrency'], options['poll'], options['once'])
+        except KeyboardInterrupt:
+            # the pool already waited for the running jobs
+            return
+
+        self.stdout.write('Ran %d jobs' % count)
@@ -0,0 +1,22 @@
+from datetime import date
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+from restaurant.models import Restaurant
+from restaurant.sharding import using_shard
+
+
+class Command(BaseCommand):
+    help = 'Show restaurants whose hide_until passed again, run once a day after midnight ' \
+           'before precomputerecommendations'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='restaurants updated per transaction')
+
+    def handle(self, *args, **options):
+        today = date.today()
+        for db in settings.DATABASE_SHARDS or [DEFAULT_DB_ALIAS]:
+            with using_shard(db):
+                shown, hidden = Restaurant.syncHidden(today, using=db, batch_size=options['batch_size'])
+                self.stdout.write('Showed %d and hid %d restaurants on %s' % (shown, hidden, db))
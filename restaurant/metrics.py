@@ -0,0 +1,182 @@
+"""
+    in-process metrics of the requests, exposed on /metrics in the prometheus
+    text format, filled by middleware.MetricsMiddleware
+
+    with several worker processes (gunicorn) each one writes a snapshot of
+    its registry to settings.METRICS_DIR, at most every
+    settings.METRICS_FLUSH_SECONDS and when it exits, and /metrics adds up
+    the snapshots of all of them. Snapshots of exited workers are kept so
+    the totals never go back, clear METRICS_DIR when deploying.
+    Without METRICS_DIR /metrics shows the process serving it only
+"""
+import atexit
+import json
+import os
+import threading
+import time
+from django.conf import settings
+from . import response_cache
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# name -> (type, help)
+METRICS = {
+    'foodpocket_requests_total': ('counter', 'Requests by view, method and status'),
+    'foodpocket_request_duration_seconds': ('histogram', 'Request latency by view'),
+    'foodpocket_db_queries_total': ('counter', 'Database queries by view'),
+    'foodpocket_token_validations_total': (
+        'counter', 'Requests with a user_token by outcome, rejected ones answered 401'),
+    'foodpocket_response_cache_total': ('counter', 'Response cache lookups and invalidations by result'),
+}
+
+
+def _key(name: str, labels: dict) -> str:
+    return json.dumps([name, sorted(labels.items())])
+
+
+class Registry:
+    """
+        counters and histograms keyed by metric name and labels
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name: str, labels: dict, value: float = 1):
+        key = _key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, labels: dict, value: float, buckets: tuple = LATENCY_BUCKETS):
+        key = _key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                # non cumulative counts per bucket, then +Inf, sum
+                histogram = self.histograms[key] = [0] * (len(buckets) + 1) + [0.0]
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    break
+            else:
+                index = len(buckets)
+            histogram[index] += 1
+            histogram[-1] += value
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: list(values) for key, values in self.histograms.items()}
+        # kept by response_cache itself, per process like this registry
+        for result, value in response_cache.stats().items():
+            if result != 'hit_ratio':
+                counters[_key('foodpocket_response_cache_total', {'result': result})] = value
+        return {'counters': counters, 'histograms': histograms}
+
+
+registry = Registry()
+
+_flush_lock = threading.Lock()
+_last_flush = 0.0
+
+
+def _snapshot_path(pid: int) -> str:
+    return os.path.join(settings.METRICS_DIR, 'metrics-%d.json' % pid)
+
+
+def flush(force: bool = False):
+    """
+        write the snapshot of this process to settings.METRICS_DIR,
+        at most every settings.METRICS_FLUSH_SECONDS unless forced
+    """
+    global _last_flush
+    if not settings.METRICS_DIR:
+        return
+    now = time.monotonic()
+    if not force and now - _last_flush < settings.METRICS_FLUSH_SECONDS:
+        return
+    with _flush_lock:
+        _last_flush = now
+        os.makedirs(settings.METRICS_DIR, exist_ok=True)
+        path = _snapshot_path(os.getpid())
+        with open(path + '.tmp', 'w') as f:
+            json.dump(registry.snapshot(), f)
+        # readers never see a half written snapshot
+        os.replace(path + '.tmp', path)
+
+
+atexit.register(lambda: flush(force=True))
+
+
+def merge(snapshots: list) -> dict:
+    total = {'counters': {}, 'histograms': {}}
+    for snapshot in snapshots:
+        for key, value in snapshot['counters'].items():
+            total['counters'][key] = total['counters'].get(key, 0) + value
+        for key, values in snapshot['histograms'].items():
+            current = total['histograms'].get(key)
+            total['histograms'][key] = values if current is None else \
+                [a + b for a, b in zip(current, values)]
+    return total
+
+
+def collect() -> dict:
+    """
+        snapshot of every worker writing to settings.METRICS_DIR,
+        this process counted from memory
+    """
+    snapshots = [registry.snapshot()]
+    if settings.METRICS_DIR and os.path.isdir(settings.METRICS_DIR):
+        own = os.path.basename(_snapshot_path(os.getpid()))
+        for name in os.listdir(settings.METRICS_DIR):
+            if not name.endswith('.json') or name == own:
+                continue
+            try:
+                with open(os.path.join(settings.METRICS_DIR, name)) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+    return merge(snapshots)
+
+
+def _labels(labels: list, extra: tuple = ()) -> str:
+    pairs = [(name, value) for name, value in labels] + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for name, value in pairs)
+
+
+def _number(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(snapshot: dict) -> str:
+    """
+        prometheus text exposition format (version 0.0.4)
+    """
+    series = {}
+    for key, value in snapshot['counters'].items():
+        name, labels = json.loads(key)
+        series.setdefault(name, []).append((labels, value))
+    for key, values in snapshot['histograms'].items():
+        name, labels = json.loads(key)
+        series.setdefault(name, []).append((labels, values))
+
+    lines = []
+    for name in sorted(series):
+        kind, description = METRICS.get(name, ('untyped', ''))
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for labels, value in sorted(series[name], key=lambda item: item[0]):
+            if kind != 'histogram':
+                lines.append('%s%s %s' % (name, _labels(labels), _number(value)))
+                continue
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), value[:-1]):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (name, _labels(labels, (('le', bound),)), cumulative))
+            lines.append('%s_sum%s %s' % (name, _labels(labels), _number(value[-1])))
+            lines.append('%s_count%s %d' % (name, _labels(labels), cumulative))
+    return '\n'.join(lines) + '\n'
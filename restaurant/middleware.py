@@ -0,0 +1,371 @@
+import asyncio
+import hashlib
+import random
+import time
+from contextlib import contextmanager
+from functools import partial
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import middleware as auth
+from django.contrib.messages import middleware as messages
+from django.contrib.sessions import middleware as sessions
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+from django.middleware import csrf
+from django.utils.cache import patch_vary_headers
+from . import compression, metrics, profiling
+from .async_views import run_orm
+from .dbhooks import adding, orm_hooks, query_wrappers
+from .routers import use_replica
+from .sharding import current_shard, shard_for_token
+
+
+def keep_while_streaming(content, var, value):
+    """
+        streaming content is produced after the middleware returned,
+        set var to value again while it is consumed
+    """
+    previous = var.get()
+    var.set(value)
+    try:
+        yield from content
+    finally:
+        var.set(previous)
+
+
+class HybridMiddleware:
+    """
+        base of the middleware below, they run in the mode of the handler
+        they wrap. Under ASGI a sync-only middleware would send every request
+        through the single thread of sync_to_async(thread_sensitive=True),
+        one request at a time, and the async views would gain nothing
+
+        subclasses implement handle (WSGI) and ahandle (ASGI)
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            # asyncio.iscoroutinefunction(self) is then true, like django's MiddlewareMixin
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.ahandle(request)
+        return self.handle(request)
+
+    def handle(self, request):
+        raise NotImplementedError
+
+    async def ahandle(self, request):
+        raise NotImplementedError
+
+
+class ReplicaRoutingMiddleware(HybridMiddleware):
+    """
+        let views decorated with @db_policy('replica') read from replicas,
+        after a client's own successful mutation its reads stick to the
+        primary for settings.REPLICA_STICKY_SECONDS to read its own writes
+    """
+    SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+    def handle(self, request):
+        use_replica.set(False)
+        return self.finish(request, self.get_response(request))
+
+    async def ahandle(self, request):
+        use_replica.set(False)
+        return self.finish(request, await self.get_response(request))
+
+    def finish(self, request, response):
+        replica = use_replica.get()
+        use_replica.set(False)
+
+        # streaming content is produced after this returns, keep its routing until it ends
+        if replica and response.streaming:
+            response.streaming_content = keep_while_streaming(
+                response.streaming_content, use_replica, True)
+
+        if request.method not in self.SAFE_METHODS and response.status_code < 400:
+            token = request.POST.get('user_token')
+            if token:
+                cache.set(self.pin_key(token), True, settings.REPLICA_STICKY_SECONDS)
+
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if request.method not in self.SAFE_METHODS:
+            return None
+        if getattr(view_func, 'db_policy', 'primary') != 'replica' or \
+                request.method not in view_func.db_policy_methods:
+            return None
+
+        token = request.GET.get('user_token')
+        if token and cache.get(self.pin_key(token)):
+            return None
+
+        use_replica.set(True)
+        return None
+
+    @staticmethod
+    def pin_key(token: str) -> str:
+        return 'replica-pin:' + hashlib.sha1(token.encode()).hexdigest()
+
+
+class ShardRoutingMiddleware(HybridMiddleware):
+    """
+        route queries of a request to the shard holding its user_token,
+        requests without a (known) token stay on the default database
+        until a view picks a shard, e.g. through an account instance
+    """
+
+    @staticmethod
+    def token_of(request):
+        return request.GET.get('user_token') or request.POST.get('user_token')
+
+    def handle(self, request):
+        if not settings.DATABASE_SHARDS:
+            return self.get_response(request)
+
+        token = self.token_of(request)
+        shard = shard_for_token(token) if token else None
+
+        reset = current_shard.set(shard)
+        try:
+            response = self.get_response(request)
+        finally:
+            current_shard.reset(reset)
+        return self.finish(shard, response)
+
+    async def ahandle(self, request):
+        if not settings.DATABASE_SHARDS:
+            return await self.get_response(request)
+
+        token = self.token_of(request)
+        # the lookup may query every shard
+        shard = await run_orm(shard_for_token, token) if token else None
+
+        reset = current_shard.set(shard)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_shard.reset(reset)
+        return self.finish(shard, response)
+
+    @staticmethod
+    def finish(shard, response):
+        if shard is not None and response.streaming:
+            response.streaming_content = keep_while_streaming(
+                response.streaming_content, current_shard, shard)
+        return response
+
+
+def is_api(request) -> bool:
+    """
+        the token authenticated API under settings.API_PREFIX
+    """
+    return request.path_info.startswith(settings.API_PREFIX)
+
+
+class SkipOnApiMixin:
+    """
+        for django's session, csrf, auth and messages middleware, which the
+        API needs none of: its requests go straight to the next middleware
+        (under ASGI without a hop to django's sync thread), every other path
+        (e.g. the admin) runs them as usual
+    """
+
+    def __call__(self, request):
+        if is_api(request):
+            return self.get_response(request)
+        return super().__call__(request)
+
+
+class SessionMiddleware(SkipOnApiMixin, sessions.SessionMiddleware):
+    pass
+
+
+class CsrfViewMiddleware(SkipOnApiMixin, csrf.CsrfViewMiddleware):
+
+    def process_view(self, request, callback, callback_args, callback_kwargs):
+        if is_api(request):
+            return None
+        return super().process_view(request, callback, callback_args, callback_kwargs)
+
+
+class AuthenticationMiddleware(SkipOnApiMixin, auth.AuthenticationMiddleware):
+    pass
+
+
+class MessageMiddleware(SkipOnApiMixin, messages.MessageMiddleware):
+    pass
+
+
+class CompressionMiddleware(HybridMiddleware):
+    """
+        gzip / brotli for API responses (see compression.py), the level is
+        tuned per endpoint (url name) in settings.COMPRESSION_LEVELS,
+        bodies under settings.COMPRESSION_MIN_SIZE are sent as they are
+    """
+
+    def handle(self, request):
+        return self.compress(request, self.get_response(request))
+
+    async def ahandle(self, request):
+        response = await self.get_response(request)
+        # compressing a big body takes a while, off the event loop
+        return await sync_to_async(self.compress, thread_sensitive=False)(request, response)
+
+    def compress(self, request, response):
+        if not is_api(request):
+            return response
+        if response.status_code != 200 or response.has_header('Content-Encoding'):
+            return response
+        if not response.streaming and len(response.content) < settings.COMPRESSION_MIN_SIZE:
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        encoding = compression.negotiate(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None:
+            return response
+
+        match = request.resolver_match
+        level = compression.level_for(match.url_name if match else None, encoding)
+
+        if response.streaming:
+            response.streaming_content = compression.compress_stream(
+                response.streaming_content, encoding, level)
+            del response['Content-Length']
+        else:
+            compressed = compression.compress(response.content, encoding, level)
+            if len(compressed) >= len(response.content):
+                return response
+            response.content = compressed
+            response['Content-Length'] = str(len(compressed))
+
+        # the etag belongs to the uncompressed body, still fine for If-None-Match
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+        response['Content-Encoding'] = encoding
+        return response
+
+
+class ProfilingMiddleware(HybridMiddleware):
+    """
+        opt-in sampling profiler (see profiling.py), profiles a share of the
+        requests (settings.PROFILE_SAMPLE_RATE) and the ones running longer
+        than settings.PROFILE_SLOW_MS, not loaded while neither is set
+    """
+
+    def __init__(self, get_response):
+        if not settings.PROFILE_SAMPLE_RATE and settings.PROFILE_SLOW_MS is None:
+            raise MiddlewareNotUsed
+        super().__init__(get_response)
+        self.slow = settings.PROFILE_SLOW_MS / 1000 if settings.PROFILE_SLOW_MS is not None else None
+        self.sampler = profiling.Sampler(settings.PROFILE_INTERVAL_MS / 1000, self.slow)
+
+    def handle(self, request):
+        profile = self.begin(sampled=True)
+        if profile is None:
+            return self.get_response(request)
+
+        with self.profiled(profile):
+            response = self.get_response(request)
+        return self.finish(request, profile, response)
+
+    async def ahandle(self, request):
+        # the event loop thread serves other requests meanwhile, it is not sampled
+        profile = self.begin(sampled=False)
+        if profile is None:
+            return await self.get_response(request)
+
+        with self.profiled(profile):
+            response = await self.get_response(request)
+        return self.finish(request, profile, response)
+
+    def begin(self, sampled: bool):
+        fromStart = random.random() < settings.PROFILE_SAMPLE_RATE
+        if not fromStart and self.slow is None:
+            return None
+        return self.sampler.begin(fromStart, sampled)
+
+    @contextmanager
+    def profiled(self, profile: profiling.Profile):
+        # queries are timed on every thread working for the request,
+        # the ORM threads of async views are sampled too
+        reset = profiling.current_profile.set(profile)
+        try:
+            with adding(query_wrappers, profile.timeQuery), \
+                    adding(orm_hooks, partial(self.sampler.following, profile)):
+                yield
+        finally:
+            profiling.current_profile.reset(reset)
+            self.sampler.end(profile)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # under ASGI django calls this on the thread it then runs sync views on,
+        # shared by all requests so another profile may take it over
+        profile = profiling.current_profile.get()
+        if self.is_async and profile is not None and not asyncio.iscoroutinefunction(view_func):
+            self.sampler.register(profile)
+        return None
+
+    def finish(self, request, profile: profiling.Profile, response):
+        if profile.kept(self.slow):
+            match = request.resolver_match
+            profiling.write(profile, match.url_name if match and match.url_name else 'unknown')
+        return response
+
+
+class MetricsMiddleware(HybridMiddleware):
+    """
+        count requests, their latency and queries per view (url name) and
+        the outcome of their user_token into metrics.registry, served on /metrics
+        not loaded when settings.METRICS_ENABLED is off
+    """
+
+    def __init__(self, get_response):
+        if not settings.METRICS_ENABLED:
+            raise MiddlewareNotUsed
+        super().__init__(get_response)
+
+    def handle(self, request):
+        queries = []
+        start = time.perf_counter()
+        with adding(query_wrappers, partial(self.countQuery, queries)):
+            response = self.get_response(request)
+        return self.finish(request, response, time.perf_counter() - start, len(queries))
+
+    async def ahandle(self, request):
+        queries = []
+        start = time.perf_counter()
+        with adding(query_wrappers, partial(self.countQuery, queries)):
+            response = await self.get_response(request)
+        return self.finish(request, response, time.perf_counter() - start, len(queries))
+
+    @staticmethod
+    def countQuery(queries, execute, sql, params, many, context):
+        # appended from several threads at the same time, list.append is atomic
+        queries.append(sql)
+        return execute(sql, params, many, context)
+
+    def finish(self, request, response, duration: float, queries: int):
+        match = request.resolver_match
+        view = {'view': match.url_name if match and match.url_name else 'unknown'}
+        registry = metrics.registry
+        registry.inc('foodpocket_requests_total',
+                     dict(view, method=request.method, status=str(response.status_code)))
+        registry.observe('foodpocket_request_duration_seconds', view, duration)
+        registry.inc('foodpocket_db_queries_total', view, queries)
+
+        # the views answer 401 for an unknown or expired token
+        if 'user_token' in request.GET or (request.method == 'POST' and 'user_token' in request.POST):
+            outcome = 'rejected' if response.status_code == 401 else 'accepted'
+            registry.inc('foodpocket_token_validations_total', {'outcome': outcome})
+
+        metrics.flush()
+        return response
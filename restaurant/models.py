@@ -1,13 +1,22 @@
-from django.db import models
+from django.conf import settings
+from django.db import IntegrityError, models, router, transaction
 from django.utils import timezone
-from django.db.models import Max, F
+from django.db.models import Count, F, Max, Q, Sum
+from django.db.models.functions import TruncMonth
+from django.dispatch import Signal
 import uuid
+import json
 import random
 import string
 from datetime import date, timedelta
 from django.utils.translation import gettext_lazy as _
 import re
-from random import randrange
+from contextlib import nullcontext
+from . import response_cache
+
+# sent by Restaurant.syncHidden with restaurantIds, ownerIds, pocketIds, hidden and using
+# once the hidden flag of restaurants flipped in bulk, e.g. to notify their owners
+hidden_changed = Signal()
 
 
 # Create your models here.
@@ -35,11 +44,30 @@ class Account (models.Model):
         """
             initialize account configs and resources
             including:
-            1. create a empty pocket
+            1. assign a shard for pocket data (when sharding is enabled)
+            2. create a empty pocket
         """
+        from .sharding import assign_shard
+        assign_shard(self)
+
         mypocket = Pocket(owner=self, name="My Pocket")
         mypocket.save()
 
+    def createToken(self, days: int = 30) -> str:
+        """
+            issue a new login token valid for the given days
+        """
+        token = TokenSystem.generate_token()
+        self.tokensystem_set.create(
+            token=token,
+            expire_time=timezone.now() + timezone.timedelta(days=days)
+        )
+        return token
+
+    def getLastPocket(self):
+        return self.pocket_set.exclude(status=Pocket.Status.DELETED).order_by(
+            '-last_use_time', '-create_time').first()
+
     @staticmethod
     def preprocessUsername(username: str) -> (str, bool, str):
         """
@@ -80,6 +108,19 @@ class Account (models.Model):
         return isValid, errorMsg
 
 
+class AccountShard (models.Model):
+    """
+        shard map: which database of settings.DATABASE_SHARDS holds the
+        pockets, restaurants, visit records and tokens of an account,
+        always stored on the default database (see sharding.py)
+    """
+    account_uid = models.UUIDField(unique=True)
+    shard = models.CharField(max_length=64)
+
+    def __str__(self):
+        return str(self.account_uid) + "/" + self.shard
+
+
 class TokenSystem (models.Model):
     owner = models.ForeignKey(Account, on_delete=models.CASCADE)
 
@@ -120,6 +161,7 @@ class Pocket (models.Model):
     last_use_time = models.DateTimeField(null=True, blank=True)
     status = models.IntegerField(choices=Status.choices, default=Status.ACTIVE)
     note = models.CharField(max_length=1000, default="", blank=True)
+    delete_time = models.DateTimeField(null=True, blank=True, db_index=True)
 
     def __str__(self):
         return self.name
@@ -132,6 +174,8 @@ class Pocket (models.Model):
         try:
             newStatus = self.Status[newStatusLabel].value
             self.status = newStatus
+            if newStatus == self.Status.DELETED:
+                self.delete_time = timezone.now()
 
         except KeyError:
             return False, "Undefined status"
@@ -157,55 +201,152 @@ class Pocket (models.Model):
             "name": self.name,
         }
 
-    def remove(self):
+    def remove(self, cascade: bool = True):
         """
             fake remove a pocket and all relavant restaurants and visit records
+            cascade: False leaves the restaurants to removeRestaurants (e.g. in a background job)
         """
         self.status = Pocket.Status.DELETED
+        self.delete_time = timezone.now()
         self.save()
 
-        # remove restaurants
-        for restaurant in self.restaurant_set.exclude(status=Restaurant.Status.DELETED):
+        if cascade:
+            self.removeRestaurants()
+
+    def removeRestaurants(self, progress=None):
+        """
+            fake remove the restaurants (and their visit records) of a pocket
+            progress: optional callable(done, total), e.g. Job.report
+        """
+        restaurants = list(self.restaurant_set.exclude(status=Restaurant.Status.DELETED))
+        for done, restaurant in enumerate(restaurants, 1):
             restaurant.remove()
+            if progress is not None:
+                progress(done, len(restaurants))
 
     def getRestaurants(self):
         return self.restaurant_set.exclude(status=Restaurant.Status.DELETED)
 
+    def copyRestaurants(self, restaurants, deep: bool = False, batch_size: int = 500,
+                        progress=None, atomic: bool = True, skip: int = 0) -> int:
+        """
+            copy restaurants (a queryset, possibly from other pockets) into this pocket
+            deep: also copy visit records of the copied restaurants
+            progress: optional callable(done, total) called after every chunk
+            atomic: copy everything in one transaction, otherwise every chunk is
+                committed with its progress call, so a background job shows its
+                progress and leaves the database to others between chunks
+            skip: restaurants copied by an earlier run (its last progress), e.g. a retried job
+
+            rows are inserted with bulk_create chunk by chunk,
+            so the number of queries only grows with the number of chunks
+
+            return number of copied restaurants
+        """
+        restaurants = restaurants.exclude(status=Restaurant.Status.DELETED) \
+            .order_by('id')
+        copied = skip
+        total = restaurants.count() if progress is not None else None
+
+        lastId = 0
+        if skip:
+            lastId = next(iter(restaurants.values_list('id', flat=True)[skip - 1:skip]), None)
+            if lastId is None:
+                return copied
+
+        db = router.db_for_write(Restaurant, instance=self)
+        with transaction.atomic(using=db) if atomic else nullcontext():
+            while True:
+                chunk = list(restaurants.filter(id__gt=lastId)[:batch_size])
+                if not chunk:
+                    break
+                lastId = chunk[-1].id
+
+                # the transaction of the chunk unless the whole copy has one
+                with transaction.atomic(using=db, savepoint=False):
+                    self._copyChunk(chunk, deep, batch_size, db)
+                    copied += len(chunk)
+                    if not atomic:
+                        self._copied(db)
+                    if progress is not None:
+                        progress(copied, total)
+
+            if atomic:
+                self._copied(db)
+
+        return copied
+
+    def _copyChunk(self, chunk: list, deep: bool, batch_size: int, db: str):
+        copies = {
+            rest.id: Restaurant(
+                owner=self.owner,
+                pocket=self,
+                name=rest.name,
+                longitude=rest.longitude,
+                latitude=rest.latitude,
+                address=rest.address,
+                create_time=rest.create_time,
+                last_visit=rest.last_visit if deep else None,
+                status=rest.status,
+                hide_until=rest.hide_until,
+                hidden=rest.hidden,
+                note=rest.note,
+            ) for rest in chunk
+        }
+        Restaurant.objects.bulk_create(copies.values())
+
+        if deep:
+            # sqlite does not return primary keys from bulk inserts
+            newIds = dict(Restaurant.objects.filter(
+                uid__in=[copy.uid for copy in copies.values()]
+            ).values_list('uid', 'id'))
+            idMap = {oldId: newIds[copy.uid]
+                     for oldId, copy in copies.items()}
+            self._copyVisitRecords(idMap, batch_size)
+            # bulk inserts skip VisitRecord.save
+            VisitSummary.rebuild(idMap.values(), using=db, batch_size=batch_size)
+
+    def _copied(self, db: str):
+        # bulk inserts send no post_save
+        response_cache.invalidate(self.owner_id, db)
+        DailyRecommendation.invalidate([self.id], db)
+
+    def _copyVisitRecords(self, idMap: dict, batch_size: int):
+        records = VisitRecord.objects.filter(restaurant_id__in=idMap.keys()) \
+            .exclude(status=VisitRecord.Status.DELETED) \
+            .values_list('restaurant_id', 'visit_date', 'create_time', 'score')
+
+        buffer = []
+        for restaurant_id, visit_date, create_time, score in records.iterator(chunk_size=batch_size):
+            buffer.append(VisitRecord(
+                restaurant_id=idMap[restaurant_id],
+                owner=self.owner,
+                visit_date=visit_date,
+                create_time=create_time,
+                score=score,
+            ))
+            if len(buffer) >= batch_size:
+                VisitRecord.objects.bulk_create(buffer)
+                buffer = []
+
+        if buffer:
+            VisitRecord.objects.bulk_create(buffer)
+
     def getVisitRecords(self):
         return VisitRecord.objects.select_related('restaurant') \
             .filter(restaurant__pocket=self).exclude(status=VisitRecord.Status.DELETED) \
             .order_by('-visit_date', '-create_time')
 
     def getRecommendList(self):
-        visibleList = self.restaurant_set \
-            .exclude(status=Restaurant.Status.DELETED) \
-            .exclude(hide_until__gt=date.today()) \
-            .order_by(F('last_visit').asc(nulls_first=True), 'create_time')
-
-        recommendList = []
-        randThreshold = 50  # 50/100
-        # rule: only recommend a restaurant visited less than 5 times in past 30 days
-        visitLimitIn30Days = 5
-        # rule: only recommend a restaurant visited less than 2 times in past 7 days
-        visitLimitIn7Days = 2
-        for rest in visibleList:
-            records = rest.getVisitRecords()
-            if records.filter(visit_date__gt=date.today() - timedelta(days=30)).count() < visitLimitIn30Days \
-                    and records.filter(visit_date__gt=date.today() - timedelta(days=7)).count() < visitLimitIn7Days:
-
-                if rest.status == Restaurant.Status.ACTIVE:
-                    # rule: always recommend an ACTIVE restaurant
-                    recommendList.append(rest)
-                elif rest.status == Restaurant.Status.RANDOM:
-                    # rule: use random to decide whether recommend a RANDOM restaurant
-                    if randrange(1, 100) > randThreshold:
-                        recommendList.append(rest)
-
-        return recommendList
+        return PocketSnapshot(self).getRecommendList()
 
 
 class Restaurant (models.Model):
 
+    class Meta:
+        # hidden restaurants due to show again (Restaurant.syncHidden)
+        indexes = [models.Index(fields=['hidden', 'hide_until'])]
+
     class Status(models.IntegerChoices):
         # user can always see this restaurant in restaurant list
         ACTIVE = 1, _('ACTIVE')
@@ -242,15 +383,28 @@ class Restaurant (models.Model):
     create_time = models.DateTimeField(default=timezone.now)
     last_visit = models.DateField(null=True, blank=True)
     status = models.IntegerField(choices=Status.choices, default=Status.RANDOM)
+    delete_time = models.DateTimeField(null=True, blank=True, db_index=True)
     hide_until = models.DateField(default=date.today)  # check this with status
+    # hide_until is in the future, set by save and cleared by syncHidden once it passed
+    hidden = models.BooleanField(default=False)
     note = models.CharField(max_length=1000, default="", blank=True)
 
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        ''' On save, keep hidden in step with hide_until '''
+        if 'hide_until' not in self.get_deferred_fields():
+            self.hidden = self.hide_until > date.today()
+            update_fields = kwargs.get('update_fields')
+            if update_fields is not None and 'hide_until' in update_fields:
+                kwargs['update_fields'] = set(update_fields) | {'hidden'}
+        return super(Restaurant, self).save(*args, **kwargs)
+
     def getStatusLabel(self) -> str:
         # handling cases for hide_until, return a special status "HIDE" for frond-end
-        if self.status != self.Status.DELETED and self.hide_until > date.today():
+        # hidden is only cleared by syncHidden once a day, hide_until decides
+        if self.status != self.Status.DELETED and self.hidden and self.hide_until > date.today():
             return self.Status.HIDE.label
         else:
             return self.Status(self.status).label
@@ -266,6 +420,8 @@ class Restaurant (models.Model):
                 # don't update status while the new status is HIDE
                 # for HIDE state, the hide_until will handle it
                 self.status = newStatus
+                if newStatus == self.Status.DELETED:
+                    self.delete_time = timezone.now()
 
                 # also reset hide_until to today
                 self.editHideUntil(str(date.today()))
@@ -307,6 +463,7 @@ class Restaurant (models.Model):
             fake remove a restaurant and all relavant visit records
         """
         self.status = Restaurant.Status.DELETED
+        self.delete_time = timezone.now()
         self.save()
 
         # remove visit records
@@ -318,6 +475,71 @@ class Restaurant (models.Model):
             .aggregate(Max('visit_date'))['visit_date__max']
         self.save()
 
+    @staticmethod
+    def updateLastVisits(restaurantIds, batch_size: int = 500):
+        """
+            recompute last_visit for many restaurants with one grouped
+            aggregate and batched updates, instead of one query per restaurant
+        """
+        restaurantIds = list(restaurantIds)
+        if not restaurantIds:
+            return
+
+        lastVisits = dict(
+            VisitRecord.objects.filter(restaurant_id__in=restaurantIds)
+            .exclude(status=VisitRecord.Status.DELETED)
+            .values('restaurant_id')
+            .annotate(last_visit=Max('visit_date'))
+            .values_list('restaurant_id', 'last_visit')
+        )
+
+        restaurants = [
+            Restaurant(id=rid, last_visit=lastVisits.get(rid))
+            for rid in restaurantIds
+        ]
+        Restaurant.objects.bulk_update(
+            restaurants, ['last_visit'], batch_size=batch_size)
+
+        # bulk updates send no post_save
+        db = router.db_for_write(Restaurant)
+        owners = Restaurant.objects.using(db).filter(id__in=restaurantIds)
+        for ownerId in owners.values_list('owner_id', flat=True).distinct():
+            response_cache.invalidate(ownerId, db)
+        DailyRecommendation.invalidate(owners.values_list('pocket_id', flat=True).distinct(), db)
+
+    @staticmethod
+    def syncHidden(today: date = None, using: str = None, batch_size: int = 500) -> (int, int):
+        """
+            show restaurants whose hide_until passed again, and hide the ones
+            whose hide_until is ahead but were never flagged (rows older than hidden)
+            both lookups use the (hidden, hide_until) index, hidden_changed is sent per batch
+
+            return number of shown and hidden restaurants
+        """
+        today = today or date.today()
+        db = using or router.db_for_write(Restaurant)
+        restaurants = Restaurant.objects.using(db)
+
+        counts = []
+        for hidden, due in ((False, restaurants.filter(hidden=True, hide_until__lte=today)),
+                            (True, restaurants.filter(hidden=False, hide_until__gt=today))):
+            count = 0
+            while True:
+                chunk = list(due.values_list('id', 'owner_id', 'pocket_id')[:batch_size])
+                if not chunk:
+                    break
+                restaurantIds = [restaurantId for restaurantId, _, _ in chunk]
+                with transaction.atomic(using=db):
+                    restaurants.filter(id__in=restaurantIds).update(hidden=hidden)
+                    hidden_changed.send(
+                        sender=Restaurant, restaurantIds=restaurantIds,
+                        ownerIds={ownerId for _, ownerId, _ in chunk},
+                        pocketIds={pocketId for _, _, pocketId in chunk},
+                        hidden=hidden, using=db)
+                count += len(chunk)
+            counts.append(count)
+        return tuple(counts)
+
     def addVisitRecord(self, visit_date, score):
         self.visitrecord_set.create(
             owner=self.owner,
@@ -331,21 +553,76 @@ class Restaurant (models.Model):
     def getVisitRecords(self):
         return self.visitrecord_set.exclude(status=VisitRecord.Status.DELETED)
 
-    def brief(self):
-        last_update = self.create_time
-        if self.last_visit and self.last_visit > self.create_time.date():
-            last_update = self.last_visit
+    # fields of brief(), and the model columns each of them reads
+    BRIEF_FIELDS = ('restaurant_uid', 'restaurant_name', 'visit_count', 'last_visit',
+                    'last_update', 'status', 'hide_until', 'note')
+    FIELD_COLUMNS = {
+        'restaurant_uid': ('uid',),
+        'restaurant_name': ('name',),
+        'visit_count': (),
+        'visit_dates': (),
+        'last_visit': ('last_visit',),
+        'last_update': ('create_time', 'last_visit'),
+        'status': ('status', 'hidden', 'hide_until'),
+        'hide_until': ('hide_until',),
+        'note': ('note',),
+    }
 
-        return {
-            'restaurant_uid': self.uid,
-            'restaurant_name': self.name,
-            'visit_count': self.getVisitRecords().count(),
-            'last_visit': self.last_visit if self.last_visit else "",
-            'last_update': last_update,
-            'status': self.getStatusLabel(),
-            'hide_until': self.hide_until,
-            'note': self.note,
-        }
+    @staticmethod
+    def parseFields(value: str, allowed: tuple) -> tuple:
+        """
+            parse a fields= parameter (comma separated), None when not given
+            raise ValueError for unknown fields
+        """
+        if value is None:
+            return None
+        fields = tuple(field.strip() for field in value.split(',') if field.strip())
+        unknown = [field for field in fields if field not in allowed]
+        if not fields or unknown:
+            raise ValueError('unknown fields: %s' % ', '.join(unknown))
+        return fields
+
+    @staticmethod
+    def columnsFor(fields: tuple, required: tuple = ()) -> list:
+        """
+            model columns to load with .only() for the given output fields
+        """
+        columns = set(required)
+        for field in fields:
+            columns.update(Restaurant.FIELD_COLUMNS[field])
+        return sorted(columns)
+
+    def brief(self, visitCount: int = None, fields: tuple = None):
+        """
+            visitCount: skip the count query when the caller already knows it
+            fields: only these of BRIEF_FIELDS, columns outside of them may be deferred
+        """
+        fields = fields or self.BRIEF_FIELDS
+        brief = {}
+
+        for field in fields:
+            if field == 'restaurant_uid':
+                brief[field] = self.uid
+            elif field == 'restaurant_name':
+                brief[field] = self.name
+            elif field == 'visit_count':
+                brief[field] = visitCount if visitCount is not None \
+                    else self.visitsummary_set.aggregate(total=Sum('visit_count'))['total'] or 0
+            elif field == 'last_visit':
+                brief[field] = self.last_visit if self.last_visit else ""
+            elif field == 'last_update':
+                last_update = self.create_time
+                if self.last_visit and self.last_visit > self.create_time.date():
+                    last_update = self.last_visit
+                brief[field] = last_update
+            elif field == 'status':
+                brief[field] = self.getStatusLabel()
+            elif field == 'hide_until':
+                brief[field] = self.hide_until
+            elif field == 'note':
+                brief[field] = self.note
+
+        return brief
 
 
 class VisitRecord (models.Model):
@@ -361,15 +638,67 @@ class VisitRecord (models.Model):
     create_time = models.DateTimeField(default=timezone.now)
     score = models.IntegerField(default=3)
     status = models.IntegerField(choices=Status.choices, default=Status.ACTIVE)
+    delete_time = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    # columns deciding what a record adds to VisitSummary
+    SUMMARY_COLUMNS = ('restaurant_id', 'visit_date', 'score', 'status')
 
     def __str__(self):
         return str(self.owner) + '/' + str(self.restaurant) + '/' + str(self.visit_date)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # what VisitSummary counts for the record as loaded, see save()
+        if all(column in field_names for column in cls.SUMMARY_COLUMNS):
+            instance._counted = instance._summaryKey()
+        else:
+            instance._counted = 'unknown'
+        return instance
+
+    def _summaryKey(self):
+        """
+            (restaurant id, month, score) this record adds to VisitSummary, None when it adds nothing
+        """
+        if self.status != VisitRecord.Status.ACTIVE:
+            return None
+        visitDate = self._meta.get_field('visit_date').to_python(self.visit_date)
+        return self.restaurant_id, VisitSummary.monthOf(visitDate), self.score
+
+    def save(self, *args, **kwargs):
+        ''' On save, keep the monthly VisitSummary of the restaurant in step '''
+        counted = getattr(self, '_counted', None)
+        super(VisitRecord, self).save(*args, **kwargs)
+
+        current = self._summaryKey()
+        if counted == current:
+            return
+        db = router.db_for_write(VisitSummary, instance=self)
+        if counted == 'unknown':
+            VisitSummary.rebuild([self.restaurant_id], using=db)
+        else:
+            if counted is not None:
+                VisitSummary.add(*counted, ownerId=self.owner_id, delta=-1, using=db)
+            if current is not None:
+                VisitSummary.add(*current, ownerId=self.owner_id, delta=1, using=db)
+        self._counted = current
+
+    def delete(self, *args, **kwargs):
+        counted = getattr(self, '_counted', None)
+        db = router.db_for_write(VisitSummary, instance=self)
+        result = super(VisitRecord, self).delete(*args, **kwargs)
+        if counted == 'unknown':
+            VisitSummary.rebuild([self.restaurant_id], using=db)
+        elif counted is not None:
+            VisitSummary.add(*counted, ownerId=self.owner_id, delta=-1, using=db)
+        return result
+
     def remove(self):
         """
             fake remove a visit record
         """
         self.status = VisitRecord.Status.DELETED
+        self.delete_time = timezone.now()
         self.save()
 
         self.restaurant.updateLastVisit()
@@ -379,3 +708,601 @@ class VisitRecord (models.Model):
         self.save()
 
         self.restaurant.updateLastVisit()
+
+
+class VisitSummary (models.Model):
+    """
+        active visit records of a restaurant in one month (month is its first day)
+        kept in step by VisitRecord.save (addVisitRecord, edit, remove),
+        code inserting visit records in bulk calls rebuild
+        manage.py backfillsummaries builds it from the existing history
+    """
+
+    class Meta:
+        unique_together = ('restaurant', 'month')
+
+    restaurant = models.ForeignKey(Restaurant, on_delete=models.CASCADE)
+    owner = models.ForeignKey(Account, on_delete=models.SET_NULL, null=True)
+    month = models.DateField()
+    visit_count = models.IntegerField(default=0)
+    score_sum = models.IntegerField(default=0)
+
+    def __str__(self):
+        return str(self.restaurant) + '/' + self.month.strftime('%Y-%m')
+
+    @staticmethod
+    def monthOf(day: date) -> date:
+        return day.replace(day=1)
+
+    @staticmethod
+    def add(restaurantId: int, month: date, score: int, ownerId: int = None,
+            delta: int = 1, using: str = None):
+        """
+            add delta visits (negative to take them back) with score to a month
+        """
+        db = using or router.db_for_write(VisitSummary)
+        summaries = VisitSummary.objects.using(db).filter(restaurant_id=restaurantId, month=month)
+        changes = {'visit_count': F('visit_count') + delta, 'score_sum': F('score_sum') + delta * score}
+        if summaries.update(**changes):
+            return
+        try:
+            with transaction.atomic(using=db):
+                VisitSummary.objects.using(db).create(
+                    restaurant_id=restaurantId, owner_id=ownerId, month=month,
+                    visit_count=delta, score_sum=delta * score)
+        except IntegrityError:
+            # created by a concurrent visit of the same month
+            summaries.update(**changes)
+
+    @staticmethod
+    def rebuild(restaurantIds, using: str = None, batch_size: int = 500):
+        """
+            recompute the summaries of restaurants from their visit records
+            with one grouped aggregate per batch of restaurants
+        """
+        restaurantIds = list(restaurantIds)
+        db = using or router.db_for_write(VisitSummary)
+        with transaction.atomic(using=db):
+            for start in range(0, len(restaurantIds), batch_size):
+                chunk = restaurantIds[start:start + batch_size]
+                VisitSummary.objects.using(db).filter(restaurant_id__in=chunk).delete()
+
+                months = VisitRecord.objects.using(db) \
+                    .filter(restaurant_id__in=chunk, status=VisitRecord.Status.ACTIVE) \
+                    .annotate(month=TruncMonth('visit_date')) \
+                    .values('restaurant_id', 'restaurant__owner_id', 'month') \
+                    .annotate(visit_count=Count('id'), score_sum=Sum('score')) \
+                    .order_by()
+                VisitSummary.objects.using(db).bulk_create([
+                    VisitSummary(
+                        restaurant_id=row['restaurant_id'],
+                        owner_id=row['restaurant__owner_id'],
+                        month=row['month'],
+                        visit_count=row['visit_count'],
+                        score_sum=row['score_sum'],
+                    ) for row in months
+                ])
+
+
+class ArchivedRow (models.Model):
+    """
+        a pocket, restaurant or visit record purged by retention.purge(archive=True),
+        kept on the database (shard) the row was purged from
+    """
+    model = models.CharField(max_length=64)  # label, e.g. restaurant.visitrecord
+    uid = models.UUIDField(db_index=True)
+    data = models.TextField()  # json of the columns of the row
+    delete_time = models.DateTimeField()
+    archive_time = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return self.model + "/" + str(self.uid)
+
+
+class Job (models.Model):
+    """
+        background job of a heavy mutation, run by the runjobs command
+        (see jobs.py), always stored on the default database
+    """
+
+    class Status(models.IntegerChoices):
+        QUEUED = 1, _('QUEUED')
+        RUNNING = 2, _('RUNNING')
+        DONE = 3, _('DONE')
+        FAILED = 4, _('FAILED')
+
+    class LeaseLost(Exception):
+        """
+            raised by report once another worker took the job over (or gave
+            it up), the worker holding this copy of the job has to stop
+        """
+
+    uid = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
+    owner = models.ForeignKey(Account, on_delete=models.CASCADE)
+    kind = models.CharField(max_length=64)
+    params = models.TextField(default="{}")  # json
+    status = models.IntegerField(choices=Status.choices, default=Status.QUEUED, db_index=True)
+
+    # progress of total units (restaurants, rows, ...), total is 0 while unknown
+    progress = models.IntegerField(default=0)
+    total = models.IntegerField(default=0)
+    result = models.TextField(default="null")  # json
+    error = models.CharField(max_length=1000, default="", blank=True)
+
+    # a running job whose lease expired lost its worker and is claimed again
+    worker = models.CharField(max_length=128, default="", blank=True)
+    attempts = models.IntegerField(default=0)
+    lease_until = models.DateTimeField(null=True, blank=True)
+
+    create_time = models.DateTimeField(default=timezone.now)
+    start_time = models.DateTimeField(null=True, blank=True)
+    finish_time = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return self.kind + "/" + str(self.uid)
+
+    def report(self, progress: int, total: int = None, checkpoint: bool = False):
+        """
+            store progress and renew the lease, writes at most
+            once per settings.JOB_PROGRESS_INTERVAL seconds
+            checkpoint: the work up to progress is committed, always written
+            raise LeaseLost when the job is no longer held by this claim
+        """
+        now = timezone.now()
+        self.progress = progress
+        if total is not None:
+            self.total = total
+
+        # the last report of a job with a known total is always written
+        done = self.total and progress == self.total
+        lastReport = getattr(self, '_lastReport', None)
+        if lastReport is not None and not checkpoint and not done and \
+                (now - lastReport).total_seconds() < settings.JOB_PROGRESS_INTERVAL:
+            return
+        self._lastReport = now
+
+        self.lease_until = now + timedelta(seconds=settings.JOB_LEASE_SECONDS)
+        if not self.held().update(progress=self.progress, total=self.total, lease_until=self.lease_until):
+            raise Job.LeaseLost(str(self))
+
+    def held(self):
+        """
+            the job, as long as this claim of it (worker and attempt) still holds
+            a claim by another worker bumps attempts, so writes through this fence it out
+        """
+        return Job.objects.filter(id=self.id, status=Job.Status.RUNNING,
+                                  worker=self.worker, attempts=self.attempts)
+
+    def checkpoint(self, progress: int, total: int = None):
+        """
+            report progress whose work is committed, called inside the transaction
+            of each chunk: the JobCheckpoint row is written on the shard the chunk
+            is written to, in the same transaction, so a retry resumes exactly
+            after it (see resumeFrom) wherever the job itself is stored
+        """
+        self.report(progress, total, checkpoint=True)
+        JobCheckpoint.objects.update_or_create(job_uid=self.uid, defaults={'progress': progress})
+
+    def resumeFrom(self) -> int:
+        """
+            units committed by earlier attempts of the job (its last checkpoint)
+        """
+        return JobCheckpoint.objects.filter(job_uid=self.uid) \
+            .values_list('progress', flat=True).first() or 0
+
+    def brief(self) -> dict:
+        return {
+            "job_uid": self.uid,
+            "kind": self.kind,
+            "status": self.Status(self.status).label,
+            "progress": self.progress,
+            "total": self.total,
+            "result": json.loads(self.result),
+            "error": self.error,
+            "create_time": self.create_time,
+            "finish_time": self.finish_time,
+        }
+
+
+class JobCheckpoint (models.Model):
+    """
+        committed progress of a chunked job (Job.checkpoint), stored on the shard
+        of its owner next to the rows the job writes, while the Job stays on the
+        default database; removed once the job finished
+    """
+    job_uid = models.UUIDField(unique=True)
+    progress = models.IntegerField(default=0)
+
+    def __str__(self):
+        return str(self.job_uid) + "@" + str(self.progress)
+
+
+class DailyRecommendation (models.Model):
+    """
+        recommend list of a pocket precomputed for a day (PocketSnapshot.getRecommendList),
+        restaurants holds the ids of the recommended restaurants in order, comma separated
+
+        manage.py precomputerecommendations builds the lists of all active pockets
+        once a day, invalidate drops the list of a pocket when its restaurants or
+        visit records change and the next read builds it again for that pocket only
+    """
+    pocket = models.OneToOneField(Pocket, on_delete=models.CASCADE)
+    day = models.DateField()
+    restaurants = models.TextField(blank=True, default="")
+    update_time = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return str(self.pocket) + '/' + self.day.isoformat()
+
+    def restaurantIds(self) -> list:
+        return [int(restaurantId) for restaurantId in self.restaurants.split(',') if restaurantId]
+
+    @staticmethod
+    def build(pockets: list, today: date = None, using: str = None) -> list:
+        """
+            compute and store the recommend lists of pockets for a day, with the
+            queries of PocketSnapshot.recommendMany for all of them together
+        """
+        today = today or date.today()
+        pockets = list(pockets)
+        db = using or router.db_for_write(DailyRecommendation)
+
+        snapshots = PocketSnapshot.many(pockets, ('restaurant_uid',))
+        rows = [
+            DailyRecommendation(pocket=snapshot.pocket, day=today,
+                                restaurants=','.join(str(rest.id) for rest in recommendList))
+            for snapshot, recommendList in zip(snapshots, PocketSnapshot.recommendMany(snapshots, today))
+        ]
+        try:
+            with transaction.atomic(using=db):
+                DailyRecommendation.objects.using(db).filter(pocket__in=pockets).delete()
+                DailyRecommendation.objects.using(db).bulk_create(rows)
+        except IntegrityError:
+            # stored by a concurrent build of the same pockets
+            pass
+        return rows
+
+    @staticmethod
+    def forPockets(pockets: list, today: date = None) -> dict:
+        """
+            {pocket id: ids of the recommended restaurants}, the lists missing
+            or left from another day are built (and stored) first
+        """
+        today = today or date.today()
+        recommended = {
+            row.pocket_id: row.restaurantIds()
+            for row in DailyRecommendation.objects.filter(pocket__in=pockets, day=today)
+        }
+        missing = [pocket for pocket in pockets if pocket.id not in recommended]
+        if missing:
+            from .routers import use_replica
+
+            # the stored list is served all day, build it from the primary,
+            # never from a replica that may not have the latest changes yet
+            reset = use_replica.set(False)
+            try:
+                for row in DailyRecommendation.build(missing, today):
+                    recommended[row.pocket_id] = row.restaurantIds()
+            finally:
+                use_replica.reset(reset)
+        return recommended
+
+    @staticmethod
+    def invalidate(pocketIds: list, using: str = None):
+        """
+            drop the recommend lists of pockets whose restaurants or visit records changed
+        """
+        db = using or router.db_for_write(DailyRecommendation)
+        DailyRecommendation.objects.using(db).filter(pocket_id__in=pocketIds).delete()
+
+
+class PocketSnapshot:
+    """
+        in-memory snapshot of the restaurants and visit records of a pocket,
+        loaded with two queries and shared by the restaurant list and the
+        recommend list instead of querying per restaurant
+
+        fields limits the output of both lists to these fields and the
+        restaurant columns loaded to the ones they need, visit records are
+        only loaded for visit_dates and last_update, visit counts and the
+        recommend rules read the monthly VisitSummary instead
+    """
+
+    # rule: only recommend a restaurant visited less than 5 times in past 30 days
+    visitLimitIn30Days = 5
+    # rule: only recommend a restaurant visited less than 2 times in past 7 days
+    visitLimitIn7Days = 2
+    randThreshold = 50  # 50/100
+
+    RESTAURANT_LIST_FIELDS = ('restaurant_uid', 'restaurant_name', 'visit_count', 'visit_dates',
+                              'last_update', 'status', 'hide_until', 'note')
+    # fields read from the visit records, visit_count comes from VisitSummary
+    RECORD_FIELDS = ('visit_dates', 'last_update')
+
+    # columns used for sorting and the recommend rules, pocket is read
+    # by the related manager to attach the pocket to each restaurant
+    REQUIRED_COLUMNS = ('pocket', 'uid', 'create_time', 'last_visit', 'status', 'hidden', 'hide_until')
+
+    def __init__(self, pocket: Pocket, fields: tuple = None, restaurants: list = None):
+        """
+            restaurants: the restaurants of the pocket when they are loaded already (see many)
+        """
+        self.pocket = pocket
+        self.fields = fields
+
+        if restaurants is None:
+            restaurants = pocket.getRestaurants()
+            if fields is not None:
+                restaurants = restaurants.only(*Restaurant.columnsFor(fields, self.REQUIRED_COLUMNS))
+        self.restaurants = list(restaurants)
+
+        # (visit_date, create_time) of each restaurant, newest first, None until loaded
+        self.records = None
+        # (month, visit_count) of each restaurant, None until loaded
+        self.summaries = None
+
+    def _loadRecords(self):
+        self.records = {rest.id: [] for rest in self.restaurants}
+        records = VisitRecord.objects \
+            .filter(restaurant__pocket=self.pocket) \
+            .exclude(status=VisitRecord.Status.DELETED) \
+            .order_by('-visit_date', '-create_time') \
+            .values_list('restaurant_id', 'visit_date', 'create_time')
+        for restaurant_id, visit_date, create_time in records:
+            # skip records which the belonging restaurant does not available (deleted)
+            if restaurant_id in self.records:
+                self.records[restaurant_id].append((visit_date, create_time))
+
+    def _loadSummaries(self):
+        self.summaries = {rest.id: [] for rest in self.restaurants}
+        summaries = VisitSummary.objects \
+            .filter(restaurant__pocket=self.pocket, visit_count__gt=0) \
+            .values_list('restaurant_id', 'month', 'visit_count')
+        for restaurant_id, month, visit_count in summaries:
+            if restaurant_id in self.summaries:
+                self.summaries[restaurant_id].append((month, visit_count))
+
+    @classmethod
+    def many(cls, pockets: list, fields: tuple = None) -> list:
+        """
+            snapshots of several pockets, their restaurants and visit summaries
+            are loaded with one query each for all the pockets together
+        """
+        pockets = list(pockets)
+        restaurants = Restaurant.objects.filter(pocket__in=pockets) \
+            .exclude(status=Restaurant.Status.DELETED)
+        if fields is not None:
+            restaurants = restaurants.only(*Restaurant.columnsFor(fields, cls.REQUIRED_COLUMNS))
+
+        byPocket = {pocket.id: [] for pocket in pockets}
+        for rest in restaurants:
+            byPocket[rest.pocket_id].append(rest)
+        snapshots = [cls(pocket, fields, byPocket[pocket.id]) for pocket in pockets]
+        cls._loadSummariesOf(snapshots)
+        return snapshots
+
+    @classmethod
+    def precomputed(cls, pockets: list, fields: tuple = None, today: date = None) -> list:
+        """
+            snapshots holding only the recommended restaurants of each pocket,
+            in recommended order, from the DailyRecommendation of the day
+            served with a constant number of queries whatever the pocket sizes
+        """
+        pockets = list(pockets)
+        recommended = DailyRecommendation.forPockets(pockets, today)
+
+        byId = {}
+        ids = [restaurantId for restaurantIds in recommended.values() for restaurantId in restaurantIds]
+        if ids:
+            restaurants = Restaurant.objects.filter(id__in=ids).exclude(status=Restaurant.Status.DELETED)
+            if fields is not None:
+                restaurants = restaurants.only(*Restaurant.columnsFor(fields, cls.REQUIRED_COLUMNS))
+            byId = {rest.id: rest for rest in restaurants}
+
+        snapshots = [
+            cls(pocket, fields, [byId[restaurantId] for restaurantId in recommended[pocket.id]
+                                 if restaurantId in byId])
+            for pocket in pockets
+        ]
+        if 'visit_count' in (fields or Restaurant.BRIEF_FIELDS):
+            cls._loadSummariesOf(snapshots)
+        return snapshots
+
+    @staticmethod
+    def _loadSummariesOf(snapshots: list):
+        """
+            visit summaries of the restaurants of several snapshots in one query
+        """
+        summaries = {}
+        for snapshot in snapshots:
+            snapshot.summaries = {rest.id: [] for rest in snapshot.restaurants}
+            summaries.update(snapshot.summaries)
+        if not summaries:
+            return
+        for restaurant_id, month, visit_count in VisitSummary.objects \
+                .filter(restaurant__pocket__in=[snapshot.pocket for snapshot in snapshots], visit_count__gt=0) \
+                .values_list('restaurant_id', 'month', 'visit_count'):
+            if restaurant_id in summaries:
+                summaries[restaurant_id].append((month, visit_count))
+
+    def visitCount(self, rest: Restaurant) -> int:
+        if self.records is not None:
+            return len(self.records[rest.id])
+        if self.summaries is None:
+            self._loadSummaries()
+        return sum(visit_count for _, visit_count in self.summaries[rest.id])
+
+    def _regulars(self, restaurants: list, today: date) -> list:
+        """
+            ids of the restaurants which may reach a visit limit, the summaries
+            of the months overlapping a rule window bound its visits from above
+        """
+        if self.summaries is None:
+            self._loadSummaries()
+
+        since30 = VisitSummary.monthOf(today - timedelta(days=30))
+        since7 = VisitSummary.monthOf(today - timedelta(days=7))
+        regulars = []
+        for rest in restaurants:
+            months = self.summaries[rest.id]
+            if sum(count for month, count in months if month >= since30) >= self.visitLimitIn30Days \
+                    or sum(count for month, count in months if month >= since7) >= self.visitLimitIn7Days:
+                regulars.append(rest.id)
+        return regulars
+
+    @staticmethod
+    def windowCounts(restaurantIds: list, today: date) -> dict:
+        """
+            {restaurant id: (visits in the 30 day window, visits in the 7 day window)}
+            of restaurants with visits in the window, with one grouped query
+        """
+        if not restaurantIds:
+            return {}
+        since7 = today - timedelta(days=7)
+        counts = VisitRecord.objects \
+            .filter(restaurant_id__in=restaurantIds, visit_date__gt=today - timedelta(days=30),
+                    status=VisitRecord.Status.ACTIVE) \
+            .values('restaurant_id') \
+            .annotate(in30=Count('id'), in7=Count('id', filter=Q(visit_date__gt=since7))) \
+            .order_by() \
+            .values_list('restaurant_id', 'in30', 'in7')
+        return {restaurant_id: (in30, in7) for restaurant_id, in30, in7 in counts}
+
+    def _windowCounts(self, restaurants: list, today: date) -> dict:
+        if self.records is not None:
+            since30, since7 = today - timedelta(days=30), today - timedelta(days=7)
+            return {rest.id: (sum(1 for d, _ in self.records[rest.id] if d > since30),
+                              sum(1 for d, _ in self.records[rest.id] if d > since7))
+                    for rest in restaurants}
+        return self.windowCounts(self._regulars(restaurants, today), today)
+
+    def brief(self, rest: Restaurant) -> dict:
+        fields = self.fields or Restaurant.BRIEF_FIELDS
+        visitCount = self.visitCount(rest) if 'visit_count' in fields else None
+        return rest.brief(visitCount=visitCount, fields=self.fields)
+
+    def getRestaurantList(self) -> list:
+        """
+            all restaurants with their visit dates, in last visited + last updated order
+            without visit records the order comes from last_visit and create_time
+        """
+        fields = self.fields or self.RESTAURANT_LIST_FIELDS
+        if self.records is None and any(field in self.RECORD_FIELDS for field in fields):
+            self._loadRecords()
+
+        restaurantList = []
+        for rest in self.restaurants:
+            entry = {}
+            if self.records is not None:
+                records = self.records[rest.id]
+                visitDates = [visit_date for visit_date, _ in records]
+
+                # update last visit time for sorting
+                last_update = max([rest.create_time] + [create_time for _, create_time in records])
+                sortKey = (visitDates[0] if visitDates else date.min, last_update)
+
+                entry.update({
+                    'visit_count': len(records),
+                    'visit_dates': visitDates,
+                    'last_update': last_update,
+                })
+            else:
+                sortKey = (rest.last_visit or date.min, rest.create_time)
+                if 'visit_count' in fields:
+                    entry['visit_count'] = self.visitCount(rest)
+
+            for field in fields:
+                if field == 'restaurant_uid':
+                    entry[field] = rest.uid
+                elif field == 'restaurant_name':
+                    entry[field] = rest.name
+                elif field == 'status':
+                    entry[field] = rest.getStatusLabel()
+                elif field == 'hide_until':
+                    entry[field] = rest.hide_until
+                elif field == 'note':
+                    entry[field] = rest.note
+
+            restaurantList.append((sortKey, {field: entry[field] for field in fields}))
+
+        # reorder the list to last visited + last updated order
+        restaurantList.sort(key=lambda item: item[0], reverse=True)  # large to small
+        return [entry for _, entry in restaurantList]
+
+    @staticmethod
+    def seedFor(pocket: Pocket, day: date) -> str:
+        """
+            seed of the RANDOM decisions of a user on a day
+        """
+        return '%s:%s' % (pocket.owner_id, day.isoformat())
+
+    def _randomDraw(self, rest: Restaurant, today: date) -> int:
+        """
+            draw in 1..99 of a RANDOM restaurant from a generator seeded by the
+            owner, the day and the restaurant, so the recommend list stays the
+            same for the whole day (and can be cached) and adding, removing or
+            editing a restaurant leaves the decisions of the others alone
+        """
+        return random.Random('%s:%s' % (self.seedFor(self.pocket, today), rest.uid)).randrange(1, 100)
+
+    def _visible(self, today: date) -> list:
+        # the flag skips the date comparison for most rows, a flag syncHidden
+        # has not cleared yet today does not hide a restaurant whose hide_until passed
+        return [rest for rest in self.restaurants if not (rest.hidden and rest.hide_until > today)]
+
+    def getRecommendList(self, today: date = None, windowCounts: dict = None) -> list:
+        """
+            windowCounts: precomputed windowCounts() of the pocket (see recommendMany)
+        """
+        today = today or date.today()
+        visibleList = sorted(
+            self._visible(today),
+            key=lambda rest: (rest.last_visit is not None,
+                              rest.last_visit or date.min, rest.create_time)
+        )
+
+        if windowCounts is None:
+            windowCounts = self._windowCounts(visibleList, today)
+
+        recommendList = []
+        for rest in visibleList:
+            in30Days, in7Days = windowCounts.get(rest.id, (0, 0))
+            if in30Days < self.visitLimitIn30Days and in7Days < self.visitLimitIn7Days:
+
+                if rest.status == Restaurant.Status.ACTIVE:
+                    # rule: always recommend an ACTIVE restaurant
+                    recommendList.append(rest)
+                elif rest.status == Restaurant.Status.RANDOM:
+                    # rule: use random to decide whether recommend a RANDOM restaurant
+                    if self._randomDraw(rest, today) > self.randThreshold:
+                        recommendList.append(rest)
+
+        return recommendList
+
+    @classmethod
+    def recommendMany(cls, snapshots: list, today: date = None) -> list:
+        """
+            recommend lists of several snapshots (see many), the visit windows
+            of all of them are counted with one grouped query
+        """
+        today = today or date.today()
+        regulars = []
+        for snapshot in snapshots:
+            regulars += snapshot._regulars(snapshot._visible(today), today)
+        windowCounts = cls.windowCounts(regulars, today)
+        return [snapshot.getRecommendList(today, windowCounts) for snapshot in snapshots]
+
+    @classmethod
+    def recommendLists(cls, pockets: list, fields: tuple = None, today: date = None) -> list:
+        """
+            [{pocket_uid, name, recommendations}] of several pockets from their
+            precomputed recommend lists, with a constant number of queries
+            however many pockets there are
+        """
+        return [
+            {
+                'pocket_uid': snapshot.pocket.uid,
+                'name': snapshot.pocket.name,
+                'recommendations': [snapshot.brief(rest) for rest in snapshot.restaurants],
+            } for snapshot in cls.precomputed(pockets, fields, today)
+        ]
@@ -0,0 +1,175 @@
+"""
+    sampling profiler for production requests, used by middleware.ProfilingMiddleware
+
+    a profiled request registers its thread with the Sampler, a daemon thread
+    taking the python stack of every registered thread (sys._current_frames)
+    each settings.PROFILE_INTERVAL_MS. Requests picked with probability
+    settings.PROFILE_SAMPLE_RATE are sampled from their start, with
+    settings.PROFILE_SLOW_MS set every request is registered and sampled
+    once it has run that long, and only kept when it ran past it
+
+    each kept request is written to settings.PROFILE_DIR as collapsed stacks,
+    which flamegraph.pl, speedscope or inferno render:
+        <time>-<url name>-<ms>ms.folded      frame;frame;... samples
+        <time>-<url name>-<ms>ms.sql.folded  url name;statement microseconds
+
+    queries are timed on whichever thread runs them (dbhooks.query_wrappers).
+    Async views run the ORM in executor threads (async_views.run_orm), each
+    call registers its thread for the profile of the request (dbhooks.orm_hooks).
+    Under ASGI the event loop thread is not sampled, sync views are sampled on
+    the thread django runs them on
+"""
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from django.conf import settings
+
+# profile of the current request, set by middleware.ProfilingMiddleware
+current_profile = ContextVar('current_profile', default=None)
+
+
+def frame_name(frame) -> str:
+    code = frame.f_code
+    return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+def collapse(frame) -> str:
+    """
+        stack of a frame from the outermost call, ; separated
+    """
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class Profile:
+    """
+        stack samples and query timings of one request
+    """
+
+    def __init__(self, fromStart: bool):
+        self.from_start = fromStart
+        self.start = time.perf_counter()
+        self.duration = None
+        self.samples = Counter()
+        self.queries = []
+
+    def timeQuery(self, execute, sql, params, many, context):
+        # dbhooks.query_wrappers
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((sql, time.perf_counter() - start))
+
+    def kept(self, slow: float = None) -> bool:
+        return self.from_start or (slow is not None and self.duration >= slow)
+
+
+class Sampler:
+    """
+        samples the stacks of the threads registered for a profile,
+        the thread starts with the first profile and waits while there is none
+    """
+
+    def __init__(self, interval: float, slow: float = None):
+        """
+            interval, slow: seconds
+        """
+        self.interval = interval
+        self.slow = slow
+        # thread id -> profile
+        self.profiles = {}
+        self.lock = threading.Lock()
+        self.active = threading.Event()
+        self.thread = None
+
+    def begin(self, fromStart: bool, sampled: bool = True) -> Profile:
+        """
+            sampled: sample the current thread, off for the event loop
+            thread which runs many requests at once
+        """
+        profile = Profile(fromStart)
+        if sampled:
+            self.register(profile)
+        return profile
+
+    def end(self, profile: Profile):
+        profile.duration = time.perf_counter() - profile.start
+        with self.lock:
+            for threadId in [threadId for threadId, p in self.profiles.items() if p is profile]:
+                del self.profiles[threadId]
+
+    @contextmanager
+    def following(self, profile: Profile):
+        """
+            sample the current thread for profile while the block runs,
+            for the ORM threads of async views
+        """
+        threadId = threading.get_ident()
+        self.register(profile)
+        try:
+            yield
+        finally:
+            with self.lock:
+                if self.profiles.get(threadId) is profile:
+                    del self.profiles[threadId]
+
+    def register(self, profile: Profile):
+        """
+            sample the current thread for profile until it ends
+        """
+        with self.lock:
+            self.profiles[threading.get_ident()] = profile
+            self.active.set()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            self.active.wait()
+            time.sleep(self.interval)
+            with self.lock:
+                profiles = list(self.profiles.items())
+                if not profiles:
+                    self.active.clear()
+                    continue
+
+            now = time.perf_counter()
+            frames = sys._current_frames()
+            for threadId, profile in profiles:
+                if not profile.from_start and now - profile.start < self.slow:
+                    continue
+                frame = frames.get(threadId)
+                if frame is not None:
+                    profile.samples[collapse(frame)] += 1
+            del frames
+
+
+def write(profile: Profile, name: str) -> str:
+    """
+        write the collapsed stacks of a profile, return the path without extension
+    """
+    os.makedirs(settings.PROFILE_DIR, exist_ok=True)
+    path = os.path.join(settings.PROFILE_DIR, '%s-%s-%dms' % (
+        datetime.now().strftime('%Y%m%d-%H%M%S-%f'), name, profile.duration * 1000))
+
+    with open(path + '.folded', 'w') as f:
+        for stack, count in profile.samples.items():
+            f.write('%s %d\n' % (stack, count))
+
+    with open(path + '.sql.folded', 'w') as f:
+        timings = Counter()
+        for sql, seconds in profile.queries:
+            timings[' '.join(sql.split()).replace(';', ',')] += seconds
+        for sql, seconds in timings.items():
+            f.write('%s;%s %d\n' % (name, sql, seconds * 1000000))
+    return path
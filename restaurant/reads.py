@@ -0,0 +1,253 @@
+"""
+    parameters, authorization and response data of the read endpoints,
+    shared by the sync views (views.py) and their async variants
+    (async_views.py) so both answer a request the same way.
+    The views only differ in how they run the ORM calls
+"""
+from datetime import date
+from functools import wraps
+from uuid import UUID
+from django.db.models import Count, Q
+from django.http import HttpResponse
+from django.utils import timezone
+from . import analytics, compact
+from .models import VisitRecord, Restaurant, TokenSystem, Pocket, PocketSnapshot
+
+
+class InvalidRequest(Exception):
+    """
+        missing or malformed parameters, answered with 400
+    """
+
+    def __init__(self, message: str = 'read document for correct parameters'):
+        super().__init__(message)
+
+    def response(self) -> HttpResponse:
+        return HttpResponse('Invalid request; ' + str(self), status=400)
+
+
+def _params(parse):
+    """
+        parse(request.GET) of a GET only endpoint,
+        a KeyError or ValueError of parse is an InvalidRequest
+    """
+    @wraps(parse)
+    def wrapper(request):
+        if request.method != 'GET':
+            raise InvalidRequest()
+        try:
+            return parse(request.GET)
+        except (KeyError, ValueError):
+            raise InvalidRequest()
+    return wrapper
+
+
+def _pocket_uid(value: str) -> UUID:
+    return UUID(value.strip(), version=4)
+
+
+def _format(query) -> str:
+    fmt = query.get('format', 'json')
+    if fmt not in compact.FORMATS:
+        raise ValueError('unknown format')
+    return fmt
+
+
+@_params
+def recommend_list_params(query) -> tuple:
+    """
+        user_token, pocket_uid, fields of getRecommendList
+    """
+    return query['user_token'], _pocket_uid(query['pocket_uid']), \
+        Restaurant.parseFields(query.get('fields'), Restaurant.BRIEF_FIELDS)
+
+
+@_params
+def recommend_lists_params(query) -> tuple:
+    """
+        user_token, pocket_uids (a set, None for all pockets), fields of getRecommendLists
+    """
+    pocket_uids = query.get('pocket_uids')
+    if pocket_uids is not None:
+        pocket_uids = {_pocket_uid(uid) for uid in pocket_uids.split(',')}
+    return query['user_token'], pocket_uids, \
+        Restaurant.parseFields(query.get('fields'), Restaurant.BRIEF_FIELDS)
+
+
+@_params
+def restaurant_list_params(query) -> tuple:
+    """
+        user_token, pocket_uid, fields, format of getRestaurantList
+    """
+    return query['user_token'], _pocket_uid(query['pocket_uid']), \
+        Restaurant.parseFields(query.get('fields'), PocketSnapshot.RESTAURANT_LIST_FIELDS), \
+        _format(query)
+
+
+@_params
+def visit_records_params(query) -> tuple:
+    """
+        user_token, pocket_uid, format of getVisitRecords
+    """
+    return query['user_token'], _pocket_uid(query['pocket_uid']), _format(query)
+
+
+@_params
+def visit_stats_params(query) -> tuple:
+    """
+        user_token, pocket_uid, date_from, date_to of getVisitStats
+    """
+    user_token = query['user_token']
+    pocket_uid = _pocket_uid(query['pocket_uid'])
+    date_from = query.get('date_from', None)
+    date_to = query.get('date_to', None)
+
+    defaultFrom, defaultTo = analytics.default_range(date.today())
+    try:
+        date_to = date.fromisoformat(date_to) if date_to else defaultTo
+        date_from = date.fromisoformat(date_from) if date_from else \
+            date_to - (defaultTo - defaultFrom)
+    except ValueError:
+        raise InvalidRequest('Wrong date format, should be YYYY-MM-DD')
+
+    if date_from > date_to:
+        raise InvalidRequest('date_from should not be after date_to')
+    return user_token, pocket_uid, date_from, date_to
+
+
+@_params
+def pocket_list_params(query) -> tuple:
+    """
+        user_token of getPocketList
+    """
+    return query['user_token'],
+
+
+def token_owner_id(user_token: str):
+    """
+        id of the owner of an unexpired token, None when there is none
+    """
+    return TokenSystem.objects.filter(
+        token=user_token, expire_time__gte=timezone.now()) \
+        .values_list('owner_id', flat=True).first()
+
+
+def unauthorized() -> HttpResponse:
+    return HttpResponse('Unauthorized, please login', status=401)
+
+
+def live_pocket(pocket_uid: UUID):
+    """
+        pocket of any owner which is not deleted, None when there is none
+    """
+    return Pocket.objects.exclude(status=Pocket.Status.DELETED) \
+        .filter(uid=pocket_uid).first()
+
+
+def pocket_error(ownerId, pocket):
+    """
+        error response when there is no owner (token) or the pocket is not theirs,
+        None when the pocket may be read
+    """
+    if ownerId is None:
+        return unauthorized()
+    if pocket is None or pocket.owner_id != ownerId:
+        return HttpResponse('Failed, Pocket not found', status=404)
+    return None
+
+
+def authorize_pocket(user_token: str, pocket_uid: UUID):
+    """
+        the token owner and then the pocket (async views look them up at the same time)
+
+        return
+        1. pocket
+        2. error response or None
+    """
+    ownerId = token_owner_id(user_token)
+    pocket = live_pocket(pocket_uid) if ownerId is not None else None
+    error = pocket_error(ownerId, pocket)
+    return (None, error) if error is not None else (pocket, None)
+
+
+def owner_pockets(ownerId: int, pocket_uids: set = None):
+    """
+        pockets of an owner in created order, all of them or those of pocket_uids
+
+        return
+        1. pockets
+        2. error response (one of pocket_uids is not found) or None
+    """
+    pockets = Pocket.objects.filter(owner_id=ownerId) \
+        .exclude(status=Pocket.Status.DELETED) \
+        .order_by('create_time')
+    if pocket_uids is not None:
+        pockets = pockets.filter(uid__in=pocket_uids)
+    pockets = list(pockets)
+    if pocket_uids is not None and len(pockets) != len(pocket_uids):
+        return None, HttpResponse('Failed, Pocket not found', status=404)
+    return pockets, None
+
+
+def touch_pockets(pockets: list):
+    # update last use time, without post_save which would drop cached responses
+    Pocket.objects.filter(pk__in=[pocket.pk for pocket in pockets]).update(last_use_time=timezone.now())
+
+
+def recommend_list(pocket: Pocket, fields: tuple, today: date) -> dict:
+    snapshot = PocketSnapshot.precomputed([pocket], fields, today)[0]
+    return {'result': 'successful', 'data': [snapshot.brief(rest) for rest in snapshot.restaurants]}
+
+
+def recommend_lists(pockets: list, fields: tuple, today: date) -> dict:
+    return {'result': 'successful', 'data': PocketSnapshot.recommendLists(pockets, fields, today)}
+
+
+def restaurant_list(pocket: Pocket, fields: tuple, fmt: str) -> dict:
+    restaurantList = PocketSnapshot(pocket, fields).getRestaurantList()
+    return {
+        'result': 'successful',
+        'data': compact.restaurant_list(restaurantList, fields) if fmt == 'compact' else restaurantList,
+    }
+
+
+def visit_records(pocket: Pocket, fmt: str) -> dict:
+    records = VisitRecord.objects.select_related('restaurant') \
+        .filter(owner_id=pocket.owner_id, restaurant__pocket=pocket) \
+        .exclude(status=VisitRecord.Status.DELETED) \
+        .order_by('-visit_date', '-create_time')
+
+    if fmt == 'compact':
+        return {'result': 'successful', 'data': compact.visit_records(records)}
+    return {
+        'result': 'successful',
+        'data': [
+            {
+                'visitrecord_uid': record.uid,
+                'restaurant_uid': record.restaurant.uid,
+                'restaurant_name': record.restaurant.name,
+                'visit_date': record.visit_date,
+                'create_time': record.create_time,
+            } for record in records
+        ],
+    }
+
+
+def visit_stats(pocket: Pocket, date_from: date, date_to: date) -> dict:
+    return {'result': 'successful', 'data': analytics.visit_stats(pocket, date_from, date_to)}
+
+
+def pocket_list(ownerId: int) -> dict:
+    return {
+        'result': 'successful',
+        'data': [
+            {
+                "pocket_uid": pocket.uid,
+                "name": pocket.name,
+                'size': pocket.size,
+            } for pocket in Pocket.objects.filter(owner_id=ownerId)
+            .exclude(status=Pocket.Status.DELETED)
+            .annotate(size=Count('restaurant', filter=~Q(restaurant__status=Restaurant.Status.DELETED)))
+            .order_by('create_time')
+        ],
+    }
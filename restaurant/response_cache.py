@@ -0,0 +1,128 @@
+"""
+    per-account cache of serialized read responses
+
+    entries are keyed by (account, pocket, endpoint, params) plus a version
+    of the account, every write of the account bumps the version
+    (post_save / post_delete signals in signals.py, and invalidate() calls
+    on the bulk paths which send no signals), so old entries are never read
+    again and age out of the LRU cache settings.RESPONSE_CACHE_ALIAS
+
+    the version only reaches other processes through a shared cache, with
+    a per-process one their entries live until RESPONSE_CACHE_SECONDS
+"""
+import hashlib
+import threading
+import uuid
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.http import HttpResponse, JsonResponse
+from django.utils.cache import get_conditional_response
+from .singleflight import SingleFlight
+
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'not_modified': 0, 'invalidations': 0}
+
+# misses of identical requests at the same time build the response once
+_flight = SingleFlight()
+
+
+def _cache():
+    return caches[settings.RESPONSE_CACHE_ALIAS]
+
+
+def _count(name: str):
+    with _lock:
+        _stats[name] += 1
+
+
+def _version_key(accountId: int) -> str:
+    return 'response-version:%s' % accountId
+
+
+def get_version(accountId: int) -> str:
+    cache = _cache()
+    version = cache.get(_version_key(accountId))
+    if version is None:
+        # first read after a restart or after the version was evicted
+        cache.add(_version_key(accountId), uuid.uuid4().hex, None)
+        version = cache.get(_version_key(accountId))
+    return version
+
+
+def _bump(accountId: int):
+    _cache().set(_version_key(accountId), uuid.uuid4().hex, None)
+    _count('invalidations')
+
+
+def invalidate(accountId: int, using: str = DEFAULT_DB_ALIAS):
+    """
+        drop cached responses of an account
+
+        bumped right away and once more when the transaction on `using`
+        commits, a response built from the old rows meanwhile is stored
+        under the version it started with and never read again
+    """
+    if accountId is None:
+        return
+    _bump(accountId)
+    transaction.on_commit(lambda: _bump(accountId), using=using)
+
+
+def cache_key(accountId: int, pocketUid, endpoint: str, params) -> str:
+    """
+        params is request.GET, user_token is left out since every device
+        of an account has its own token
+    """
+    query = sorted((name, value) for name, values in params.lists()
+                   if name != 'user_token' for value in values)
+    digest = hashlib.sha1(repr(query).encode()).hexdigest()
+    return 'response:%s:%s:%s:%s:%s' % (
+        accountId, pocketUid, endpoint, get_version(accountId), digest)
+
+
+def respond(request, accountId: int, pocketUid, endpoint: str, build) -> HttpResponse:
+    """
+        return the cached response of the request, or call build() for the
+        response dict, serialize and cache it. Concurrent misses of the same
+        key wait for the first one and share its bytes
+        X-Cache tells whether the response was a HIT, a MISS or COALESCED
+        the ETag is a hash of the body, a matching If-None-Match gets a 304
+    """
+    key = cache_key(accountId, pocketUid, endpoint, request.GET)
+    entry = _cache().get(key)
+
+    if entry is None:
+        _count('misses')
+
+        def build_entry():
+            content = JsonResponse(build()).content
+            entry = (content, '"%s"' % hashlib.sha1(content).hexdigest())
+            _cache().set(key, entry, settings.RESPONSE_CACHE_SECONDS)
+            return entry
+
+        entry, shared = _flight.do(key, build_entry, settings.SINGLE_FLIGHT_TIMEOUT)
+        if shared:
+            _count('coalesced')
+        state = 'COALESCED' if shared else 'MISS'
+    else:
+        _count('hits')
+        state = 'HIT'
+
+    content, etag = entry
+    response = get_conditional_response(request, etag=etag)
+    if response is not None:
+        _count('not_modified')
+    else:
+        response = HttpResponse(content, content_type='application/json')
+        response['ETag'] = etag
+    response['X-Cache'] = state
+    return response
+
+
+def stats() -> dict:
+    with _lock:
+        result = dict(_stats)
+    lookups = result['hits'] + result['misses']
+    result['hit_ratio'] = result['hits'] / lookups if lookups else 0.0
+    return result
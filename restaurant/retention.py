@@ -0,0 +1,113 @@
+"""
+    retention of soft-deleted rows
+
+    remove() only flips status to DELETED and stamps delete_time, purge()
+    deletes the rows deleted more than `days` ago, optionally moving them to
+    ArchivedRow first. Children go first, a restaurant is only purged once
+    none of its visit records is left and a pocket once none of its
+    restaurants is, so live rows are never deleted along with a parent.
+
+    every batch is a short transaction of its own followed by a pause,
+    so requests get the database in between while it runs in business hours
+"""
+import json
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DEFAULT_DB_ALIAS, router, transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+from .models import ArchivedRow, Pocket, Restaurant, VisitRecord
+from .sharding import using_shard
+
+# children first
+PURGE_ORDER = (VisitRecord, Restaurant, Pocket)
+
+DEFAULT_BATCH_SIZE = 500
+
+
+def expired(model, cutoff):
+    """
+        rows of model purge() deletes: deleted before cutoff, without children left behind
+    """
+    rows = model.objects.filter(status=model.Status.DELETED, delete_time__lt=cutoff)
+    if model is Restaurant:
+        visits = VisitRecord.objects.filter(restaurant=OuterRef('pk')) \
+            .exclude(pk__in=expired(VisitRecord, cutoff).values('pk'))
+        rows = rows.filter(~Exists(visits))
+    elif model is Pocket:
+        restaurants = Restaurant.objects.filter(pocket=OuterRef('pk')) \
+            .exclude(pk__in=expired(Restaurant, cutoff).values('pk'))
+        rows = rows.filter(~Exists(restaurants))
+    return rows
+
+
+def unstamped(model):
+    """
+        rows deleted before delete_time existed,
+        purge() stamps them so they are kept for the full retention period
+    """
+    return model.objects.filter(status=model.Status.DELETED, delete_time__isnull=True)
+
+
+def _archive(model, rows: list):
+    fields = model._meta.concrete_fields
+    ArchivedRow.objects.bulk_create([
+        ArchivedRow(
+            model=model._meta.label_lower,
+            uid=row.uid,
+            data=json.dumps({field.attname: getattr(row, field.attname) for field in fields},
+                            cls=DjangoJSONEncoder),
+            delete_time=row.delete_time,
+        ) for row in rows
+    ])
+
+
+def _purge_model(model, cutoff, batch_size: int, pause: float, archive: bool) -> int:
+    db = router.db_for_write(model)
+    purged = 0
+    while True:
+        with transaction.atomic(using=db):
+            rows = list(expired(model, cutoff).order_by('id')[:batch_size])
+            if not rows:
+                return purged
+            if archive:
+                _archive(model, rows)
+            model.objects.filter(id__in=[row.id for row in rows]).delete()
+        purged += len(rows)
+        time.sleep(pause)
+
+
+def purge(days: int = None, batch_size: int = DEFAULT_BATCH_SIZE, pause: float = None,
+          archive: bool = False, dry_run: bool = False) -> dict:
+    """
+        purge rows deleted more than days (settings.PURGE_RETENTION_DAYS) ago
+        on every shard, sleeping pause (settings.PURGE_PAUSE_SECONDS) seconds
+        between batches of batch_size rows
+
+        dry_run: only count what would be purged and stamped
+
+        return {database: {model label: purged rows, 'unstamped': stamped rows}}
+    """
+    days = settings.PURGE_RETENTION_DAYS if days is None else days
+    pause = settings.PURGE_PAUSE_SECONDS if pause is None else pause
+    cutoff = timezone.now() - timedelta(days=days)
+
+    report = {}
+    for db in settings.DATABASE_SHARDS or [DEFAULT_DB_ALIAS]:
+        with using_shard(db):
+            stats = report[db] = {}
+            if dry_run:
+                stats['unstamped'] = sum(unstamped(model).count() for model in PURGE_ORDER)
+            else:
+                stats['unstamped'] = sum(unstamped(model).update(delete_time=timezone.now())
+                                         for model in PURGE_ORDER)
+
+            for model in PURGE_ORDER:
+                if dry_run:
+                    stats[model._meta.label_lower] = expired(model, cutoff).count()
+                else:
+                    stats[model._meta.label_lower] = _purge_model(
+                        model, cutoff, batch_size, pause, archive)
+    return report
@@ -0,0 +1,89 @@
+import random
+from contextvars import ContextVar
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from .models import Account
+from .sharding import SHARDED_MODELS, current_shard, shard_of
+
+# whether reads of the current request may go to a replica,
+# set per request by middleware.ReplicaRoutingMiddleware
+use_replica = ContextVar('use_replica', default=False)
+
+# models always read from the primary, a token issued by loginAccount
+# must be usable right away even when replicas lag behind,
+# so must a job polled right after it was enqueued
+PRIMARY_ONLY_MODELS = ('restaurant.account', 'restaurant.accountshard', 'restaurant.tokensystem',
+                       'restaurant.job')
+
+
+def db_policy(policy: str, methods: tuple = ('GET', 'HEAD', 'OPTIONS')):
+    """
+        declare where a view reads from
+        'replica': reads go to settings.DATABASE_REPLICAS (unless pinned to the primary)
+        'primary': everything goes to the primary (default for undecorated views)
+        methods: the requests the policy is for, others go to the primary,
+            e.g. ('GET',) for a view which also logs in on POST
+    """
+    assert policy in ('replica', 'primary')
+
+    def decorator(view):
+        view.db_policy = policy
+        view.db_policy_methods = methods
+        return view
+    return decorator
+
+
+class PrimaryReplicaRouter:
+    """
+        send reads to a random replica while use_replica is on,
+        writes always go to the primary (default) database
+    """
+
+    def db_for_read(self, model, **hints):
+        if not use_replica.get() or not settings.DATABASE_REPLICAS:
+            return None
+        if model._meta.label_lower in PRIMARY_ONLY_MODELS:
+            return DEFAULT_DB_ALIAS
+        return random.choice(settings.DATABASE_REPLICAS)
+
+    def db_for_write(self, model, **hints):
+        # explicit, otherwise django writes an instance back to the replica it was read from
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same data as the primary
+        return True
+
+
+class ShardRouter:
+    """
+        pin pocket data (sharding.SHARDED_MODELS) to the shard of its owner,
+        accounts and the shard map stay on the default database
+        comes before PrimaryReplicaRouter, replicas only serve the default database
+    """
+
+    def _db(self, model, **hints):
+        if not settings.DATABASE_SHARDS:
+            return None
+        if model._meta.label_lower not in SHARDED_MODELS:
+            # shard copies of accounts only back foreign keys
+            return DEFAULT_DB_ALIAS if model._meta.label_lower in PRIMARY_ONLY_MODELS else None
+
+        instance = hints.get('instance')
+        if isinstance(instance, Account):
+            # related managers of an account, e.g. account.pocket_set
+            return shard_of(instance)
+        if instance is not None:
+            if instance._state.db in settings.DATABASE_SHARDS:
+                return instance._state.db
+            owner = instance._state.fields_cache.get('owner')
+            if owner is not None:
+                return shard_of(owner)
+        return current_shard.get()
+
+    db_for_read = _db
+    db_for_write = _db
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # rows of one account share a shard, accounts are copied to it
+        return True if settings.DATABASE_SHARDS else None
@@ -0,0 +1,243 @@
+"""
+    owner-based sharding of pocket data
+
+    every query in views.py is scoped by an account, so Pocket, Restaurant,
+    VisitRecord and TokenSystem rows live on the shard of their owner
+    (one of settings.DATABASE_SHARDS), Account and the AccountShard map
+    stay on the default database. Each shard keeps a copy of the account
+    rows it holds data for, only to satisfy foreign keys.
+
+    routers.ShardRouter picks the shard from the instance a query is
+    about, or from current_shard which middleware.ShardRoutingMiddleware
+    sets from the user_token of the request
+
+    account to shard and token to shard lookups are cached in the default
+    cache, which must be shared by every process (checks.check_shard_cache):
+    move_account (manage.py rebalance) drops the entries of the account it
+    moves, a per-process cache would only drop them in its own process
+"""
+import hashlib
+import zlib
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, transaction
+from .models import Account, AccountShard, TokenSystem, Pocket, Restaurant, VisitRecord, VisitSummary
+
+# shard of the current request, set per request by middleware.ShardRoutingMiddleware
+current_shard = ContextVar('current_shard', default=None)
+
+# archived rows stay on the shard they were purged from (see retention.py),
+# job checkpoints are committed with the chunks of the job (see Job.checkpoint)
+SHARDED_MODELS = ('restaurant.pocket', 'restaurant.restaurant',
+                  'restaurant.visitrecord', 'restaurant.visitsummary',
+                  'restaurant.dailyrecommendation', 'restaurant.tokensystem',
+                  'restaurant.archivedrow', 'restaurant.jobcheckpoint')
+
+# how long token to shard and account to shard lookups are cached
+LOOKUP_CACHE_SECONDS = 300
+
+# cached shard of a token no shard has
+NO_SHARD = ''
+
+DEFAULT_BATCH_SIZE = 500
+
+
+def sharding_enabled() -> bool:
+    return bool(settings.DATABASE_SHARDS)
+
+
+def pick_shard(account_uid) -> str:
+    """
+        initial shard of a new account, a stable hash of its uid
+    """
+    shards = settings.DATABASE_SHARDS
+    return shards[zlib.crc32(account_uid.bytes) % len(shards)]
+
+
+def _account_key(account_uid) -> str:
+    return 'account-shard:' + str(account_uid)
+
+
+def _token_key(token: str) -> str:
+    return 'token-shard:' + hashlib.sha1(token.encode()).hexdigest()
+
+
+def _copy_account(account: Account, shard: str):
+    # foreign keys on the shard point at this copy, it is never read
+    if shard != DEFAULT_DB_ALIAS and \
+            not Account.objects.using(shard).filter(pk=account.pk).exists():
+        Account.objects.using(shard).bulk_create([Account(**{
+            field.attname: getattr(account, field.attname)
+            for field in Account._meta.concrete_fields
+        })])
+
+
+def assign_shard(account: Account, shard: str = None) -> str:
+    """
+        put a new account on a shard (picked by pick_shard when not given)
+        return the shard, or the default database when sharding is disabled
+    """
+    if not sharding_enabled():
+        return DEFAULT_DB_ALIAS
+
+    shard = shard or pick_shard(account.uid)
+    _copy_account(account, shard)
+    AccountShard.objects.update_or_create(
+        account_uid=account.uid, defaults={'shard': shard})
+    cache.delete(_account_key(account.uid))
+    account._shard = shard
+    return shard
+
+
+def shard_of(account: Account) -> str:
+    """
+        shard holding the data of an account,
+        accounts without a mapping are on the default database
+    """
+    if not sharding_enabled():
+        return DEFAULT_DB_ALIAS
+
+    if getattr(account, '_shard', None) is None:
+        key = _account_key(account.uid)
+        shard = cache.get(key)
+        if shard is None:
+            shard = AccountShard.objects.filter(account_uid=account.uid) \
+                .values_list('shard', flat=True).first() or DEFAULT_DB_ALIAS
+            cache.set(key, shard, LOOKUP_CACHE_SECONDS)
+        account._shard = shard
+    return account._shard
+
+
+def shard_for_token(token: str):
+    """
+        shard holding a login token, None when no shard has it
+        tokens carry no shard, so a cache miss asks every shard in turn
+    """
+    key = _token_key(token)
+    shard = cache.get(key)
+    if shard is None:
+        shard = locate_shard(TokenSystem, token=token)
+        # unknown tokens too, a client sending one would ask every shard on each request
+        cache.set(key, NO_SHARD if shard is None else shard, LOOKUP_CACHE_SECONDS)
+    return shard or None
+
+
+def locate_shard(model, **filters):
+    """
+        first shard with a row of model matching filters, None when there is none
+    """
+    for shard in settings.DATABASE_SHARDS or [DEFAULT_DB_ALIAS]:
+        if model.objects.using(shard).filter(**filters).exists():
+            return shard
+    return None
+
+
+@contextmanager
+def using_shard(shard: str):
+    """
+        route queries without an instance to shard, for code running outside
+        of a request such as management commands
+    """
+    reset = current_shard.set(shard)
+    try:
+        yield
+    finally:
+        current_shard.reset(reset)
+
+
+def _copy_rows(queryset, target: str, remap: dict, batch_size: int) -> dict:
+    """
+        copy rows of a queryset to the target database chunk by chunk,
+        foreign key columns in remap (attname: {old id: new id}) are rewritten
+
+        return old id to new id map (ids are per database, uids are kept)
+    """
+    model = queryset.model
+    fields = [field for field in model._meta.concrete_fields if not field.primary_key]
+    hasUid = any(field.name == 'uid' for field in fields)
+    queryset = queryset.order_by('pk')
+    idMap = {}
+
+    lastId = 0
+    while True:
+        chunk = list(queryset.filter(pk__gt=lastId)[:batch_size])
+        if not chunk:
+            break
+        lastId = chunk[-1].pk
+
+        copies = []
+        for obj in chunk:
+            values = {field.attname: getattr(obj, field.attname) for field in fields}
+            for attname, mapping in remap.items():
+                if values[attname] is not None:
+                    values[attname] = mapping[values[attname]]
+            copies.append(model(**values))
+        model.objects.using(target).bulk_create(copies)
+
+        if hasUid:
+            # sqlite does not return primary keys from bulk inserts
+            newIds = dict(model.objects.using(target).filter(
+                uid__in=[obj.uid for obj in chunk]).values_list('uid', 'id'))
+            idMap.update({obj.pk: newIds[obj.uid] for obj in chunk})
+
+    return idMap
+
+
+def move_account(account: Account, target: str, batch_size: int = DEFAULT_BATCH_SIZE) -> dict:
+    """
+        move all pockets, restaurants, visit records and tokens of an account
+        to the target shard, deleted (status DELETED) rows are moved as well
+
+        rows are copied in one transaction on the target, then the shard map
+        is switched and the rows are removed from the source. Writes of the
+        account made while it moves may be lost, move idle accounts.
+        Only safe with a shared default cache, the web workers must see the
+        cached shard of the account go away.
+
+        return number of moved rows per model
+    """
+    if target not in settings.DATABASE_SHARDS:
+        raise ValueError('Unknown shard: %s' % target)
+
+    source = shard_of(account)
+    if source == target:
+        return {'pockets': 0, 'restaurants': 0, 'visit_records': 0, 'tokens': 0}
+
+    pockets = Pocket.objects.using(source).filter(owner=account)
+    restaurants = Restaurant.objects.using(source).filter(owner=account)
+    visits = VisitRecord.objects.using(source).filter(owner=account)
+    summaries = VisitSummary.objects.using(source).filter(owner=account)
+    tokens = TokenSystem.objects.using(source).filter(owner=account)
+    tokenValues = list(tokens.values_list('token', flat=True))
+
+    with transaction.atomic(using=target):
+        _copy_account(account, target)
+        pocketMap = _copy_rows(pockets, target, {}, batch_size)
+        restaurantMap = _copy_rows(
+            restaurants, target, {'pocket_id': pocketMap}, batch_size)
+        visitMap = _copy_rows(
+            visits, target, {'restaurant_id': restaurantMap}, batch_size)
+        _copy_rows(summaries, target, {'restaurant_id': restaurantMap}, batch_size)
+        _copy_rows(tokens, target, {}, batch_size)
+
+    stats = {'pockets': len(pocketMap), 'restaurants': len(restaurantMap),
+             'visit_records': len(visitMap), 'tokens': len(tokenValues)}
+
+    AccountShard.objects.update_or_create(
+        account_uid=account.uid, defaults={'shard': target})
+    cache.delete(_account_key(account.uid))
+    cache.delete_many([_token_key(token) for token in tokenValues])
+    account._shard = target
+
+    with transaction.atomic(using=source):
+        visits.delete()
+        summaries.delete()
+        restaurants.delete()
+        pockets.delete()
+        tokens.delete()
+        if source != DEFAULT_DB_ALIAS:
+            Account.objects.using(source).filter(pk=account.pk).delete()
+
+    return stats
@@ -0,0 +1,63 @@
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from . import dbhooks, response_cache
+from .models import DailyRecommendation, Pocket, Restaurant, VisitRecord, hidden_changed
+
+
+@receiver(connection_created)
+def apply_sqlite_pragmas(sender, connection, **kwargs):
+    """
+        apply settings.SQLITE_PRAGMAS to every new sqlite connection,
+        with CONN_MAX_AGE this runs once per persistent connection
+    """
+    if connection.vendor != 'sqlite' or not settings.SQLITE_PRAGMAS:
+        return
+
+    with connection.cursor() as cursor:
+        for name, value in settings.SQLITE_PRAGMAS.items():
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+
+
+@receiver(connection_created)
+def install_query_wrappers(sender, connection, **kwargs):
+    """
+        let the middleware observe the queries of a request (see dbhooks.py)
+    """
+    dbhooks.install(connection)
+
+
+@receiver([post_save, post_delete], sender=Pocket)
+@receiver([post_save, post_delete], sender=Restaurant)
+@receiver([post_save, post_delete], sender=VisitRecord)
+def invalidate_responses(sender, instance, using, **kwargs):
+    """
+        cached responses of an account are stale once any of its rows change
+    """
+    response_cache.invalidate(instance.owner_id, using)
+
+
+@receiver([post_save, post_delete], sender=Restaurant)
+@receiver([post_save, post_delete], sender=VisitRecord)
+def invalidate_recommendations(sender, instance, using, **kwargs):
+    """
+        the precomputed recommend list of a pocket is stale once a restaurant
+        (status, hide_until) or a visit record of the pocket changes
+    """
+    if sender is Restaurant:
+        pocketIds = [instance.pocket_id]
+    else:
+        pocketIds = Restaurant.objects.using(using).filter(id=instance.restaurant_id).values('pocket_id')
+    DailyRecommendation.invalidate(pocketIds, using)
+
+
+@receiver(hidden_changed)
+def invalidate_hidden(sender, ownerIds, pocketIds, using, **kwargs):
+    """
+        restaurants shown or hidden by the daily sync change the status label
+        of the restaurant list and the recommend lists, bulk updates send no post_save
+    """
+    for ownerId in ownerIds:
+        response_cache.invalidate(ownerId, using)
+    DailyRecommendation.invalidate(pocketIds, using)
@@ -0,0 +1,59 @@
+"""
+    single-flight: concurrent identical calls in one process wait for the
+    first one (the leader) and share its result instead of running again
+"""
+import threading
+import time
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.started = time.monotonic()
+        self.value = None
+        self.failed = False
+
+
+class SingleFlight:
+    """
+        followers wait for the leader until `timeout` seconds after it started,
+        after that, or when the leader raised, they run func themselves,
+        so a stuck leader cannot block followers forever
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, timeout: float) -> (object, bool):
+        """
+            return
+            1. result of func, possibly computed by another thread
+            2. was the result shared from another thread?
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            remaining = timeout - (time.monotonic() - call.started)
+            if remaining > 0 and call.done.wait(remaining) and not call.failed:
+                return call.value, True
+            return func(), False
+
+        try:
+            call.value = func()
+        except BaseException:
+            call.failed = True
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.value, False
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls)
@@ -0,0 +1,655 @@
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.cache import cache, caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, connections, transaction
+from django.test.utils import CaptureQueriesContext
+from django.test import TestCase, Client, override_settings
+from django.urls import reverse
+from restaurant.models import Account, AccountShard, TokenSystem, Pocket, Restaurant, VisitRecord, \
+    ArchivedRow, VisitSummary, PocketSnapshot, DailyRecommendation, Job, JobCheckpoint
+from restaurant import checks, jobs
+from restaurant.routers import PrimaryReplicaRouter, use_replica
+from restaurant.urls import urlpatterns
+from restaurant.sharding import assign_shard
+from django.utils import timezone
+from datetime import date, timedelta
+from unittest import mock
+import io
+import json
+import os
+import re
+
+
+class SqlitePragmaTestCase(TestCase):
+    def query_pragma(self, conn, name):
+        with conn.cursor() as cursor:
+            cursor.execute('PRAGMA %s' % name)
+            return cursor.fetchone()[0]
+
+    @override_settings(SQLITE_PRAGMAS={'synchronous': 'NORMAL', 'busy_timeout': 1234})
+    def test_pragmas_applied_on_new_connection(self):
+        """
+            SQLITE_PRAGMAS are applied when a connection is created
+        """
+        conn = connection.copy()
+        self.addCleanup(conn.close)
+
+        self.assertEqual(1, self.query_pragma(conn, 'synchronous'))  # NORMAL
+        self.assertEqual(1234, self.query_pragma(conn, 'busy_timeout'))
+
+    @override_settings(SQLITE_PRAGMAS={})
+    def test_no_pragmas_by_default(self):
+        conn = connection.copy()
+        self.addCleanup(conn.close)
+
+        self.assertEqual(2, self.query_pragma(conn, 'synchronous'))  # sqlite default FULL
+
+
+@override_settings(DATABASE_REPLICAS=['replica'], RESPONSE_CACHE_SECONDS=0)
+class ReplicaRoutingTestCase(TestCase):
+    """
+        the replica is a separate test database which only receives the rows
+        copied by setUp, so rows found only on the primary show where a read went
+        (cached responses would hide where reads go, the cache is off)
+    """
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        cache.clear()
+        self.c = Client()
+
+        self.tester = Account(username='tester', email='tester@test.com')
+        self.tester.save()
+        self.token = self.tester.createToken()
+        self.pocket = Pocket(owner=self.tester, name='My Pocket')
+        self.pocket.save()
+
+        # replicate account and pocket, but not the restaurant
+        self.tester.save(using='replica')
+        self.pocket.save(using='replica')
+        Restaurant(owner=self.tester, pocket=self.pocket, name='primary only').save()
+
+        self.params = {'user_token': self.token, 'pocket_uid': self.pocket.uid}
+
+    def restaurant_names(self):
+        res = self.c.get('/api/rest/getRestaurantList/', self.params)
+        self.assertEqual(200, res.status_code)
+        return [rest['restaurant_name'] for rest in json.loads(res.content)['data']]
+
+    def test_get_reads_from_replica(self):
+        self.assertEqual([], self.restaurant_names())
+
+        # the token is looked up on the primary, the last_use_time save goes to the primary
+        self.assertIsNotNone(Pocket.objects.using('default').get(pk=self.pocket.pk).last_use_time)
+        self.assertIsNone(Pocket.objects.using('replica').get(pk=self.pocket.pk).last_use_time)
+
+    @override_settings(DATABASE_REPLICAS=[])
+    def test_no_replicas(self):
+        self.assertEqual(['primary only'], self.restaurant_names())
+
+    def test_sticky_primary_after_write(self):
+        res = self.c.post('/api/rest/newRestaurant/', dict(self.params, name='new one'))
+        self.assertEqual(200, res.status_code)
+
+        # the writer reads its own writes from the primary
+        self.assertEqual({'primary only', 'new one'}, set(self.restaurant_names()))
+
+        # other clients, and the writer once the pin expired, read from the replica again
+        self.params['user_token'] = self.tester.createToken()
+        self.assertEqual([], self.restaurant_names())
+
+    def test_export_streams_from_replica(self):
+        Restaurant(owner=self.tester, pocket=self.pocket, name='replica only').save(using='replica')
+
+        res = self.c.get('/api/rest/exportPocket/', self.params)
+        content = b''.join(res.streaming_content).decode()
+        self.assertIn('replica only', content)
+        self.assertNotIn('primary only', content)
+
+        # routing is reset once the response is consumed
+        self.assertTrue(Restaurant.objects.filter(name='primary only').exists())
+
+    def test_bootstrap_login_reads_primary(self):
+        res = self.c.get('/api/rest/bootstrap/', {'user_token': self.token})
+        self.assertEqual([], json.loads(res.content)['data']['restaurants'])
+
+        # the token it creates and the data it returns are on the primary
+        Account.objects.filter(pk=self.tester.pk).update(password=make_password('secret'))
+        res = self.c.post('/api/rest/bootstrap/', {'username': 'tester', 'password': 'secret'})
+        data = json.loads(res.content)['data']
+        self.assertEqual(['primary only'], [rest['restaurant_name'] for rest in data['restaurants']])
+
+    def test_recommend_lists_built_from_primary(self):
+        token = use_replica.set(True)
+        self.addCleanup(use_replica.reset, token)
+
+        # the stored list is served all day, a lagging replica would leave 'primary only' out of it
+        rest = Restaurant.objects.using('default').get(name='primary only')
+        rest.editStatus('ACTIVE')
+        rest.save()
+        self.assertEqual({self.pocket.id: [rest.id]}, DailyRecommendation.forPockets([self.pocket]))
+        self.assertEqual([rest.id], DailyRecommendation.objects.using('default').get().restaurantIds())
+        self.assertTrue(use_replica.get())
+
+    def test_router(self):
+        router = PrimaryReplicaRouter()
+        token = use_replica.set(True)
+        self.addCleanup(use_replica.reset, token)
+
+        self.assertEqual('replica', router.db_for_read(Restaurant))
+        self.assertEqual('default', router.db_for_read(TokenSystem))
+        self.assertEqual('default', router.db_for_write(Restaurant))
+
+
+@override_settings(DATABASE_SHARDS=['default', 'shard1'])
+class ShardingTestCase(TestCase):
+    """
+        the tester lives on shard1, so rows found on the default database
+        would be in the wrong place
+    """
+    databases = {'default', 'shard1'}
+
+    def setUp(self):
+        cache.clear()
+        self.c = Client()
+
+        self.tester = Account(username='tester', email='tester@test.com')
+        self.tester.save()
+        assign_shard(self.tester, 'shard1')
+        self.token = self.tester.createToken()
+        self.pocket = Pocket(owner=self.tester, name='My Pocket')
+        self.pocket.save()
+
+        self.params = {'user_token': self.token, 'pocket_uid': self.pocket.uid}
+
+    def restaurant_list(self):
+        res = self.c.get('/api/rest/getRestaurantList/', self.params)
+        self.assertEqual(200, res.status_code)
+        return json.loads(res.content)['data']
+
+    def test_account_data_on_its_shard(self):
+        self.assertTrue(TokenSystem.objects.using('shard1').filter(token=self.token).exists())
+        self.assertTrue(Pocket.objects.using('shard1').filter(pk=self.pocket.pk).exists())
+        self.assertFalse(TokenSystem.objects.using('default').exists())
+        self.assertFalse(Pocket.objects.using('default').exists())
+
+        # the account itself stays on the default database
+        self.assertEqual('default', Account.objects.get(pk=self.tester.pk)._state.db)
+
+    def test_requests_routed_by_token(self):
+        res = self.c.post('/api/rest/newRestaurant/', dict(self.params, name='sushi'))
+        self.assertEqual(200, res.status_code)
+
+        self.assertTrue(Restaurant.objects.using('shard1').filter(name='sushi').exists())
+        self.assertFalse(Restaurant.objects.using('default').exists())
+        self.assertEqual(['sushi'], [rest['restaurant_name'] for rest in self.restaurant_list()])
+
+    def test_unknown_token_cached(self):
+        params = dict(self.params, user_token='unknown')
+        self.assertEqual(401, self.c.get('/api/rest/getRestaurantList/', params).status_code)
+
+        # the shards are not asked again
+        with CaptureQueriesContext(connections['default']) as default, \
+                CaptureQueriesContext(connections['shard1']) as shard1:
+            self.assertEqual(401, self.c.get('/api/rest/getRestaurantList/', params).status_code)
+        self.assertFalse([query for query in default.captured_queries + shard1.captured_queries
+                          if 'SELECT (1) AS "a"' in query['sql']])
+
+    def test_shared_cache_check(self):
+        # rebalance runs in its own process, a per-process cache keeps the moved account on its old shard
+        self.assertEqual(['restaurant.E001'], [error.id for error in checks.check_shard_cache(None)])
+
+        dummy = {'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}}
+        with override_settings(CACHES=dummy):
+            self.assertEqual([], checks.check_shard_cache(None))
+        with override_settings(DATABASE_SHARDS=[]):
+            self.assertEqual([], checks.check_shard_cache(None))
+
+    def test_register_and_login(self):
+        res = self.c.post('/api/rest/registerAccount/', {
+            'username': 'newbie', 'password': 'secret', 'email': 'newbie@test.com'})
+        self.assertEqual(200, res.status_code)
+
+        newbie = Account.objects.get(username='newbie')
+        shard = AccountShard.objects.get(account_uid=newbie.uid).shard
+        self.assertEqual(1, Pocket.objects.using(shard).filter(owner_id=newbie.pk).count())
+
+        res = self.c.post('/api/rest/loginAccount/', {'username': 'newbie', 'password': 'secret'})
+        data = json.loads(res.content)['data']
+        self.assertTrue(TokenSystem.objects.using(shard).filter(token=data['token']).exists())
+
+        res = self.c.get('/api/rest/getPocketList/', {'user_token': data['token']})
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(1, len(json.loads(res.content)['data']))
+
+    def test_commands_find_pocket_shard(self):
+        Restaurant(owner=self.tester, pocket=self.pocket, name='ramen').save()
+
+        out = io.StringIO()
+        call_command('exportpocket', str(self.pocket.uid), stdout=out)
+        self.assertIn('ramen', out.getvalue())
+
+    def test_job_checkpoint_on_shard(self):
+        Restaurant(owner=self.tester, pocket=self.pocket, name='ramen').save()
+        target = Pocket(owner=self.tester, name='target')
+        target.save()
+        jobs.enqueue('copyRestaurants', self.tester, pocket_uid=str(target.uid), copy_from=str(self.pocket.uid))
+
+        # committed with the chunk on shard1, the job itself is on the default database
+        seen = []
+        checkpoint = Job.checkpoint
+
+        def observed(job, progress, total=None):
+            checkpoint(job, progress, total)
+            seen.append((list(JobCheckpoint.objects.using('shard1').values_list('progress', flat=True)),
+                         JobCheckpoint.objects.using('default').exists()))
+
+        with mock.patch.object(Job, 'checkpoint', observed):
+            self.assertEqual(1, jobs.run_pending())
+        self.assertEqual([([1], False)], seen)
+        self.assertEqual(Job.Status.DONE, Job.objects.get().status)
+        self.assertFalse(JobCheckpoint.objects.using('shard1').exists())
+
+    def test_rebalance(self):
+        restaurant = Restaurant(owner=self.tester, pocket=self.pocket, name='ramen')
+        restaurant.save()
+        restaurant.addVisitRecord(date(2020, 1, 1), 4)
+        self.restaurant_list()  # caches the shard of the token
+
+        out = io.StringIO()
+        call_command('rebalance', str(self.tester.uid), 'default', stdout=out)
+        self.assertIn('Moved 1 pockets, 1 restaurants, 1 visit records and 1 tokens', out.getvalue())
+
+        self.assertEqual('default', AccountShard.objects.get(account_uid=self.tester.uid).shard)
+        for model in (Pocket, Restaurant, VisitRecord, TokenSystem):
+            self.assertFalse(model.objects.using('shard1').exists())
+            self.assertEqual(1, model.objects.using('default').count())
+        self.assertFalse(Account.objects.using('shard1').exists())
+
+        # the token keeps working, and relations were remapped
+        restaurants = self.restaurant_list()
+        self.assertEqual(['ramen'], [rest['restaurant_name'] for rest in restaurants])
+        self.assertEqual(1, restaurants[0]['visit_count'])
+
+
+@override_settings(PURGE_PAUSE_SECONDS=0)
+class PurgeTestCase(TestCase):
+    def setUp(self):
+        self.tester = Account(username='tester', email='tester@test.com')
+        self.tester.save()
+        self.pocket = Pocket(owner=self.tester, name='My Pocket')
+        self.pocket.save()
+        longAgo = timezone.now() - timedelta(days=40)
+
+        # removed long ago together with its visit
+        self.old = self.restaurant('old', longAgo)
+        self.oldVisit = self.visit(self.old, longAgo)
+
+        # removed long ago, but one of its visits only recently
+        self.kept = self.restaurant('kept', longAgo)
+        self.visit(self.kept, timezone.now() - timedelta(days=5))
+
+        # removed before delete_time existed
+        self.visit(self.restaurant('active', None), None)
+
+        # removed long ago with everything in it
+        self.oldPocket = Pocket(owner=self.tester, name='old', status=Pocket.Status.DELETED,
+                                delete_time=longAgo)
+        self.oldPocket.save()
+        Restaurant(owner=self.tester, pocket=self.oldPocket, name='gone',
+                   status=Restaurant.Status.DELETED, delete_time=longAgo).save()
+
+    def restaurant(self, name, deleteTime):
+        restaurant = Restaurant(owner=self.tester, pocket=self.pocket, name=name)
+        if deleteTime is not None:
+            restaurant.status, restaurant.delete_time = Restaurant.Status.DELETED, deleteTime
+        restaurant.save()
+        return restaurant
+
+    def visit(self, restaurant, deleteTime):
+        visit = VisitRecord(restaurant=restaurant, owner=self.tester, visit_date=date(2020, 1, 1),
+                            status=VisitRecord.Status.DELETED, delete_time=deleteTime)
+        visit.save()
+        return visit
+
+    def test_remove_stamps_delete_time(self):
+        restaurant = self.restaurant('new', None)
+        restaurant.addVisitRecord(date(2020, 1, 1), 3)
+        self.pocket.remove()
+
+        self.assertIsNotNone(Pocket.objects.get(pk=self.pocket.pk).delete_time)
+        self.assertIsNotNone(Restaurant.objects.get(pk=restaurant.pk).delete_time)
+        self.assertIsNotNone(restaurant.visitrecord_set.get().delete_time)
+
+    def test_edit_status_stamps_delete_time(self):
+        restaurant = self.restaurant('new', None)
+        self.assertEqual((True, ''), restaurant.editStatus('DELETED'))
+        self.assertIsNotNone(restaurant.delete_time)
+
+        self.assertEqual((True, ''), self.pocket.editStatus('DELETED'))
+        self.assertIsNotNone(self.pocket.delete_time)
+
+    def test_dry_run(self):
+        out = io.StringIO()
+        call_command('purgedeleted', '--dry-run', stdout=out)
+        self.assertIn('Would purge 1 visit records, 2 restaurants and 1 pockets on default, '
+                      '1 removed rows without delete_time to stamp', out.getvalue())
+
+        self.assertEqual(4, Restaurant.objects.count())
+        self.assertTrue(VisitRecord.objects.filter(delete_time__isnull=True).exists())
+
+    def test_purge(self):
+        out = io.StringIO()
+        call_command('purgedeleted', '--archive', '--batch-size', '1', stdout=out)
+        self.assertIn('Archived 1 visit records, 2 restaurants and 1 pockets on default', out.getvalue())
+
+        self.assertEqual(['active', 'kept'], sorted(Restaurant.objects.values_list('name', flat=True)))
+        self.assertFalse(VisitRecord.objects.filter(pk=self.oldVisit.pk).exists())
+        self.assertEqual([self.pocket.pk], list(Pocket.objects.values_list('pk', flat=True)))
+
+        # unstamped rows get the full retention period from now on
+        self.assertFalse(VisitRecord.objects.filter(delete_time__isnull=True).exists())
+
+        archived = ArchivedRow.objects.get(uid=self.old.uid)
+        self.assertEqual('restaurant.restaurant', archived.model)
+        self.assertEqual('old', json.loads(archived.data)['name'])
+        self.assertEqual(4, ArchivedRow.objects.count())
+
+        # nothing left to purge
+        out = io.StringIO()
+        call_command('purgedeleted', stdout=out)
+        self.assertIn('Purged 0 visit records, 0 restaurants and 0 pockets', out.getvalue())
+
+
+class VisitSummaryTestCase(TestCase):
+    def setUp(self):
+        self.tester = Account(username='tester', email='tester@test.com')
+        self.tester.save()
+        self.pocket = Pocket(owner=self.tester, name='My Pocket')
+        self.pocket.save()
+        self.restaurant = Restaurant(owner=self.tester, pocket=self.pocket, name='ramen',
+                                     status=Restaurant.Status.ACTIVE)
+        self.restaurant.save()
+
+    def months(self, restaurant=None) -> dict:
+        return {summary.month: (summary.visit_count, summary.score_sum) for summary in
+                VisitSummary.objects.filter(restaurant=restaurant or self.restaurant, visit_count__gt=0)}
+
+    def test_kept_in_step(self):
+        self.restaurant.addVisitRecord(date(2020, 1, 5), 4)
+        self.restaurant.addVisitRecord(date(2020, 1, 20), 2)
+        self.restaurant.addVisitRecord(date(2020, 2, 1), 5)
+        self.assertEqual({date(2020, 1, 1): (2, 6), date(2020, 2, 1): (1, 5)}, self.months())
+
+        # moved to another month
+        record = self.restaurant.getVisitRecords().get(visit_date=date(2020, 1, 20))
+        record.edit(date(2020, 3, 3))
+        self.assertEqual({date(2020, 1, 1): (1, 4), date(2020, 2, 1): (1, 5),
+                          date(2020, 3, 1): (1, 2)}, self.months())
+
+        VisitRecord.objects.get(pk=record.pk).remove()
+        self.restaurant.getVisitRecords().get(visit_date=date(2020, 2, 1)).delete()
+        self.assertEqual({date(2020, 1, 1): (1, 4)}, self.months())
+
+        # the same as rebuilt from the records
+        VisitSummary.rebuild([self.restaurant.id])
+        self.assertEqual({date(2020, 1, 1): (1, 4)}, self.months())
+
+    def test_bulk_copy_and_backfill(self):
+        self.restaurant.addVisitRecord(date(2020, 1, 5), 4)
+        copy = Pocket(owner=self.tester, name='copy')
+        copy.save()
+        copy.copyRestaurants(self.pocket.getRestaurants(), deep=True)
+        self.assertEqual({date(2020, 1, 1): (1, 4)}, self.months(copy.getRestaurants().get()))
+
+        VisitSummary.objects.all().delete()
+        out = io.StringIO()
+        call_command('backfillsummaries', stdout=out)
+        self.assertIn('Rebuilt visit summaries of 2 restaurants on default', out.getvalue())
+        self.assertEqual({date(2020, 1, 1): (1, 4)}, self.months())
+
+    def test_recommend_rules_read_summaries(self):
+        today = date.today()
+        quiet = Restaurant(owner=self.tester, pocket=self.pocket, name='quiet',
+                           status=Restaurant.Status.ACTIVE)
+        quiet.save()
+        quiet.addVisitRecord(today - timedelta(days=400), 3)
+        for days in (1, 2):
+            self.restaurant.addVisitRecord(today - timedelta(days=days), 3)
+
+        # restaurants, summaries, and the recent visits of the one reaching a limit
+        with CaptureQueriesContext(connection) as queries:
+            snapshot = PocketSnapshot(self.pocket)
+            names = [rest.name for rest in snapshot.getRecommendList()]
+            counts = [snapshot.brief(rest)['visit_count'] for rest in snapshot.restaurants]
+        self.assertEqual(['quiet'], names)
+        self.assertEqual([2, 1], counts)
+        self.assertEqual(3, len(queries))
+        self.assertIn('"visit_date" >', queries[2]['sql'])
+
+
+class HiddenTestCase(TestCase):
+    def setUp(self):
+        self.tester = Account(username='tester', email='tester@test.com')
+        self.tester.save()
+        self.pocket = Pocket(owner=self.tester, name='My Pocket')
+        self.pocket.save()
+        self.restaurant = Restaurant(owner=self.tester, pocket=self.pocket, name='ramen',
+                                     status=Restaurant.Status.ACTIVE)
+        self.restaurant.save()
+
+    def test_save_flags_hidden(self):
+        self.assertFalse(self.restaurant.hidden)
+        self.restaurant.editHideUntil(str(date.today() + timedelta(days=2)))
+        self.restaurant.save(update_fields=['hide_until'])
+        self.assertTrue(Restaurant.objects.get(pk=self.restaurant.pk).hidden)
+        self.assertEqual('HIDE', self.restaurant.getStatusLabel())
+
+        self.restaurant.editStatus('RANDOM')
+        self.restaurant.save()
+        self.assertFalse(Restaurant.objects.get(pk=self.restaurant.pk).hidden)
+
+    def test_sync_hidden(self):
+        today = date.today()
+        self.restaurant.editHideUntil(str(today + timedelta(days=1)))
+        self.restaurant.save()
+        # saved before there was a hidden column
+        older = Restaurant(owner=self.tester, pocket=self.pocket, name='curry')
+        older.save()
+        Restaurant.objects.filter(pk=older.pk).update(hide_until=today + timedelta(days=3))
+
+        out = io.StringIO()
+        call_command('unhiderestaurants', stdout=out)
+        self.assertIn('Showed 0 and hid 1 restaurants on default', out.getvalue())
+        self.assertTrue(Restaurant.objects.get(pk=older.pk).hidden)
+        self.assertEqual([], [rest.name for rest in PocketSnapshot(self.pocket).getRecommendList()])
+
+        # the next day the first one shows again, and so do its recommendations
+        self.assertEqual((1, 0), Restaurant.syncHidden(today + timedelta(days=1)))
+        self.assertEqual('ACTIVE', Restaurant.objects.get(pk=self.restaurant.pk).getStatusLabel())
+        self.assertEqual(['ramen'], [rest.name for rest in PocketSnapshot(self.pocket).getRecommendList()])
+        self.assertEqual((0, 0), Restaurant.syncHidden(today + timedelta(days=1)))
+
+    def test_hide_until_passed_before_sync(self):
+        # flagged yesterday, unhiderestaurants has not run yet today
+        Restaurant.objects.filter(pk=self.restaurant.pk).update(
+            hidden=True, hide_until=date.today() - timedelta(days=1))
+
+        self.assertEqual('ACTIVE', Restaurant.objects.get(pk=self.restaurant.pk).getStatusLabel())
+        self.assertEqual(['ramen'], [rest.name for rest in PocketSnapshot(self.pocket).getRecommendList()])
+        self.assertEqual(['ramen'], [rest.name for rest in PocketSnapshot.recommendMany(
+            PocketSnapshot.many([self.pocket], ('restaurant_uid',)))[0]])
+
+
+QUERY_PLAN_BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'query_plans.json')
+
+
+def normalize_sql(sql: str) -> str:
+    """
+        statement with its literals replaced by ?, lists of them (IN, VALUES) by one (?)
+        and the rows of a bulk insert (SELECT ... UNION ALL SELECT ...) by one SELECT ?
+    """
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    sql = re.sub(r'(?<![\w."])-?\d+(?:\.\d+)?\b', '?', sql)
+    item = r'(?:\?|NULL)'
+    sql = re.sub(r'\(%s(?:, %s)*\)' % (item, item), '(?)', sql)
+    sql = re.sub(r'\(\?\)(?:, \(\?\))+', '(?)', sql)
+    return re.sub(r'SELECT {0}(?:, {0})*(?: UNION ALL SELECT {0}(?:, {0})*)*$'.format(item), 'SELECT ?', sql)
+
+
+def explain(conn, sql: str) -> list:
+    with conn.cursor() as cursor:
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+        # older sqlite versions write SCAN TABLE t / SEARCH TABLE t
+        return [re.sub(r'^(SCAN|SEARCH) TABLE ', r'\1 ', row[3]) for row in cursor.fetchall()]
+
+
+def scanned_tables(plan: list) -> set:
+    """
+        tables read from start to end, through the table or a whole index
+    """
+    tables = set()
+    for detail in plan:
+        match = re.match(r'SCAN (\w+)', detail)
+        if match and match.group(1) not in ('CONSTANT', 'SUBQUERY'):
+            tables.add(match.group(1))
+    return tables
+
+
+class QueryPlanTestCase(TestCase):
+    """
+        every statement of every endpoint in restaurant/urls.py and its
+        EXPLAIN QUERY PLAN are compared with restaurant/query_plans.json,
+        a statement which is new or scans a table it used to search fails the test
+
+        after an intended change rewrite the baselines with
+        UPDATE_QUERY_PLANS=1 python manage.py test restaurant.test_db.QueryPlanTestCase
+    """
+
+    def setUp(self):
+        self.tester = Account(username='tester', password=make_password('secret'), email='tester@test.com')
+        self.tester.save()
+        self.tester.initAccount()
+        self.token = self.tester.createToken()
+        self.pocket = self.tester.pocket_set.first()
+        self.other = Pocket(owner=self.tester, name='2nd pocket')
+        self.other.save()
+
+        today = date.today()
+        Restaurant.objects.bulk_create([
+            Restaurant(owner=self.tester, pocket=pocket, name='%s %d' % (pocket.name, i),
+                       status=Restaurant.Status.ACTIVE if i % 2 else Restaurant.Status.RANDOM)
+            for pocket in (self.pocket, self.other) for i in range(20)
+        ])
+        ids = list(Restaurant.objects.values_list('id', flat=True))
+        VisitRecord.objects.bulk_create([
+            VisitRecord(restaurant_id=ids[i % len(ids)], owner=self.tester,
+                        visit_date=today - timedelta(days=i % 90), score=i % 5 + 1)
+            for i in range(400)
+        ])
+        Restaurant.updateLastVisits(ids)
+        VisitSummary.rebuild(ids)
+
+        self.restaurant = self.pocket.getRestaurants().first()
+        self.visit = self.restaurant.getVisitRecords().first()
+        self.job = jobs.enqueue('removePocket', self.tester, pocket_uid=str(self.other.uid))
+
+    def endpoints(self) -> dict:
+        """
+            url name -> (method, params) of a successful request
+        """
+        user = {'user_token': self.token}
+        pocket = dict(user, pocket_uid=self.pocket.uid)
+        restaurant = dict(user, restaurant_uid=self.restaurant.uid)
+        visit = dict(user, visitrecord_uid=self.visit.uid)
+        upload = SimpleUploadedFile('visits.csv', (
+            'restaurant_name,visit_date,score\n'
+            '%s,2020-01-01,3\n'
+            'imported,2020-01-02,4\n' % self.restaurant.name).encode('utf-8'))
+        return {
+            'registerAccount': ('post', {'username': 'newbie', 'password': 'secret', 'email': 'newbie@test.com'}),
+            'loginAccount': ('post', {'username': 'tester', 'password': 'secret'}),
+            'bootstrap': ('get', user),
+            'getPocketList': ('get', user),
+            'newPocket': ('post', dict(user, name='copy', copy_from=self.pocket.uid,
+                                       deep_copy_restaurants='true')),
+            'editPocket': ('post', dict(pocket, name='renamed')),
+            'removePocket': ('post', pocket),
+            'exportPocket': ('get', pocket),
+            'getRecommendList': ('get', pocket),
+            'getRecommendLists': ('get', user),
+            'getRestaurantList': ('get', pocket),
+            'newRestaurant': ('post', dict(pocket, name='new restaurant')),
+            'editRestaurant': ('post', dict(restaurant, note='new note', status='ACTIVE')),
+            'removeRestaurant': ('post', restaurant),
+            'getVisitRecords': ('get', pocket),
+            'getVisitStats': ('get', pocket),
+            'newVisit': ('post', dict(restaurant, visit_date='2020-01-01', score=4)),
+            'editVisitRecord': ('post', dict(visit, visit_date='2020-01-02')),
+            'removeVisitRecord': ('post', visit),
+            'importVisitRecords': ('post', dict(pocket, file=upload)),
+            'getJob': ('get', dict(user, job_uid=self.job.uid)),
+        }
+
+    def capture(self, name: str, method: str, params: dict) -> dict:
+        """
+            normalized statements of one request -> their query plans,
+            the changes of the request are rolled back afterwards
+        """
+        for alias in settings.CACHES:
+            caches[alias].clear()
+
+        client = Client()
+        with transaction.atomic():
+            with CaptureQueriesContext(connection) as queries:
+                res = getattr(client, method)(reverse(name), params)
+                if res.streaming:
+                    b''.join(res.streaming_content)
+            self.assertLess(res.status_code, 300, name)
+            transaction.set_rollback(True)
+
+        plans = {}
+        for query in queries:
+            sql = query['sql']
+            if sql.split(' ', 1)[0].upper() not in ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH'):
+                continue
+            statement = normalize_sql(sql)
+            if statement not in plans:
+                # inserts read no table
+                plans[statement] = explain(connection, sql) if not sql.startswith('INSERT') else []
+        return plans
+
+    def test_query_plans(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('the baselines are EXPLAIN QUERY PLAN output of sqlite')
+
+        endpoints = self.endpoints()
+        names = [pattern.name for pattern in urlpatterns]
+        self.assertEqual([], [name for name in names if name not in endpoints],
+                         'add a request of the new endpoints to QueryPlanTestCase.endpoints')
+        current = {name: self.capture(name, *endpoints[name]) for name in names}
+
+        if os.environ.get('UPDATE_QUERY_PLANS'):
+            with open(QUERY_PLAN_BASELINES, 'w') as f:
+                json.dump(current, f, indent=2, sort_keys=True)
+                f.write('\n')
+            return
+
+        with open(QUERY_PLAN_BASELINES) as f:
+            baselines = json.load(f)
+
+        problems = []
+        for name, plans in current.items():
+            baseline = baselines.get(name, {})
+            for statement, plan in plans.items():
+                if statement not in baseline:
+                    problems.append('%s: new statement %s\n    %s' % (name, statement, '\n    '.join(plan)))
+                    continue
+                for table in sorted(scanned_tables(plan) - scanned_tables(baseline[statement])):
+                    problems.append('%s: scans %s in %s\n    %s' % (
+                        name, table, statement, '\n    '.join(plan)))
+
+        self.assertEqual([], problems, '\n' + '\n'.join(problems) +
+                         '\nrewrite the baselines with UPDATE_QUERY_PLANS=1 when intended')
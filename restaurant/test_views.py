@@ -1,9 +1,34 @@
-from django.test import TestCase, Client
-from restaurant.models import Restaurant, VisitRecord, Account, TokenSystem, Pocket
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, Client, RequestFactory, \
+    override_settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.management import call_command
+from django.db import OperationalError, connection
+from django.test.utils import CaptureQueriesContext
+from restaurant.models import Restaurant, VisitRecord, Account, TokenSystem, Pocket, PocketSnapshot, Job, \
+    JobCheckpoint, DailyRecommendation
+from restaurant import checks, views, async_views, reads, response_cache, compression, jobs, metrics, profiling
+from restaurant.middleware import MetricsMiddleware, ProfilingMiddleware
+from restaurant.asgi import StreamingASGIHandler
+from urllib.parse import urlencode
+from unittest import mock
+from django.urls import path
+from restaurant.sharding import current_shard
+from restaurant.singleflight import SingleFlight
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import threading
+import time
+import random
+from asgiref.sync import async_to_sync
 from django.utils import timezone
 from datetime import date
+import gzip
 import json
 import uuid
+import io
+import os
+import tempfile
 from django.contrib.auth.hashers import check_password, make_password
 
 tester_data = {
@@ -69,6 +94,99 @@ class RestaurantApiTestCase(TestCase):
         self.assertEqual(Pocket.objects.get(
             uid=content['pocket_uid']).name, data['name'])
 
+    def test_copy_pocket(self):
+        """
+            Copy all restaurants of a pocket, with and without visit records
+        """
+        other = Restaurant(owner=self.tester, pocket=self.myPocket, name='other')
+        other.save()
+        other.addVisitRecord(date(2020, 1, 1), 4)
+
+        # shallow copy of selected restaurants
+        res = self.c.post('/api/rest/newPocket/', {
+            'name': 'shallow',
+            'user_token': self.token,
+            'copy_restaurants': json.dumps([str(other.uid)]),
+        })
+        self.assertEqual(200, res.status_code)
+        shallow = Pocket.objects.get(
+            uid=json.loads(res.content)['data']['pocket_uid'])
+        self.assertEqual(['other'], [r.name for r in shallow.getRestaurants()])
+        self.assertIsNone(shallow.getRestaurants().first().last_visit)
+        self.assertEqual(0, VisitRecord.objects.filter(
+            restaurant__pocket=shallow).count())
+
+        # deep copy of a whole pocket
+        res = self.c.post('/api/rest/newPocket/', {
+            'name': 'deep',
+            'user_token': self.token,
+            'copy_from': self.myPocket.uid,
+            'deep_copy_restaurants': 'true',
+        })
+        self.assertEqual(200, res.status_code)
+        content = json.loads(res.content)['data']
+        self.assertEqual(2, content['size'])
+
+        deep = Pocket.objects.get(uid=content['pocket_uid'])
+        copy = deep.getRestaurants().get(name='other')
+        self.assertNotEqual(other.uid, copy.uid)
+        self.assertEqual(date(2020, 1, 1), copy.last_visit)
+        self.assertEqual([(date(2020, 1, 1), 4)], list(
+            copy.getVisitRecords().values_list('visit_date', 'score')))
+
+        # the source pocket is not touched
+        self.assertEqual(2, self.myPocket.getRestaurants().count())
+        self.assertEqual(2, VisitRecord.objects.filter(
+            restaurant__pocket=self.myPocket).count())
+
+    def test_copy_pocket_queries(self):
+        """
+            Deep copy runs a constant number of queries per chunk
+        """
+        def countQueries(name):
+            with CaptureQueriesContext(connection) as ctx:
+                newPocket = self.tester.pocket_set.create(name=name)
+                newPocket.copyRestaurants(self.myPocket.getRestaurants(), deep=True)
+            return len(ctx.captured_queries)
+
+        small = countQueries('small')
+
+        for i in range(20):
+            rest = Restaurant(owner=self.tester, pocket=self.myPocket,
+                              name='restaurant %d' % i)
+            rest.save()
+            for day in range(1, 6):
+                rest.visitrecord_set.create(
+                    owner=self.tester, visit_date=date(2020, 1, day))
+
+        self.assertEqual(small, countQueries('large'))
+        self.assertEqual(101, VisitRecord.objects.filter(
+            restaurant__pocket__name='large').count())
+
+    def test_copy_pocket_error(self):
+        """
+            Copy from a pocket owned by others or with malformed parameters
+        """
+        stranger = Account(username='stranger', email='stranger@test.com')
+        stranger.save()
+        stranger.initAccount()
+
+        res = self.c.post('/api/rest/newPocket/', {
+            'name': 'steal',
+            'user_token': self.token,
+            'copy_from': stranger.pocket_set.first().uid,
+        })
+        self.assertEqual(404, res.status_code)
+
+        res = self.c.post('/api/rest/newPocket/', {
+            'name': 'malformed',
+            'user_token': self.token,
+            'copy_restaurants': '{"a": 1}',
+        })
+        self.assertEqual(400, res.status_code)
+        self.assertFalse(Pocket.objects.filter(
+            name__in=['steal', 'malformed']).exists())
+
     def test_edit_pocket(self):
         """
             Basic functional test from editPocket api
@@ -367,6 +485,10 @@ class RestaurantApiTestCase(TestCase):
         self.assertEqual(0, VisitRecord.objects.select_related(
             'restaurant').filter(restaurant=self.myRest).exclude(status=VisitRecord.Status.DELETED).count())
 
+        # purgedeleted keeps removed rows for the retention period from delete_time
+        self.assertIsNotNone(Restaurant.objects.get(pk=self.myRest.pk).delete_time)
+        self.assertFalse(VisitRecord.objects.filter(restaurant=self.myRest, delete_time__isnull=True).exists())
+
     def test_remove_visit(self):
         """
             Test Basic removing a visit record
@@ -486,6 +608,594 @@ class RestaurantApiTestCase(TestCase):
     def test_new_restaurant_error(self):
         pass
 
+    def test_get_restaurant_list(self):
+        """
+            @brief: Basic functional test for getRestaurantList api
+            @target: getRestaurantList
+        """
+        older = Restaurant(owner=self.tester, pocket=self.myPocket, name='older')
+        older.save()
+        older.addVisitRecord(date(2020, 1, 1), 3)
+        older.addVisitRecord(date(2020, 2, 1), 3)
+        Restaurant(owner=self.tester, pocket=self.myPocket, name='removed',
+                   status=Restaurant.Status.DELETED).save()
+
+        res = self.c.get('/api/rest/getRestaurantList/', {
+            'user_token': self.token,
+            'pocket_uid': self.myPocket.uid,
+        })
+        self.assertEqual(200, res.status_code)
+
+        content = json.loads(res.content)['data']
+        self.assertEqual([self.myRest.name, 'older'],
+                         [rest['restaurant_name'] for rest in content])
+        self.assertEqual(['2020-02-01', '2020-01-01'], content[1]['visit_dates'])
+        self.assertEqual(2, content[1]['visit_count'])
+
+    def test_compact_format(self):
+        """
+            @brief: format=compact carries the same data as column arrays
+            @target: getRestaurantList, getVisitRecords
+        """
+        other = Restaurant(owner=self.tester, pocket=self.myPocket, name='other')
+        other.save()
+        for day in range(1, 29):
+            other.addVisitRecord(date(2020, 2, day), 3)
+
+        params = {'user_token': self.token, 'pocket_uid': self.myPocket.uid}
+
+        def get(endpoint, **extra):
+            res = self.c.get('/api/rest/%s/' % endpoint, dict(params, **extra))
+            self.assertEqual(200, res.status_code)
+            return res, json.loads(res.content)['data']
+
+        def day(offset):
+            return str(date.fromordinal(date(1970, 1, 1).toordinal() + offset))
+
+        # restaurant list, visit dates of all restaurants back to back
+        plainRes, plain = get('getRestaurantList')
+        compactRes, packed = get('getRestaurantList', format='compact')
+        self.assertEqual('compact', packed['format'])
+        dates = iter(packed['visit_dates'])
+        for i, rest in enumerate(plain):
+            self.assertEqual(rest['restaurant_uid'], packed['restaurant_uid'][i])
+            self.assertEqual(rest['note'], packed['note'][i])
+            self.assertEqual(rest['hide_until'], day(packed['hide_until'][i]))
+            self.assertEqual(rest['visit_dates'],
+                             [day(next(dates)) for _ in range(packed['visit_count'][i])])
+        self.assertLess(len(compactRes.content), len(plainRes.content))
+
+        # visit records refer to the restaurants dictionary
+        plainRes, plain = get('getVisitRecords')
+        compactRes, packed = get('getVisitRecords', format='compact')
+        self.assertEqual(2, len(packed['restaurants']['restaurant_uid']))
+        self.assertEqual(
+            [(record['restaurant_name'], record['visit_date']) for record in plain],
+            [(packed['restaurants']['restaurant_name'][ref], day(offset))
+             for ref, offset in zip(packed['restaurant'], packed['visit_date'])])
+        self.assertLess(len(compactRes.content), len(plainRes.content) / 2)
+
+        res = self.c.get('/api/rest/getVisitRecords/', dict(params, format='xml'))
+        self.assertEqual(400, res.status_code)
+
+    def test_sparse_fields(self):
+        """
+            @brief: fields= limits the output and the loaded columns, visit records are skipped without visit fields
+            @target: getRestaurantList, getRecommendList
+        """
+        older = Restaurant(owner=self.tester, pocket=self.myPocket, name='older', note='x' * 1000)
+        older.save()
+        older.addVisitRecord(date(2020, 1, 1), 3)
+        self.myRest.updateLastVisit()  # setUp saved its visit directly
+
+        # without visit fields the order comes from last_visit, the same as with them
+        params = {'user_token': self.token, 'pocket_uid': self.myPocket.uid}
+        names = [rest['restaurant_name'] for rest in json.loads(self.c.get(
+            '/api/rest/getRestaurantList/', params).content)['data']]
+        self.assertEqual([self.myRest.name, 'older'], names)
+
+        res = self.c.get('/api/rest/getRestaurantList/', dict(params, fields='restaurant_name,status'))
+        self.assertEqual(200, res.status_code)
+        content = json.loads(res.content)['data']
+        self.assertEqual([{'restaurant_name': self.myRest.name, 'status': 'RANDOM'},
+                          {'restaurant_name': 'older', 'status': 'RANDOM'}], content)
+
+        with CaptureQueriesContext(connection) as queries:
+            PocketSnapshot(self.myPocket, ('restaurant_name', 'status')).getRestaurantList()
+        self.assertEqual(1, len(queries))
+        self.assertNotIn('"note"', queries[0]['sql'])
+
+        with CaptureQueriesContext(connection) as queries:
+            PocketSnapshot(self.myPocket, ('restaurant_name', 'visit_count')).getRestaurantList()
+        self.assertEqual(2, len(queries))
+
+        res = self.c.get('/api/rest/getRecommendList/', dict(params, fields='restaurant_uid'))
+        self.assertEqual(200, res.status_code)
+        for rest in json.loads(res.content)['data']:
+            self.assertEqual(['restaurant_uid'], list(rest))
+
+        for bad in ('note,bogus', ''):
+            res = self.c.get('/api/rest/getRestaurantList/', dict(params, fields=bad))
+            self.assertEqual(400, res.status_code)
+
+    def test_response_cache(self):
+        """
+            @brief: Read responses are cached per account until one of its rows changes
+            @target: getRestaurantList, getPocketList
+        """
+        params = {'user_token': self.token, 'pocket_uid': self.myPocket.uid}
+
+        def get_list(token=self.token):
+            res = self.c.get('/api/rest/getRestaurantList/', dict(params, user_token=token))
+            self.assertEqual(200, res.status_code)
+            return res['X-Cache'], json.loads(res.content)['data']
+
+        self.assertEqual('MISS', get_list()[0])
+        hits = response_cache.stats()['hits']
+        self.assertEqual('HIT', get_list()[0])
+        self.assertEqual(hits + 1, response_cache.stats()['hits'])
+
+        # another device of the same account shares the entry
+        self.assertEqual('HIT', get_list(self.tester.createToken())[0])
+
+        # post_save drops it
+        self.c.post('/api/rest/newVisit/', {'restaurant_uid': self.myRest.uid, 'user_token': self.token})
+        state, content = get_list()
+        self.assertEqual('MISS', state)
+        self.assertEqual(self.visitCount + 1, content[0]['visit_count'])
+
+        # so do bulk inserts, which send no signals
+        self.myPocket.copyRestaurants(Restaurant.objects.filter(pk=self.myRest.pk))
+        state, content = get_list()
+        self.assertEqual('MISS', state)
+        self.assertEqual(2, len(content))
+
+        # pockets of other accounts are not affected
+        res = self.c.get('/api/rest/getPocketList/', {'user_token': self.token})
+        self.assertEqual('MISS', res['X-Cache'])
+        other = Account(username='other', email='other@test.com')
+        other.save()
+        other.initAccount()
+        res = self.c.get('/api/rest/getPocketList/', {'user_token': self.token})
+        self.assertEqual('HIT', res['X-Cache'])
+
+        # stats are for staff only
+        self.assertEqual(401, self.c.get('/ops/cacheStats/').status_code)
+
+        # versions bumped by other processes (workers, runjobs) need a shared cache
+        self.assertEqual(['restaurant.W001'], [warning.id for warning in checks.check_response_cache(None)])
+        with override_settings(RESPONSE_CACHE_SECONDS=0):
+            self.assertEqual([], checks.check_response_cache(None))
+
+    def test_visit_stats(self):
+        """
+            @brief: Grouped visit statistics of a pocket
+            @target: getVisitStats
+        """
+        other = Restaurant(owner=self.tester, pocket=self.myPocket, name='other')
+        other.save()
+        other.addVisitRecord(date(2020, 1, 6), 4)  # Monday
+        other.addVisitRecord(date(2020, 1, 12), 1)  # Sunday
+        other.addVisitRecord(date(2020, 2, 3), 5)  # Monday
+        other.getVisitRecords().get(visit_date=date(2020, 2, 3)).remove()
+
+        params = {'user_token': self.token, 'pocket_uid': self.myPocket.uid,
+                  'date_from': '2020-01-01', 'date_to': '2020-01-31'}
+        res = self.c.get('/api/rest/getVisitStats/', params)
+        self.assertEqual(200, res.status_code)
+        content = json.loads(res.content)['data']
+
+        self.assertEqual([('other', 2, 2.5), (self.myRest.name, 1, 3.0)], [
+            (rest['restaurant_name'], rest['visit_count'], rest['average_score'])
+            for rest in content['restaurants']])
+
+        thisMonth = date.today().strftime('%Y-%m')
+        self.assertEqual([('2020-01', 2, 2.5), (thisMonth, 1, 3.0)], [
+            (month['month'], month['visit_count'], month['average_score'])
+            for month in content['months']])
+
+        weekdays = {day['weekday']: day['visit_count'] for day in content['weekdays']}
+        self.assertEqual(7, len(weekdays))
+        # the setUp visit is today
+        self.assertEqual(1 + (date.today().isoweekday() == 1), weekdays[1])
+        self.assertEqual(1 + (date.today().isoweekday() == 7), weekdays[7])
+
+        self.assertEqual({'2020-01-06': 1, '2020-01-12': 1}, content['heatmap']['days'])
+
+        # the last 365 days by default
+        res = self.c.get('/api/rest/getVisitStats/', {'user_token': self.token, 'pocket_uid': self.myPocket.uid})
+        heatmap = json.loads(res.content)['data']['heatmap']
+        self.assertEqual({date.today().isoformat(): 1}, heatmap['days'])
+
+        for bad in ({'date_from': '2020/01/01'}, {'date_from': '2020-02-01', 'date_to': '2020-01-01'}):
+            res = self.c.get('/api/rest/getVisitStats/', dict(params, **bad))
+            self.assertEqual(400, res.status_code, bad)
+
+    def test_get_recommend_list(self):
+        """
+            @brief: Recommend rules, visited too often or hidden restaurants are not recommended
+            @target: getRecommendList
+        """
+        self.myRest.editStatus('ACTIVE')
+        self.myRest.save()
+        self.myRest.addVisitRecord(date.today(), 3)  # 2 visits in 7 days
+
+        fresh = Restaurant(owner=self.tester, pocket=self.myPocket, name='fresh',
+                           status=Restaurant.Status.ACTIVE)
+        fresh.save()
+        Restaurant(owner=self.tester, pocket=self.myPocket, name='hidden',
+                   status=Restaurant.Status.ACTIVE, hide_until=date(2100, 1, 1)).save()
+
+        res = self.c.get('/api/rest/getRecommendList/', {
+            'user_token': self.token,
+            'pocket_uid': self.myPocket.uid,
+        })
+        self.assertEqual(200, res.status_code)
+
+        content = json.loads(res.content)['data']
+        self.assertEqual(['fresh'], [rest['restaurant_name'] for rest in content])
+        self.assertEqual(0, content[0]['visit_count'])
+
+    def test_recommend_list_seeded(self):
+        """
+            @brief: RANDOM decisions are drawn from a generator seeded by user, day and restaurant,
+                the list is cached
+            @target: getRecommendList
+        """
+        self.myRest.remove()
+        rests = []
+        for i in range(20):
+            rest = Restaurant(owner=self.tester, pocket=self.myPocket, name='random %d' % i,
+                              status=Restaurant.Status.RANDOM)
+            rest.save()
+            rests.append(rest)
+
+        today = date.today()
+        expected = [rest.name for rest in rests if random.Random('%s:%s:%s' % (
+            self.tester.pk, today.isoformat(), rest.uid)).randrange(1, 100) > PocketSnapshot.randThreshold]
+
+        params = {'user_token': self.token, 'pocket_uid': self.myPocket.uid}
+        res = self.c.get('/api/rest/getRecommendList/', params)
+        names = [rest['restaurant_name'] for rest in json.loads(res.content)['data']]
+        self.assertEqual(sorted(expected), sorted(names))
+
+        res = self.c.get('/api/rest/getRecommendList/', params)
+        self.assertEqual('HIT', res['X-Cache'])
+        res = self.c.get('/api/rest/getRecommendList/', params, HTTP_IF_NONE_MATCH=res['ETag'])
+        self.assertEqual(304, res.status_code)
+
+        # another day, other decisions
+        snapshot = PocketSnapshot(self.myPocket)
+        self.assertEqual(sorted(names), sorted(rest.name for rest in snapshot.getRecommendList(today)))
+        self.assertNotEqual(sorted(names), sorted(
+            rest.name for rest in snapshot.getRecommendList(today + timezone.timedelta(days=1))))
+
+        # one more restaurant changes no other decision
+        Restaurant(owner=self.tester, pocket=self.myPocket, name='another',
+                   status=Restaurant.Status.RANDOM).save()
+        snapshot = PocketSnapshot(self.myPocket)
+        self.assertEqual(sorted(names), sorted(
+            rest.name for rest in snapshot.getRecommendList(today) if rest.name != 'another'))
+
+    def test_recommend_lists(self):
+        """
+            @brief: recommend lists of several pockets in one request, same as one pocket at a time
+            @target: getRecommendLists
+        """
+        self.myRest.editStatus('ACTIVE')
+        self.myRest.save()
+        pockets = [self.myPocket]
+        for i in range(3):
+            pocket = self.tester.pocket_set.create(name='pocket %d' % i)
+            pockets.append(pocket)
+            for j in range(3):
+                rest = Restaurant(owner=self.tester, pocket=pocket, name='rest %d %d' % (i, j),
+                                  status=Restaurant.Status.ACTIVE)
+                rest.save()
+                for day in range(j * 3):
+                    rest.addVisitRecord(date.today() - timezone.timedelta(days=day), 3)
+
+        res = self.c.get('/api/rest/getRecommendLists/', {'user_token': self.token})
+        self.assertEqual(200, res.status_code)
+        content = json.loads(res.content)['data']
+        self.assertEqual([str(pocket.uid) for pocket in pockets], [item['pocket_uid'] for item in content])
+        for pocket, item in zip(pockets, content):
+            single = self.c.get('/api/rest/getRecommendList/',
+                                {'user_token': self.token, 'pocket_uid': pocket.uid})
+            self.assertEqual(json.loads(single.content)['data'], item['recommendations'], pocket.name)
+        # regulars of the last visits are left out
+        self.assertEqual(['rest 0 0'], [rest['restaurant_name'] for rest in content[1]['recommendations']])
+
+        # restaurants, summaries and one grouped visit window query, however many pockets
+        with CaptureQueriesContext(connection) as queries:
+            PocketSnapshot.recommendMany(PocketSnapshot.many(pockets))
+        self.assertEqual(3, len(queries))
+        self.assertIn('GROUP BY', queries[2]['sql'])
+
+        subset = ','.join(str(pocket.uid) for pocket in pockets[2:])
+        res = self.c.get('/api/rest/getRecommendLists/', {'user_token': self.token, 'pocket_uids': subset})
+        self.assertEqual(['pocket 1', 'pocket 2'], [item['name'] for item in json.loads(res.content)['data']])
+
+        res = self.c.get('/api/rest/getRecommendLists/', {'user_token': self.token,
+                                                          'pocket_uids': str(uuid.uuid4())})
+        self.assertEqual(404, res.status_code)
+        res = self.c.get('/api/rest/getRecommendLists/', {'user_token': self.token, 'pocket_uids': 'abc'})
+        self.assertEqual(400, res.status_code)
+        res = self.c.get('/api/rest/getRecommendLists/', {'user_token': 'wrong'})
+        self.assertEqual(401, res.status_code)
+
+    def test_recommend_list_precomputed(self):
+        """
+            @brief: recommend lists are served from the precomputed list of the day,
+                    which changes of restaurants and visit records of the pocket drop
+            @target: getRecommendList
+        """
+        self.myRest.editStatus('ACTIVE')
+        self.myRest.save()
+        for i in range(10):
+            Restaurant(owner=self.tester, pocket=self.myPocket, name='rest %d' % i,
+                       status=Restaurant.Status.ACTIVE).save()
+
+        out = io.StringIO()
+        call_command('precomputerecommendations', stdout=out)
+        self.assertIn('Precomputed recommend lists of 1 pockets on default', out.getvalue())
+        stored = DailyRecommendation.objects.get(pocket=self.myPocket)
+        self.assertEqual(date.today(), stored.day)
+        self.assertEqual(11, len(stored.restaurantIds()))
+
+        # the stored list, the recommended restaurants and their summaries
+        params = {'user_token': self.token, 'pocket_uid': self.myPocket.uid}
+        with CaptureQueriesContext(connection) as queries:
+            PocketSnapshot.precomputed([self.myPocket])
+        self.assertEqual(3, len(queries))
+        res = self.c.get('/api/rest/getRecommendList/', params)
+        self.assertEqual(11, len(json.loads(res.content)['data']))
+
+        # a visit drops the list, the next read builds it again
+        rest = self.myPocket.restaurant_set.get(name='rest 0')
+        rest.addVisitRecord(date.today(), 3)
+        rest.addVisitRecord(date.today(), 3)
+        self.assertFalse(DailyRecommendation.objects.filter(pocket=self.myPocket).exists())
+        res = self.c.get('/api/rest/getRecommendList/', params)
+        names = [item['restaurant_name'] for item in json.loads(res.content)['data']]
+        self.assertEqual(10, len(names))
+        self.assertNotIn('rest 0', names)
+        self.assertTrue(DailyRecommendation.objects.filter(pocket=self.myPocket).exists())
+
+        # so does hiding a restaurant
+        rest = self.myPocket.restaurant_set.get(name='rest 1')
+        rest.hide_until = date.today() + timezone.timedelta(days=3)
+        rest.save()
+        res = self.c.get('/api/rest/getRecommendList/', params)
+        self.assertEqual(9, len(json.loads(res.content)['data']))
+
+        # so does an import, which bulk inserts the visit records
+        upload = SimpleUploadedFile('visits.csv', (
+            'restaurant_name,visit_date,score\n'
+            'rest 2,%s,3\n'
+            'rest 2,%s,3\n' % (date.today(), date.today())
+        ).encode('utf-8'))
+        res = self.c.post('/api/rest/importVisitRecords/', dict(params, file=upload))
+        self.assertEqual(200, res.status_code)
+        self.assertFalse(DailyRecommendation.objects.filter(pocket=self.myPocket).exists())
+        res = self.c.get('/api/rest/getRecommendList/', params)
+        names = [item['restaurant_name'] for item in json.loads(res.content)['data']]
+        self.assertEqual(8, len(names))
+        self.assertNotIn('rest 2', names)
+
+        # a list of another day is built again
+        DailyRecommendation.objects.update(day=date(2020, 1, 1), restaurants='')
+        snapshot = PocketSnapshot.precomputed([self.myPocket])[0]
+        self.assertEqual(8, len(snapshot.restaurants))
+
+    def test_bootstrap(self):
+        """
+            @brief: bootstrap returns the same data as the separate launch requests
+            @target: bootstrap
+        """
+        self.myRest.editStatus('ACTIVE')
+        self.myRest.save()
+        secondPocket = self.tester.pocket_set.create(name='2nd pocket')
+
+        expected = {}
+        for api in ('getRestaurantList', 'getRecommendList'):
+            res = self.c.get('/api/rest/%s/' % api, {
+                'user_token': self.token,
+                'pocket_uid': self.myPocket.uid,
+            })
+            expected[api] = json.loads(res.content)['data']
+
+        with CaptureQueriesContext(connection) as ctx:
+            res = self.c.get('/api/rest/bootstrap/', {'user_token': self.token})
+        self.assertEqual(200, res.status_code)
+        self.assertLessEqual(len(ctx.captured_queries), 6)
+
+        content = json.loads(res.content)['data']
+        self.assertEqual(self.token, content['token'])
+        self.assertEqual(str(self.myPocket.uid), content['last_pocket']['pocket_uid'])
+        self.assertEqual([(str(self.myPocket.uid), 1), (str(secondPocket.uid), 0)],
+                         [(p['pocket_uid'], p['size']) for p in content['pockets']])
+        self.assertEqual(expected['getRestaurantList'], content['restaurants'])
+        self.assertEqual(expected['getRecommendList'], content['recommendations'])
+
+        # login with password
+        res = self.c.post('/api/rest/bootstrap/', tester_data)
+        self.assertEqual(200, res.status_code)
+        content = json.loads(res.content)
+        self.assertEqual('successful', content['result'])
+        self.assertTrue(TokenSystem.objects.filter(
+            owner=self.tester, token=content['data']['token']).exists())
+        self.assertIsNone(current_shard.get())
+
+        # the recommend list of the day, not one drawn again
+        DailyRecommendation.objects.filter(pocket=self.myPocket).update(restaurants='')
+        res = self.c.get('/api/rest/bootstrap/', {'user_token': self.token})
+        self.assertEqual([], json.loads(res.content)['data']['recommendations'])
+
+        res = self.c.post('/api/rest/bootstrap/', {
+            'username': tester_data['username'],
+            'password': 'wrong password',
+        })
+        self.assertEqual('login failed', json.loads(res.content)['result'])
+
+    def test_import_visit_records(self):
+        """
+            @brief: Basic functional test for importVisitRecords api
+            @target: importVisitRecords
+        """
+        upload = SimpleUploadedFile('visits.csv', (
+            'restaurant_name,visit_date,score\n'
+            'my restaurant,2020-01-01,5\n'
+            'new restaurant,2020-02-01,\n'
+            'new restaurant,2020-03-01,4\n'
+        ).encode('utf-8'))
+        res = self.c.post('/api/rest/importVisitRecords/', {
+            'user_token': self.token,
+            'pocket_uid': self.myPocket.uid,
+            'file': upload,
+        })
+        self.assertEqual(200, res.status_code)
+
+        content = json.loads(res.content)['data']
+        self.assertEqual(3, content['visits_created'])
+        self.assertEqual(1, content['restaurants_created'])
+
+        # visits are attached to the existed restaurant instead of a new one
+        self.assertEqual(self.visitCount + 1,
+                         self.myRest.getVisitRecords().count())
+
+        # last_visit is recomputed once per affected restaurant
+        newRest = self.myPocket.getRestaurants().get(name='new restaurant')
+        self.assertEqual(date(2020, 3, 1), newRest.last_visit)
+        self.assertEqual(3, newRest.getVisitRecords().get(
+            visit_date=date(2020, 2, 1)).score)
+        self.assertEqual(date.today(), Restaurant.objects.get(
+            uid=self.myRest.uid).last_visit)
+
+    def test_import_visit_records_error(self):
+        """
+            @brief: Error testing for importVisitRecords api, a bad row rolls back the whole import
+            @target: importVisitRecords
+        """
+        upload = SimpleUploadedFile('visits.ndjson', (
+            '{"restaurant_name": "abc", "visit_date": "2020-01-01"}\n'
+            '{"restaurant_name": "abc", "visit_date": "01/02/2020"}\n'
+        ).encode('utf-8'))
+        res = self.c.post('/api/rest/importVisitRecords/', {
+            'user_token': self.token,
+            'pocket_uid': self.myPocket.uid,
+            'format': 'ndjson',
+            'file': upload,
+        })
+        self.assertEqual(400, res.status_code)
+        self.assertFalse(self.myPocket.getRestaurants()
+                         .filter(name='abc').exists())
+
+        # a row csv cannot read at all
+        upload = SimpleUploadedFile('visits.csv', (
+            'restaurant_name,visit_date\n'
+            '"%s",2020-01-01\n' % ('x' * 200000)
+        ).encode('utf-8'))
+        res = self.c.post('/api/rest/importVisitRecords/', {
+            'user_token': self.token,
+            'pocket_uid': self.myPocket.uid,
+            'file': upload,
+        })
+        self.assertEqual(400, res.status_code)
+
+    def test_import_visit_records_bom(self):
+        """
+            @brief: A csv saved by a spreadsheet app starts with a byte order mark
+            @target: importVisitRecords
+        """
+        upload = SimpleUploadedFile('visits.csv', (
+            '\ufeffrestaurant_name,visit_date\n'
+            'bom restaurant,2020-01-01\n'
+        ).encode('utf-8'))
+        res = self.c.post('/api/rest/importVisitRecords/', {
+            'user_token': self.token,
+            'pocket_uid': self.myPocket.uid,
+            'file': upload,
+        })
+        self.assertEqual(200, res.status_code)
+        self.assertTrue(self.myPocket.getRestaurants()
+                        .filter(name='bom restaurant').exists())
+
+    def test_import_visits_command(self):
+        """
+            @brief: Basic functional test for importvisits management command
+        """
+        with tempfile.NamedTemporaryFile('w', suffix='.ndjson', delete=False) as f:
+            for day in range(1, 11):
+                f.write(json.dumps({
+                    'restaurant_name': 'restaurant %d' % (day % 3),
+                    'visit_date': '2020-01-%02d' % day,
+                }) + '\n')
+        self.addCleanup(os.remove, f.name)
+
+        out = io.StringIO()
+        call_command('importvisits', str(self.myPocket.uid), f.name,
+                     format='ndjson', batch_size=4, stdout=out)
+        self.assertIn('Imported 10 visit records', out.getvalue())
+
+        self.assertEqual(4, self.myPocket.getRestaurants().count())
+        self.assertEqual(date(2020, 1, 9), self.myPocket.getRestaurants()
+                         .get(name='restaurant 0').last_visit)
+
+    def test_export_pocket(self):
+        """
+            @brief: Export a pocket and import it back into another pocket
+            @target: exportPocket, importVisitRecords
+        """
+        self.myRest.editStatus('ACTIVE')
+        self.myRest.save()
+        self.myRest.addVisitRecord(date(2020, 1, 1), 5)
+        Restaurant(owner=self.tester, pocket=self.myPocket,
+                   name='never visited', note='a, "quoted" note').save()
+
+        for fmt in ('csv', 'ndjson'):
+            res = self.c.get('/api/rest/exportPocket/', {
+                'user_token': self.token,
+                'pocket_uid': self.myPocket.uid,
+                'format': fmt,
+            })
+            self.assertEqual(200, res.status_code)
+            self.assertTrue(res.streaming)
+            content = b''.join(res.streaming_content)
+
+            newPocket = self.tester.pocket_set.create(name='restore ' + fmt)
+            res = self.c.post('/api/rest/importVisitRecords/', {
+                'user_token': self.token,
+                'pocket_uid': newPocket.uid,
+                'format': fmt,
+                'file': SimpleUploadedFile('backup.' + fmt, content),
+            })
+            self.assertEqual(200, res.status_code)
+            self.assertEqual({'restaurants_created': 2, 'visits_created': 2},
+                             json.loads(res.content)['data'])
+
+            restored = newPocket.getRestaurants().get(name=self.myRest.name)
+            self.assertEqual(Restaurant.Status.ACTIVE, restored.status)
+            self.assertEqual(self.myRest.note, restored.note)
+            self.assertEqual(date.today(), restored.last_visit)
+            self.assertEqual([2, 0], sorted(
+                (r.getVisitRecords().count() for r in newPocket.getRestaurants()),
+                reverse=True))
+            self.assertEqual('a, "quoted" note', newPocket.getRestaurants()
+                             .get(name='never visited').note)
+
+    def test_export_pocket_command(self):
+        """
+            @brief: Basic functional test for exportpocket management command
+        """
+        out = io.StringIO()
+        call_command('exportpocket', str(self.myPocket.uid),
+                     format='ndjson', stdout=out)
+        rows = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([self.myRest.name, self.myRest.name],
+                         [row['restaurant_name'] for row in rows])
+        self.assertEqual(str(date.today()), rows[1]['visit_date'])
+
 
 class AccountApiTestCase(TestCase):
     def setUp(self):
@@ -623,3 +1333,767 @@ class AccountApiTestCase(TestCase):
 
         res = self.c.post('/api/rest/loginAccount/', data)
         self.assertEqual(200, res.status_code)
+
+
+class MiddlewareStackTestCase(TestCase):
+    """
+        the API skips the session, csrf, auth and messages middleware, the admin keeps them
+    """
+    def setUp(self):
+        self.c = Client(enforce_csrf_checks=True)
+
+        self.tester = Account(username='tester', email='tester@test.com')
+        self.tester.save()
+        self.tester.initAccount()
+        self.token = self.tester.createToken()
+
+    def test_api_skips_site_middleware(self):
+        res = self.c.get('/api/rest/getPocketList/', {'user_token': self.token})
+        self.assertEqual(200, res.status_code)
+        self.assertFalse(hasattr(res.wsgi_request, 'session'))
+        self.assertFalse(hasattr(res.wsgi_request, 'user'))
+        self.assertFalse(hasattr(res.wsgi_request, '_messages'))
+
+        # CommonMiddleware still runs, hosts are validated
+        res = self.c.get('/api/rest/getPocketList/', {'user_token': self.token}, HTTP_HOST='evil.example')
+        self.assertEqual(400, res.status_code)
+
+        # csrf is not checked even without @csrf_exempt
+        res = self.c.post('/api/rest/newPocket/', {'user_token': self.token, 'name': 'new'})
+        self.assertEqual(200, res.status_code)
+
+    def test_admin_keeps_full_stack(self):
+        res = self.c.get('/admin/login/')
+        self.assertEqual(200, res.status_code)
+        self.assertEqual('DENY', res['X-Frame-Options'])
+        self.assertTrue(res.wsgi_request.user.is_anonymous)
+
+        # csrf is enforced
+        res = self.c.post('/admin/login/', {'username': 'a', 'password': 'b'})
+        self.assertEqual(403, res.status_code)
+
+        # non-staff sessions cannot read the ops endpoints
+        self.assertEqual(401, self.c.get('/ops/cacheStats/').status_code)
+
+
+class ProfilingTestCase(TestCase):
+    def setUp(self):
+        self.tester = Account(username='tester', email='tester@test.com')
+        self.tester.save()
+        self.tester.initAccount()
+        self.token = self.tester.createToken()
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = tmp.name
+
+    def profiles(self) -> list:
+        return sorted(os.listdir(self.dir))
+
+    def test_off_by_default(self):
+        with self.assertRaises(MiddlewareNotUsed):
+            ProfilingMiddleware(lambda request: None)
+
+    def test_sampled_request(self):
+        with override_settings(PROFILE_SAMPLE_RATE=1.0, PROFILE_INTERVAL_MS=1, PROFILE_DIR=self.dir):
+            res = Client().get('/api/rest/getPocketList/', {'user_token': self.token})
+        self.assertEqual(200, res.status_code)
+
+        stacks, queries = self.profiles()
+        self.assertRegex(stacks, r'-getPocketList-\d+ms\.folded$')
+        self.assertTrue(queries.endswith('.sql.folded'))
+        with open(os.path.join(self.dir, queries)) as f:
+            lines = f.read().splitlines()
+        self.assertTrue(lines)
+        for line in lines:
+            self.assertRegex(line, r'^getPocketList;(SELECT|UPDATE) .* \d+$')
+
+    def test_slow_requests_only(self):
+        with override_settings(PROFILE_SLOW_MS=60000, PROFILE_DIR=self.dir):
+            Client().get('/api/rest/getPocketList/', {'user_token': self.token})
+        self.assertEqual([], self.profiles())
+
+        with override_settings(PROFILE_SLOW_MS=0, PROFILE_DIR=self.dir):
+            Client().get('/api/rest/getPocketList/', {'user_token': self.token})
+        self.assertEqual(2, len(self.profiles()))
+
+    def test_sampler(self):
+        sampler = profiling.Sampler(0.001)
+        samples = []
+
+        def busy():
+            profile = sampler.begin(True)
+            deadline = time.perf_counter() + 0.1
+            while time.perf_counter() < deadline:
+                pass
+            sampler.end(profile)
+            samples.append(profile.samples)
+
+        thread = threading.Thread(target=busy)
+        thread.start()
+        thread.join()
+        self.assertTrue(samples[0])
+        for stack in samples[0]:
+            self.assertTrue(stack.endswith('busy (test_views.py:%d)' % busy.__code__.co_firstlineno), stack)
+
+
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        self.tester = Account(username='tester', email='tester@test.com')
+        self.tester.save()
+        self.tester.initAccount()
+        self.token = self.tester.createToken()
+
+        registry = metrics.registry
+        metrics.registry = metrics.Registry()
+        self.addCleanup(setattr, metrics, 'registry', registry)
+
+    def scrape(self) -> str:
+        with override_settings(METRICS_TOKEN='scraper'):
+            res = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer scraper')
+        self.assertEqual(200, res.status_code)
+        self.assertTrue(res['Content-Type'].startswith('text/plain; version=0.0.4'))
+        return res.content.decode()
+
+    def test_metrics(self):
+        self.client.get('/api/rest/getPocketList/', {'user_token': self.token})
+        self.client.get('/api/rest/getPocketList/', {'user_token': self.token})
+        self.client.get('/api/rest/getPocketList/', {'user_token': 'wrong'})
+
+        text = self.scrape()
+        self.assertIn('# TYPE foodpocket_requests_total counter', text)
+        self.assertIn('foodpocket_requests_total{method="GET",status="200",view="getPocketList"} 2', text)
+        self.assertIn('foodpocket_requests_total{method="GET",status="401",view="getPocketList"} 1', text)
+        self.assertIn('foodpocket_request_duration_seconds_bucket{view="getPocketList",le="+Inf"} 3', text)
+        self.assertIn('foodpocket_request_duration_seconds_count{view="getPocketList"} 3', text)
+        self.assertIn('foodpocket_token_validations_total{outcome="accepted"} 2', text)
+        self.assertIn('foodpocket_token_validations_total{outcome="rejected"} 1', text)
+        self.assertRegex(text, r'foodpocket_db_queries_total\{view="getPocketList"\} [1-9]')
+        self.assertRegex(text, r'foodpocket_response_cache_total\{result="hits"\} \d+')
+
+        # scrapers need the token, sessions have to be staff
+        self.assertEqual(401, self.client.get('/metrics').status_code)
+        with override_settings(METRICS_TOKEN='scraper'):
+            self.assertEqual(401, self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer nope').status_code)
+
+    def test_workers_add_up(self):
+        other = metrics.Registry()
+        other.inc('foodpocket_requests_total', {'method': 'GET', 'status': '200', 'view': 'getPocketList'}, 5)
+        other.observe('foodpocket_request_duration_seconds', {'view': 'getPocketList'}, 20.0)
+
+        with tempfile.TemporaryDirectory() as tmp, override_settings(METRICS_DIR=tmp):
+            with open(os.path.join(tmp, 'metrics-1.json'), 'w') as f:
+                json.dump(other.snapshot(), f)
+            self.client.get('/api/rest/getPocketList/', {'user_token': self.token})
+            metrics.flush(force=True)
+            self.assertIn('metrics-%d.json' % os.getpid(), os.listdir(tmp))
+
+            text = self.scrape()
+        self.assertIn('foodpocket_requests_total{method="GET",status="200",view="getPocketList"} 6', text)
+        self.assertIn('foodpocket_request_duration_seconds_bucket{view="getPocketList",le="10.0"} 1', text)
+        self.assertIn('foodpocket_request_duration_seconds_count{view="getPocketList"} 2', text)
+
+
+class CompressionTestCase(TestCase):
+    def setUp(self):
+        self.c = Client()
+
+        self.tester = Account(username='tester', email='tester@test.com')
+        self.tester.save()
+        self.tester.initAccount()
+        self.token = self.tester.createToken()
+        self.pocket = self.tester.pocket_set.first()
+        for i in range(10):
+            rest = Restaurant(owner=self.tester, pocket=self.pocket,
+                              name='restaurant %d' % i, note='a long note ' * 50)
+            rest.save()
+            rest.addVisitRecord(date(2020, 1, 1), 3)
+
+        self.params = {'user_token': self.token, 'pocket_uid': self.pocket.uid}
+
+    def test_large_response_compressed(self):
+        plain = self.c.get('/api/rest/getRestaurantList/', self.params)
+        self.assertFalse(plain.has_header('Content-Encoding'))
+
+        res = self.c.get('/api/rest/getRestaurantList/', self.params, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual('gzip', res['Content-Encoding'])
+        self.assertIn('Accept-Encoding', res['Vary'])
+        self.assertLess(len(res.content), len(plain.content) / 4)
+        self.assertEqual(plain.content, gzip.decompress(res.content))
+
+        # the weak etag of the compressed body still matches
+        self.assertEqual('W/' + plain['ETag'], res['ETag'])
+        res = self.c.get('/api/rest/getRestaurantList/', self.params,
+                         HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=res['ETag'])
+        self.assertEqual(304, res.status_code)
+        self.assertEqual(b'', res.content)
+
+    def test_small_response_not_compressed(self):
+        res = self.c.get('/api/rest/getPocketList/', {'user_token': self.token},
+                         HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(200, res.status_code)
+        self.assertFalse(res.has_header('Content-Encoding'))
+
+    def test_streaming_compressed(self):
+        plain = b''.join(self.c.get('/api/rest/exportPocket/', self.params).streaming_content)
+
+        res = self.c.get('/api/rest/exportPocket/', self.params, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual('gzip', res['Content-Encoding'])
+        self.assertEqual(plain, gzip.decompress(b''.join(res.streaming_content)))
+
+    def test_negotiate(self):
+        self.assertIsNone(compression.negotiate(''))
+        self.assertIsNone(compression.negotiate('gzip;q=0, deflate'))
+        self.assertEqual('gzip', compression.negotiate('deflate, gzip;q=0.5'))
+        self.assertEqual(compression.ENCODINGS[0], compression.negotiate('*'))
+
+
+async def asgi_get(application, path: str, params: dict) -> dict:
+    """
+        GET through an ASGI application, return its response messages merged
+    """
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+        'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'root_path': '',
+        'query_string': urlencode(params).encode(), 'headers': [(b'host', b'testserver')],
+        'server': ('testserver', 80), 'client': ('127.0.0.1', 1),
+    }
+    response = {'status': None, 'headers': {}, 'body': b''}
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+            response['headers'] = dict(message['headers'])
+        else:
+            response['body'] += message.get('body', b'')
+
+    await application(scope, receive, send)
+    return response
+
+
+class AsyncUrls:
+    """
+        urlconf serving read endpoints with the async views, like backend/asgi.py
+    """
+    urlpatterns = [
+        path('api/rest/getRestaurantList/', async_views.getRestaurantList, name='getRestaurantList'),
+        path('api/rest/exportPocket/', views.exportPocket, name='exportPocket'),
+    ]
+
+
+class AsyncViewsTestCase(TransactionTestCase):
+    """
+        async views query the database from the ORM thread pool,
+        so the test data has to be committed
+    """
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+        self.tester = Account(
+            username=tester_data['username'],
+            password=make_password(tester_data['password']),
+            email=tester_data['email'],
+        )
+        self.tester.save()
+        self.tester.initAccount()
+        self.token = self.tester.createToken()
+        self.myPocket = self.tester.pocket_set.first()
+
+        rest = Restaurant(owner=self.tester, pocket=self.myPocket,
+                          name='my restaurant', status=Restaurant.Status.ACTIVE)
+        rest.save()
+        rest.addVisitRecord(date(2020, 1, 1), 3)
+
+    def test_same_output_as_sync_views(self):
+        """
+            async variants return the same data as the sync views
+        """
+        params = {'user_token': self.token, 'pocket_uid': str(self.myPocket.uid)}
+        for name in ('getRecommendList', 'getRecommendLists', 'getRestaurantList', 'getVisitRecords',
+                     'getVisitStats', 'getPocketList'):
+            syncRes = getattr(views, name)(self.factory.get('/', params))
+            asyncRes = async_to_sync(getattr(async_views, name))(self.factory.get('/', params))
+            self.assertEqual(200, asyncRes.status_code, name)
+            self.assertEqual(json.loads(syncRes.content), json.loads(asyncRes.content), name)
+
+        compactParams = dict(params, format='compact')
+        for name in ('getRestaurantList', 'getVisitRecords'):
+            syncRes = getattr(views, name)(self.factory.get('/', compactParams))
+            asyncRes = async_to_sync(getattr(async_views, name))(self.factory.get('/', compactParams))
+            self.assertEqual(json.loads(syncRes.content), json.loads(asyncRes.content), name)
+
+        self.assertIsNotNone(Pocket.objects.get(pk=self.myPocket.pk).last_use_time)
+
+    def test_errors(self):
+        """
+            async variants answer malformed and unauthorized requests like the sync views
+        """
+        stranger = Account(username='stranger', email='stranger@test.com')
+        stranger.save()
+        stranger.initAccount()
+        strangerPocket = str(stranger.pocket_set.first().uid)
+        myPocket = str(self.myPocket.uid)
+
+        cases = [
+            ('getRestaurantList', {'user_token': self.token}, 400),
+            ('getRestaurantList', {'user_token': self.token, 'pocket_uid': 'abc'}, 400),
+            ('getRestaurantList', {'user_token': self.token, 'pocket_uid': myPocket, 'format': 'xml'}, 400),
+            ('getRestaurantList', {'user_token': self.token, 'pocket_uid': myPocket, 'fields': 'abc'}, 400),
+            ('getRestaurantList', {'user_token': 'abc', 'pocket_uid': myPocket}, 401),
+            ('getRestaurantList', {'user_token': 'abc', 'pocket_uid': 'abc'}, 400),
+            ('getRestaurantList', {'user_token': self.token, 'pocket_uid': strangerPocket}, 404),
+            ('getRecommendList', {'user_token': self.token, 'pocket_uid': 'abc'}, 400),
+            ('getRecommendList', {'user_token': self.token, 'pocket_uid': strangerPocket}, 404),
+            ('getRecommendLists', {'user_token': self.token, 'pocket_uids': myPocket + ',abc'}, 400),
+            ('getRecommendLists', {'user_token': self.token, 'pocket_uids': strangerPocket}, 404),
+            ('getRecommendLists', {'user_token': 'abc'}, 401),
+            ('getVisitRecords', {'user_token': self.token, 'pocket_uid': 'abc'}, 400),
+            ('getVisitRecords', {'user_token': self.token, 'pocket_uid': strangerPocket}, 404),
+            ('getVisitStats', {'user_token': self.token, 'pocket_uid': 'abc'}, 400),
+            ('getVisitStats', {'user_token': self.token, 'pocket_uid': myPocket, 'date_to': '2020-13-01'}, 400),
+            ('getVisitStats', {'user_token': self.token, 'pocket_uid': myPocket,
+                               'date_from': '2020-02-01', 'date_to': '2020-01-01'}, 400),
+            ('getPocketList', {}, 400),
+            ('getPocketList', {'user_token': 'abc'}, 401),
+        ]
+        for name, params, status in cases:
+            syncRes = getattr(views, name)(self.factory.get('/', params))
+            asyncRes = async_to_sync(getattr(async_views, name))(self.factory.get('/', params))
+            self.assertEqual(status, syncRes.status_code, (name, params))
+            self.assertEqual(status, asyncRes.status_code, (name, params))
+            self.assertEqual(syncRes.content, asyncRes.content, (name, params))
+
+        for name in ('getRestaurantList', 'getPocketList'):
+            syncRes = getattr(views, name)(self.factory.post('/', {'user_token': self.token}))
+            asyncRes = async_to_sync(getattr(async_views, name))(self.factory.post('/', {'user_token': self.token}))
+            self.assertEqual(400, syncRes.status_code, name)
+            self.assertEqual(syncRes.content, asyncRes.content, name)
+
+    def test_profiled(self):
+        """
+            the ORM threads of an async view are sampled and timed for its profile
+        """
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        with override_settings(PROFILE_SAMPLE_RATE=1.0, PROFILE_INTERVAL_MS=1, PROFILE_DIR=tmp.name):
+            middleware = ProfilingMiddleware(async_to_sync(async_views.getPocketList))
+            res = middleware(self.factory.get('/', {'user_token': self.token}))
+        self.assertEqual(200, res.status_code)
+
+        queries = [name for name in os.listdir(tmp.name) if name.endswith('.sql.folded')]
+        with open(os.path.join(tmp.name, queries[0])) as f:
+            lines = f.read().splitlines()
+        self.assertTrue(lines)
+        for line in lines:
+            self.assertRegex(line, r'^unknown;SELECT .* \d+$')
+
+    def test_metrics_count_queries(self):
+        """
+            queries of the ORM threads of an async view are counted for its view
+        """
+        registry = metrics.registry
+        metrics.registry = metrics.Registry()
+        self.addCleanup(setattr, metrics, 'registry', registry)
+
+        request = self.factory.get('/', {'user_token': self.token})
+        MetricsMiddleware(async_to_sync(async_views.getPocketList))(request)
+        counters = metrics.registry.snapshot()['counters']
+        self.assertLess(0, counters[metrics._key('foodpocket_db_queries_total', {'view': 'unknown'})])
+
+    def test_concurrent_over_asgi(self):
+        """
+            the middleware keep the async views in the event loop, slow requests run side by side
+        """
+        delay = 0.2
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        registry = metrics.registry
+        metrics.registry = metrics.Registry()
+        self.addCleanup(setattr, metrics, 'registry', registry)
+        getOwnerId = reads.token_owner_id
+
+        def slowOwnerId(user_token):
+            time.sleep(delay)
+            return getOwnerId(user_token)
+
+        async def requests(application, count):
+            params = {'user_token': self.token, 'pocket_uid': str(self.myPocket.uid)}
+            return await asyncio.gather(*[
+                asgi_get(application, '/api/rest/getRestaurantList/', params) for _ in range(count)])
+
+        with override_settings(ROOT_URLCONF=AsyncUrls, PROFILE_SAMPLE_RATE=1.0, PROFILE_DIR=tmp.name), \
+                mock.patch.object(reads, 'token_owner_id', slowOwnerId):
+            application = StreamingASGIHandler()
+            start = time.perf_counter()
+            responses = async_to_sync(requests)(application, 8)
+            elapsed = time.perf_counter() - start
+
+        self.assertEqual([200] * 8, [res['status'] for res in responses])
+        self.assertLess(elapsed, delay * 4)
+
+        # queries of the ORM threads are still counted and profiled
+        counters = metrics.registry.snapshot()['counters']
+        self.assertLessEqual(8, counters[metrics._key('foodpocket_db_queries_total', {'view': 'getRestaurantList'})])
+        profiles = [name for name in os.listdir(tmp.name) if name.endswith('.sql.folded')]
+        self.assertEqual(8, len(profiles))
+        for name in profiles:
+            with open(os.path.join(tmp.name, name)) as f:
+                self.assertIn('getRestaurantList;SELECT', f.read())
+
+    def test_export_over_asgi(self):
+        """
+            the export streams ORM rows, ASGI must not iterate it in the event loop
+        """
+        params = {'user_token': self.token, 'pocket_uid': str(self.myPocket.uid)}
+        syncRes = views.exportPocket(self.factory.get('/', params))
+        expected = b''.join(syncRes.streaming_content)
+
+        res = async_to_sync(asgi_get)(StreamingASGIHandler(), '/api/rest/exportPocket/', params)
+        self.assertEqual(200, res['status'])
+        self.assertEqual(expected, res['body'])
+        self.assertIn(b'my restaurant', res['body'])
+
+
+class BackgroundJobTestCase(TestCase):
+    """
+        heavy mutations with background=true, jobs are run in the test thread
+    """
+
+    def setUp(self):
+        self.c = Client()
+        self.tester = Account(
+            username=tester_data['username'],
+            password=make_password(tester_data['password']),
+            email=tester_data['email'],
+        )
+        self.tester.save()
+        self.tester.initAccount()
+        self.token = self.tester.createToken()
+        self.myPocket = self.tester.pocket_set.first()
+
+        for i in range(3):
+            rest = Restaurant(owner=self.tester, pocket=self.myPocket, name='restaurant %d' % i)
+            rest.save()
+            rest.addVisitRecord(date(2020, 1, i + 1), 3)
+
+    def getJob(self, data: dict) -> dict:
+        res = self.c.get('/api/rest/getJob/', {'user_token': self.token, 'job_uid': data['job_uid']})
+        self.assertEqual(200, res.status_code)
+        return json.loads(res.content)['data']
+
+    def test_remove_pocket(self):
+        secondPocket = self.tester.pocket_set.create(name='2nd pocket')
+
+        res = self.c.post('/api/rest/removePocket/', {
+            'user_token': self.token, 'pocket_uid': self.myPocket.uid, 'background': 'true'})
+        self.assertEqual(202, res.status_code)
+        data = json.loads(res.content)['data']
+        self.assertEqual('QUEUED', data['status'])
+
+        # the pocket is gone right away, its restaurants once the job ran
+        self.assertEqual(Pocket.Status.DELETED, Pocket.objects.get(pk=self.myPocket.pk).status)
+        self.assertEqual(3, self.myPocket.getRestaurants().count())
+
+        self.assertEqual(1, jobs.run_pending())
+        job = self.getJob(data)
+        self.assertEqual('DONE', job['status'])
+        self.assertEqual((3, 3), (job['progress'], job['total']))
+        self.assertEqual(0, self.myPocket.getRestaurants().count())
+        self.assertFalse(VisitRecord.objects.filter(restaurant__pocket=self.myPocket)
+                         .exclude(status=VisitRecord.Status.DELETED).exists())
+
+        # the last pocket is still protected before anything is enqueued
+        res = self.c.post('/api/rest/removePocket/', {
+            'user_token': self.token, 'pocket_uid': secondPocket.uid, 'background': 'true'})
+        self.assertEqual(403, res.status_code)
+        self.assertEqual(1, Job.objects.count())
+
+    def test_remove_pocket_enqueue_failed(self):
+        self.tester.pocket_set.create(name='2nd pocket')
+
+        # the pocket is not left hidden without a job removing its restaurants
+        with mock.patch.object(jobs, 'enqueue', side_effect=OperationalError('database is locked')), \
+                self.assertRaises(OperationalError):
+            self.c.post('/api/rest/removePocket/', {
+                'user_token': self.token, 'pocket_uid': self.myPocket.uid, 'background': 'true'})
+        self.assertEqual(Pocket.Status.ACTIVE, Pocket.objects.get(pk=self.myPocket.pk).status)
+
+    def test_copy_pocket(self):
+        res = self.c.post('/api/rest/newPocket/', {
+            'user_token': self.token,
+            'name': 'copy',
+            'copy_from': self.myPocket.uid,
+            'deep_copy_restaurants': 'true',
+            'background': 'true',
+        })
+        self.assertEqual(202, res.status_code)
+        data = json.loads(res.content)['data']
+        pocket = Pocket.objects.get(uid=data['pocket_uid'])
+        self.assertEqual(0, pocket.getRestaurants().count())
+
+        jobs.run_pending()
+        job = self.getJob(data)
+        self.assertEqual('DONE', job['status'])
+        self.assertEqual(3, job['result']['size'])
+        self.assertEqual(3, pocket.getRestaurants().count())
+        self.assertEqual(3, pocket.getVisitRecords().count())
+
+    def test_import_visit_records(self):
+        with tempfile.TemporaryDirectory() as tmp, override_settings(JOB_FILES_DIR=tmp):
+            res = self.c.post('/api/rest/importVisitRecords/', {
+                'user_token': self.token,
+                'pocket_uid': self.myPocket.uid,
+                'background': 'true',
+                'file': SimpleUploadedFile('visits.csv', (
+                    'restaurant_name,visit_date,score\n'
+                    'restaurant 0,2020-02-01,5\n'
+                    'new restaurant,2020-02-01,\n'
+                ).encode('utf-8')),
+            })
+            self.assertEqual(202, res.status_code)
+            data = json.loads(res.content)['data']
+            self.assertEqual(1, len(os.listdir(tmp)))
+
+            jobs.run_pending()
+            job = self.getJob(data)
+            self.assertEqual('DONE', job['status'])
+            self.assertEqual({'restaurants_created': 1, 'visits_created': 2}, job['result'])
+            self.assertEqual((2, 2), (job['progress'], job['total']))
+            self.assertEqual([], os.listdir(tmp))
+
+            # a bad row fails the job with the import error
+            res = self.c.post('/api/rest/importVisitRecords/', {
+                'user_token': self.token,
+                'pocket_uid': self.myPocket.uid,
+                'background': 'true',
+                'file': SimpleUploadedFile('visits.csv', b'restaurant_name,visit_date\nabc,01/02/2020\n'),
+            })
+            jobs.run_pending()
+            job = self.getJob(json.loads(res.content)['data'])
+            self.assertEqual('FAILED', job['status'])
+            self.assertIn('line 2', job['error'])
+            self.assertFalse(self.myPocket.getRestaurants().filter(name='abc').exists())
+
+    def test_get_job_errors(self):
+        job = jobs.enqueue('removePocket', self.tester, pocket_uid=str(self.myPocket.uid))
+        stranger = Account(username='stranger', email='stranger@test.com')
+        stranger.save()
+        stranger.initAccount()
+
+        cases = [
+            ({'user_token': self.token}, 400),
+            ({'user_token': self.token, 'job_uid': 'abc'}, 400),
+            ({'user_token': 'abc', 'job_uid': job.uid}, 401),
+            ({'user_token': stranger.createToken(), 'job_uid': job.uid}, 404),
+        ]
+        for params, status in cases:
+            self.assertEqual(status, self.c.get('/api/rest/getJob/', params).status_code, params)
+
+    def test_lease(self):
+        """
+            a job whose worker stopped reporting is claimed again, until it ran out of attempts
+        """
+        job = jobs.enqueue('removePocket', self.tester, pocket_uid=str(self.myPocket.uid))
+        self.assertEqual(job.pk, jobs.claim('a').pk)
+        self.assertIsNone(jobs.claim('b'))
+
+        expired = timezone.now() - timezone.timedelta(seconds=1)
+        Job.objects.filter(pk=job.pk).update(lease_until=expired)
+        claimed = jobs.claim('b')
+        self.assertEqual(('b', 2), (claimed.worker, claimed.attempts))
+
+        with override_settings(JOB_MAX_ATTEMPTS=2):
+            Job.objects.filter(pk=job.pk).update(lease_until=expired)
+            self.assertIsNone(jobs.claim('c'))
+        job.refresh_from_db()
+        self.assertEqual(Job.Status.FAILED, job.status)
+        self.assertEqual('Worker lost', job.error)
+
+
+class JobWorkerTestCase(TransactionTestCase):
+    """
+        the runjobs command runs jobs on its own threads, so the test data has to be committed
+    """
+
+    def setUp(self):
+        self.tester = Account(username=tester_data['username'], email=tester_data['email'])
+        self.tester.save()
+        self.tester.initAccount()
+
+    def test_runjobs(self):
+        tester = self.tester
+        pockets = [tester.pocket_set.create(name='pocket %d' % i) for i in range(4)]
+        for pocket in pockets:
+            Restaurant(owner=tester, pocket=pocket, name='restaurant').save()
+            jobs.enqueue('removePocket', tester, pocket_uid=str(pocket.uid))
+
+        out = io.StringIO()
+        call_command('runjobs', '--once', '--concurrency', '2', stdout=out)
+        self.assertIn('Ran 4 jobs', out.getvalue())
+        self.assertEqual(4, Job.objects.filter(status=Job.Status.DONE).count())
+        self.assertFalse(Restaurant.objects.exclude(status=Restaurant.Status.DELETED)
+                         .filter(pocket__in=pockets).exists())
+
+    def test_progress_committed(self):
+        """
+            getJob on another connection sees the progress of a running copy
+        """
+        source = self.tester.pocket_set.first()
+        Restaurant.objects.bulk_create([
+            Restaurant(owner=self.tester, pocket=source, name='restaurant %d' % i) for i in range(1200)])
+        target = self.tester.pocket_set.create(name='target')
+        job = jobs.enqueue('copyRestaurants', self.tester, pocket_uid=str(target.uid),
+                           copy_from=str(source.uid))
+
+        seen = []
+        report = Job.report
+
+        def observed(job, progress, total=None, checkpoint=False):
+            report(job, progress, total, checkpoint)
+
+            def poll():
+                seen.append(Job.objects.values_list('progress', 'total').get(pk=job.pk))
+                connection.close()
+            thread = threading.Thread(target=poll)
+            thread.start()
+            thread.join()
+
+        with mock.patch.object(Job, 'report', observed):
+            call_command('runjobs', '--once', '--concurrency', '2', stdout=io.StringIO())
+
+        # each report is committed with its chunk, the poll sees the one before
+        self.assertEqual([(0, 0), (500, 1200), (1000, 1200)], seen)
+        job.refresh_from_db()
+        self.assertEqual(Job.Status.DONE, job.status)
+        self.assertEqual(1200, target.getRestaurants().count())
+
+    def test_retry_resumes(self):
+        """
+            a copy claimed again after its worker was lost skips what it committed
+        """
+        source = self.tester.pocket_set.first()
+        for i in range(3):
+            Restaurant(owner=self.tester, pocket=source, name='restaurant %d' % i).save()
+        target = self.tester.pocket_set.create(name='target')
+        job = jobs.enqueue('copyRestaurants', self.tester, pocket_uid=str(target.uid),
+                           copy_from=str(source.uid))
+        # the earlier attempt committed two restaurants, and its checkpoint with them
+        Restaurant(owner=self.tester, pocket=target, name='restaurant 0').save()
+        Restaurant(owner=self.tester, pocket=target, name='restaurant 1').save()
+        JobCheckpoint.objects.create(job_uid=job.uid, progress=2)
+        Job.objects.filter(pk=job.pk).update(
+            status=Job.Status.RUNNING, attempts=1, progress=2, total=3,
+            lease_until=timezone.now() - timezone.timedelta(seconds=1))
+
+        self.assertEqual(1, jobs.run_pending())
+        job.refresh_from_db()
+        self.assertEqual(Job.Status.DONE, job.status)
+        self.assertEqual(3, json.loads(job.result)['size'])
+        self.assertEqual(['restaurant 0', 'restaurant 1', 'restaurant 2'],
+                         sorted(target.getRestaurants().values_list('name', flat=True)))
+        self.assertFalse(JobCheckpoint.objects.exists())
+
+    def test_lease_fenced(self):
+        """
+            a worker whose job was claimed again stops at its next report and stores nothing
+        """
+        source = self.tester.pocket_set.first()
+        for i in range(3):
+            Restaurant(owner=self.tester, pocket=source, name='restaurant %d' % i).save()
+        target = self.tester.pocket_set.create(name='target')
+        jobs.enqueue('copyRestaurants', self.tester, pocket_uid=str(target.uid), copy_from=str(source.uid))
+
+        stale = jobs.claim('a')
+        Job.objects.update(lease_until=timezone.now() - timezone.timedelta(seconds=1))
+        claimed = jobs.claim('b')
+        self.assertEqual(('b', 2), (claimed.worker, claimed.attempts))
+
+        with self.assertLogs('restaurant.jobs', 'WARNING'):
+            jobs.run(stale)
+        # its chunk was rolled back with the report, the job is still b's
+        self.assertFalse(target.getRestaurants().exists())
+        self.assertEqual((Job.Status.RUNNING, 'b', 0), Job.objects.values_list('status', 'worker', 'progress').get())
+        with self.assertRaises(Job.LeaseLost):
+            stale.report(3)
+
+    def test_claim_retried(self):
+        """
+            a locked database while claiming does not stop the worker
+        """
+        pocket = self.tester.pocket_set.first()
+        jobs.enqueue('removePocket', self.tester, pocket_uid=str(pocket.uid))
+
+        claim = jobs.claim
+        failures = [OperationalError('database is locked')]
+
+        def flaky(worker):
+            if failures:
+                raise failures.pop()
+            return claim(worker)
+
+        out = io.StringIO()
+        with mock.patch.object(jobs, 'claim', flaky), self.assertLogs('restaurant.jobs', 'WARNING'):
+            call_command('runjobs', '--once', '--poll', '0.01', stdout=out)
+        self.assertIn('Ran 1 jobs', out.getvalue())
+
+
+class SingleFlightTestCase(SimpleTestCase):
+    def test_concurrent_calls_share_result(self):
+        flight = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def slow():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return b'payload'
+
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            leader = pool.submit(flight.do, 'key', slow, 5)
+            started.wait(5)
+            followers = [pool.submit(flight.do, 'key', slow, 5) for _ in range(3)]
+            threading.Timer(0.05, release.set).start()
+
+            self.assertEqual((b'payload', False), leader.result())
+            self.assertEqual([(b'payload', True)] * 3, [future.result() for future in followers])
+
+        self.assertEqual(1, len(calls))
+        self.assertEqual(0, flight.in_flight())
+
+    def test_stuck_leader_times_out(self):
+        flight = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+
+        def stuck():
+            started.set()
+            release.wait(5)
+            return 'late'
+
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            future = pool.submit(flight.do, 'key', stuck, 0.05)
+            started.wait(5)
+            self.assertEqual(('follower', False), flight.do('key', lambda: 'follower', 0.05))
+            release.set()
+            future.result()
+
+    def test_failed_leader(self):
+        flight = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+
+        def failing():
+            started.set()
+            release.wait(5)
+            raise ValueError('boom')
+
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            future = pool.submit(flight.do, 'key', failing, 5)
+            started.wait(5)
+            threading.Timer(0.05, release.set).start()
+            self.assertEqual(('follower', False), flight.do('key', lambda: 'follower', 5))
+            with self.assertRaises(ValueError):
+                future.result()
@@ -0,0 +1,310 @@
+import csv
+import json
+from contextlib import nullcontext
+from datetime import date
+from django.db import router, transaction
+from . import response_cache
+from .models import DailyRecommendation, Restaurant, VisitRecord, VisitSummary
+
+
+# number of rows handled per bulk_create round trip
+DEFAULT_BATCH_SIZE = 500
+
+SUPPORTED_FORMATS = ('csv', 'ndjson')
+
+CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+# one row per restaurant (without visit_date) followed by one row per visit
+RESTAURANT_FIELDS = ['restaurant_name', 'status', 'hide_until',
+                     'note', 'address', 'longitude', 'latitude']
+VISIT_FIELDS = ['restaurant_name', 'visit_date', 'score']
+EXPORT_FIELDS = RESTAURANT_FIELDS + ['visit_date', 'score']
+
+
+class TransferError(Exception):
+    """
+        raised when an import row cannot be parsed,
+        line is the 1-based line number of the offending row
+    """
+
+    def __init__(self, line: int, message: str):
+        super().__init__('line %d: %s' % (line, message))
+        self.line = line
+        self.message = message
+
+
+def iter_rows(lines, fmt: str = 'csv'):
+    """
+        incrementally parse text lines into (line number, row dict) pairs
+        csv needs a header row, ndjson needs one json object per line
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(lines)
+        for row in reader:
+            yield reader.line_num, row
+    elif fmt == 'ndjson':
+        for lineNum, line in enumerate(lines, start=1):
+            line = line.strip()
+            if line == '':
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                raise TransferError(lineNum, 'Invalid json')
+            if not isinstance(row, dict):
+                raise TransferError(lineNum, 'Each line should be a json object')
+            yield lineNum, row
+    else:
+        raise ValueError('Unsupported format: ' + str(fmt))
+
+
+def _parse_restaurant(lineNum: int, name: str, row: dict) -> dict:
+    fields = {'name': name}
+
+    status = row.get('status') or 'RANDOM'
+    if status not in ('ACTIVE', 'RANDOM'):
+        raise TransferError(lineNum, 'status should be ACTIVE or RANDOM')
+    fields['status'] = Restaurant.Status[status].value
+
+    if row.get('hide_until'):
+        try:
+            fields['hide_until'] = date.fromisoformat(str(row['hide_until']))
+            # bulk inserts skip Restaurant.save
+            fields['hidden'] = fields['hide_until'] > date.today()
+        except ValueError:
+            raise TransferError(
+                lineNum, 'Wrong hide_until format, should be YYYY-MM-DD')
+
+    try:
+        fields['longitude'] = float(row.get('longitude') or 0.0)
+        fields['latitude'] = float(row.get('latitude') or 0.0)
+    except (TypeError, ValueError):
+        raise TransferError(lineNum, 'longitude and latitude should be numbers')
+
+    fields['note'] = str(row.get('note') or '')[:1000]
+    fields['address'] = str(row.get('address') or '')[:200]
+    return fields
+
+
+def _parse_row(lineNum: int, row: dict) -> tuple:
+    """
+        return ('restaurant', name, fields) for rows without visit_date,
+        otherwise ('visit', name, (visit_date, score))
+    """
+    name = str(row.get('restaurant_name') or '').strip()[:200]
+    if name == '':
+        raise TransferError(lineNum, 'restaurant_name cannot be empty')
+
+    if not row.get('visit_date'):
+        return 'restaurant', name, _parse_restaurant(lineNum, name, row)
+
+    try:
+        visit_date = date.fromisoformat(str(row['visit_date']))
+    except ValueError:
+        raise TransferError(
+            lineNum, 'Wrong visit_date format, should be YYYY-MM-DD')
+
+    try:
+        score = int(row.get('score') or 3)
+    except (TypeError, ValueError):
+        raise TransferError(lineNum, 'score should be an integer')
+    score = max(min(score, 5), 1)  # 1 <= score <= 5
+
+    return 'visit', name, (visit_date, score)
+
+
+def _resolve_restaurants(pocket, names: set, details: dict) -> (dict, int):
+    """
+        map restaurant names to ids inside a pocket,
+        restaurants which do not exist yet are created with one bulk insert,
+        using the fields in details when the import provides them
+
+        return
+        1. name to id map
+        2. number of created restaurants
+    """
+    nameMap = dict(
+        pocket.getRestaurants().filter(name__in=names).values_list('name', 'id')
+    )
+
+    missing = [name for name in names if name not in nameMap]
+    if missing:
+        Restaurant.objects.bulk_create([
+            Restaurant(owner=pocket.owner, pocket=pocket,
+                       **details.get(name, {'name': name}))
+            for name in missing
+        ])
+        # sqlite does not return primary keys from bulk inserts
+        nameMap.update(
+            pocket.getRestaurants().filter(name__in=missing).values_list('name', 'id')
+        )
+
+    return nameMap, len(missing)
+
+
+def _flush_batch(pocket, batch: list, stats: dict, affected: set):
+    details = {name: value for kind, name, value in batch
+               if kind == 'restaurant'}
+    nameMap, created = _resolve_restaurants(
+        pocket, {name for _, name, _ in batch}, details)
+    stats['restaurants_created'] += created
+
+    visits = [
+        VisitRecord(
+            restaurant_id=nameMap[name],
+            owner=pocket.owner,
+            visit_date=value[0],
+            score=value[1],
+        ) for kind, name, value in batch if kind == 'visit'
+    ]
+    VisitRecord.objects.bulk_create(visits)
+
+    stats['visits_created'] += len(visits)
+    affected.update(visit.restaurant_id for visit in visits)
+
+
+def validate(lines, fmt: str = 'csv', progress=None) -> int:
+    """
+        parse every row without importing anything, raise the TransferError
+        of the first bad one, return the number of rows
+        progress: optional callable(rows) called after every DEFAULT_BATCH_SIZE rows
+    """
+    rows = 0
+    for lineNum, row in iter_rows(lines, fmt):
+        _parse_row(lineNum, row)
+        rows += 1
+        if progress is not None and rows % DEFAULT_BATCH_SIZE == 0:
+            progress(rows)
+    return rows
+
+
+def _finish(pocket, affected: set, db: str, batch_size: int):
+    Restaurant.updateLastVisits(affected)
+    # bulk inserts skip VisitRecord.save
+    VisitSummary.rebuild(affected, using=db, batch_size=batch_size)
+
+    # bulk inserts send no post_save, drop what was derived from the pocket
+    # here rather than rely on what updateLastVisits happens to invalidate
+    response_cache.invalidate(pocket.owner_id, db)
+    DailyRecommendation.invalidate([pocket.id], db)
+    affected.clear()
+
+
+def import_visit_records(pocket, lines, fmt: str = 'csv', batch_size: int = DEFAULT_BATCH_SIZE,
+                         progress=None, atomic: bool = True, skip: int = 0) -> dict:
+    """
+        import visit records from csv or ndjson lines into a pocket
+
+        rows need restaurant_name and visit_date, score is optional
+        rows without visit_date describe a restaurant (see RESTAURANT_FIELDS),
+        which is how exported pockets are imported back
+        restaurants are resolved by name and created when missing,
+        visits are inserted with bulk_create every batch_size rows and
+        last_visit is recomputed once per affected restaurant at the end
+
+        the whole import runs in one transaction, a TransferError
+        rolls back every row imported before it
+        progress: optional callable(rows) called after every batch
+        atomic: off commits every batch on its own with its progress call,
+            last visits included, for background jobs which validate() first
+        skip: rows imported by an earlier run (its last progress), e.g. a retried job
+    """
+    stats = {'restaurants_created': 0, 'visits_created': 0}
+    affected = set()
+    batch = []
+    rows = 0
+
+    db = router.db_for_write(VisitRecord, instance=pocket)
+
+    def flush():
+        # the transaction of the batch unless the whole import has one
+        with transaction.atomic(using=db, savepoint=False):
+            _flush_batch(pocket, batch, stats, affected)
+            if not atomic:
+                _finish(pocket, affected, db, batch_size)
+            if progress is not None:
+                progress(rows)
+
+    with transaction.atomic(using=db) if atomic else nullcontext():
+        for lineNum, row in iter_rows(lines, fmt):
+            rows += 1
+            if rows <= skip:
+                continue
+            batch.append(_parse_row(lineNum, row))
+            if len(batch) >= batch_size:
+                flush()
+                batch = []
+
+        if batch:
+            flush()
+
+        if atomic:
+            _finish(pocket, affected, db, batch_size)
+
+    return stats
+
+
+class _Echo:
+    """
+        file-like object whose write returns the value,
+        lets csv.writer produce one line at a time
+    """
+
+    def write(self, value):
+        return value
+
+
+def iter_export_rows(pocket, chunk_size: int = DEFAULT_BATCH_SIZE):
+    """
+        yield the rows of a pocket export, restaurants first then visits,
+        both queries are streamed with iterator() (server-side cursors
+        where the database supports them) so memory use stays constant
+    """
+    restaurants = pocket.getRestaurants().order_by('id').values_list(
+        'name', 'status', 'hide_until', 'note', 'address', 'longitude', 'latitude')
+    for name, status, hide_until, note, address, longitude, latitude in \
+            restaurants.iterator(chunk_size=chunk_size):
+        yield {
+            'restaurant_name': name,
+            'status': Restaurant.Status(status).name,
+            'hide_until': hide_until.isoformat(),
+            'note': note,
+            'address': address,
+            'longitude': longitude,
+            'latitude': latitude,
+        }
+
+    visits = VisitRecord.objects \
+        .filter(restaurant__pocket=pocket) \
+        .exclude(status=VisitRecord.Status.DELETED) \
+        .exclude(restaurant__status=Restaurant.Status.DELETED) \
+        .order_by('restaurant_id', 'visit_date', 'id') \
+        .values_list('restaurant__name', 'visit_date', 'score')
+    for name, visit_date, score in visits.iterator(chunk_size=chunk_size):
+        yield {
+            'restaurant_name': name,
+            'visit_date': visit_date.isoformat(),
+            'score': score,
+        }
+
+
+def export_pocket(pocket, fmt: str = 'csv', chunk_size: int = DEFAULT_BATCH_SIZE):
+    """
+        yield a pocket export as text lines in csv or ndjson,
+        the output can be imported back with import_visit_records
+    """
+    rows = iter_export_rows(pocket, chunk_size)
+
+    if fmt == 'csv':
+        writer = csv.DictWriter(_Echo(), fieldnames=EXPORT_FIELDS)
+        yield writer.writeheader()
+        for row in rows:
+            yield writer.writerow(row)
+    elif fmt == 'ndjson':
+        for row in rows:
+            yield json.dumps(row, ensure_ascii=False) + '\n'
+    else:
+        raise ValueError('Unsupported format: ' + str(fmt))
@@ -1,27 +1,39 @@
+from django.conf import settings
 from django.urls import path
-from . import views
+from . import views, async_views
+
+# read endpoints, async variants under ASGI
+readViews = async_views if settings.ASYNC_VIEWS else views
 
 urlpatterns = [
     # Account API
     path('registerAccount/', views.registerAccount, name='registerAccount'),
     path('loginAccount/', views.loginAccount, name='loginAccount'),
+    path('bootstrap/', views.bootstrap, name='bootstrap'),
 
     # Pocket API
-    path('getPocketList/', views.getPocketList, name='getPocketList'),
+    path('getPocketList/', readViews.getPocketList, name='getPocketList'),
     path('newPocket/', views.newPocket, name='newPocket'),
     path('editPocket/', views.editPocket, name='editPocket'),
     path('removePocket/', views.removePocket, name='removePocket'),
+    path('exportPocket/', views.exportPocket, name='exportPocket'),
 
     # Restaurant API
-    path('getRecommendList/', views.getRecommendList, name='getRecommendList'),
-    path('getRestaurantList/', views.getRestaurantList, name='getRestaurantList'),
+    path('getRecommendList/', readViews.getRecommendList, name='getRecommendList'),
+    path('getRecommendLists/', readViews.getRecommendLists, name='getRecommendLists'),
+    path('getRestaurantList/', readViews.getRestaurantList, name='getRestaurantList'),
     path('newRestaurant/', views.newRestaurant, name='newRestaurant'),
     path('editRestaurant/', views.editRestaurant, name='editRestaurant'),
     path('removeRestaurant/', views.removeRestaurant, name='removeRestaurant'),
 
     # VisitRecord API
-    path('getVisitRecords/', views.getVisitRecords, name='getVisitRecords'),
+    path('getVisitRecords/', readViews.getVisitRecords, name='getVisitRecords'),
+    path('getVisitStats/', readViews.getVisitStats, name='getVisitStats'),
     path('newVisit/', views.newVisit, name='newVisit'),
     path('editVisitRecord/', views.editVisitRecord, name='editVisitRecord'),
     path('removeVisitRecord/', views.removeVisitRecord, name='removeVisitRecord'),
+    path('importVisitRecords/', views.importVisitRecords, name='importVisitRecords'),
+
+    # Background jobs
+    path('getJob/', views.getJob, name='getJob'),
 ]